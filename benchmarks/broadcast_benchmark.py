@@ -0,0 +1,89 @@
+"""
+Measures the cost of sending every frame message to a growing amount of local websocket clients,
+sending the message to each client with websocket.send versus encoding and framing it once with FramedMessage.
+
+Run from the repository root:
+python -m benchmarks.broadcast_benchmark --clients 1 4 16 64
+
+Clients don't negotiate compression, since compressed connections can't share frames.
+"""
+import argparse
+import websockets
+from libs.Helpers.GeneralHelpers import *
+from libs.Websockets.FramedMessage import FramedMessage
+from benchmarks.decoder_benchmark import synthesize_messages
+
+
+async def send_per_client(connections: list, message: str):
+    for connection in connections:
+        await connection.send(message)
+
+
+async def send_preframed(connections: list, message: str):
+    framed_message = FramedMessage(message)
+    for connection in connections:
+        await framed_message.send(connection)
+
+
+async def measure(send, messages: list, client_count: int) -> float:
+    """Returns the seconds spent sending all messages to all clients, excluding the time the clients take to read."""
+    connections = []
+    connected = asyncio.Event()
+
+    async def handle_connection(websocket, path=None):
+        connections.append(websocket)
+        if len(connections) == client_count:
+            connected.set()
+        await websocket.wait_closed()
+
+    received = [0]
+
+    async def read(client):
+        async for _ in client:
+            received[0] += 1
+
+    server = await websockets.serve(handle_connection, 'localhost', 0, compression=None)
+    port = server.sockets[0].getsockname()[1]
+    clients = [await websockets.connect(f'ws://localhost:{port}/', compression=None, max_size=None) for _ in range(client_count)]
+    readers = [asyncio.create_task(read(client)) for client in clients]
+    await connected.wait()
+
+    seconds = 0.0
+    for i, message in enumerate(messages):
+        start_time = time.perf_counter()
+        await send(connections, message)
+        seconds += time.perf_counter() - start_time
+        while received[0] < (i + 1) * client_count:
+            await asyncio.sleep(0)
+
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*readers)
+    server.close()
+    await server.wait_closed()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', help='JSON file containing a list of recorded messages')
+    parser.add_argument('--frames', type=int, default=120, help='Amount of frames to synthesize without --messages')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    messages = load_json_file(args.messages) if args.messages else synthesize_messages(args.frames)
+    total_bytes = sum(len(message.encode('utf-8')) for message in messages)
+    logger.info(f"Sending {len(messages)} messages, {total_bytes} bytes per client.")
+
+    for client_count in args.clients:
+        results = {}
+        for name, send in (('per_client', send_per_client), ('preframed', send_preframed)):
+            seconds = asyncio.run(measure(send, messages, client_count))
+            results[name] = seconds
+            logger.info(f"{client_count} clients, {name}: {seconds / len(messages) * 1e6:.0f} us/frame, "
+                        f"{seconds / len(messages) / client_count * 1e6:.1f} us/frame/client")
+        logger.info(f"{client_count} clients: preframed is {results['per_client'] / results['preframed']:.2f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Measures per-message compression of the frame stream, as the server does it: every message is compressed on its own,
+once for all clients. Messages are the deltas a client with --features receives for the flappy.nes encoder benchmark scenarios.
+
+Text messages are compressed with permessage-deflate at every --deflate-levels and --window-bits,
+and binary messages with zstd at every --zstd-levels, without and with a dictionary.
+Reports per scenario the compressed size as a fraction of the text message, and the compress and decompress time per frame.
+
+The dictionary is trained on a separate input sequence, or on --recordings of the game, so it isn't measured on
+the frames it was trained on. --train-dictionary saves it, for NESGameServer.ZSTD_DICTIONARY_PATH and clients.
+
+Run from the repository root:
+python -m benchmarks.compression_benchmark
+python -m benchmarks.compression_benchmark --features palette,shift,rowcache --train-dictionary flappy.zdict
+"""
+import argparse
+import zlib
+from libs.Helpers.GeneralHelpers import *
+from libs.Protocol.FrameProtocol import FEATURE_BINARY, FEATURE_ZSTD, parse_features, message_to_binary
+from libs.Protocol.ZstdCodec import ZSTD_DICTIONARY_SIZE, zstandard, train_dictionary
+from libs.Recording.StreamReader import StreamReader
+from libs.DisplayStrategies.DisplayStrategy import update_canvas
+from libs.Websockets.FrameWebsocket import FrameWebsocket
+from libs.Websockets.FramedMessage import DEFLATE_TAIL
+from benchmarks.encoder_benchmark import SCENARIOS, BUTTON_A, BUTTON_START, render_scenario
+
+# Frames of gameplay with random flaps, to train the dictionary on when no recordings are given
+TRAINING_FRAME_COUNT = 900
+TRAINING_FLAP_CHANCE = 0.06
+TRAINING_SEED = 5
+
+
+def training_frames() -> list:
+    rng = np.random.default_rng(TRAINING_SEED)
+    # Restarts every 90 frames, so the sequence also covers the title screen and crashes
+    return render_scenario(TRAINING_FRAME_COUNT,
+                           lambda i: BUTTON_START if i % 90 == 0 else (BUTTON_A if rng.random() < TRAINING_FLAP_CHANCE else 0))
+
+
+def recording_frames(path: str) -> list:
+    frames = []
+    with StreamReader(path) as reader:
+        canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+        for index in range(len(reader)):
+            update_canvas(message=reader.get_message(index), canvas=canvas, offset=reader.offset)
+            # The canvas holds (b, g, r), the emulator's frames (r, g, b)
+            frames.append(canvas[..., ::-1].copy())
+    return frames
+
+
+def stream_messages(frames: list, features: frozenset) -> list:
+    """Returns the non-empty text messages a client with the features receives while it stays connected."""
+    features = features - {FEATURE_BINARY, FEATURE_ZSTD}
+    frame_websocket = FrameWebsocket('localhost', None, rectangles=True, deflate=False)
+    messages = []
+    for frame in frames:
+        encoded_frame = frame_websocket.encode_frame(frame)
+        variant = frame_websocket.get_variant_message(features, encoded_frame, keyframe=False)
+        if variant is None:
+            variant = frame_websocket.get_variant_message(features, encoded_frame, keyframe=True)
+        if len(variant[0]) > 0:
+            messages.append(variant[0].message)
+    frame_websocket.encoder_executor.shutdown()
+    return messages
+
+
+def deflate(payload: bytes, level: int, window_bits: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+    return (compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(DEFLATE_TAIL)]
+
+
+def inflate(data: bytes, window_bits: int) -> bytes:
+    return zlib.decompressobj(-window_bits).decompress(data + DEFLATE_TAIL)
+
+
+def measure(payloads: list, compress, decompress, text_bytes: int) -> dict:
+    start_time = time.perf_counter()
+    compressed = [compress(payload) for payload in payloads]
+    compress_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    decompressed = [decompress(data) for data in compressed]
+    decompress_seconds = time.perf_counter() - start_time
+    if decompressed != payloads:
+        raise Exception("Decompressed messages differ from the originals")
+    return {'ratio': sum(map(len, compressed)) / text_bytes,
+            'compress_us_per_frame': compress_seconds / len(payloads) * 1e6,
+            'decompress_us_per_frame': decompress_seconds / len(payloads) * 1e6}
+
+
+def log_result(name: str, result: dict):
+    logger.info(f"  {name:<22} ratio {result['ratio']:.3f}, compress {result['compress_us_per_frame']:.0f} us/frame, "
+                f"decompress {result['decompress_us_per_frame']:.0f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', default='', help='Comma separated optional features of the measured stream')
+    parser.add_argument('--deflate-levels', type=int, nargs='+', default=[1, 6, 9])
+    parser.add_argument('--window-bits', type=int, nargs='+', default=[10, 12, 15])
+    parser.add_argument('--zstd-levels', type=int, nargs='+', default=[1, 3, 9])
+    parser.add_argument('--dictionary-size', type=int, default=ZSTD_DICTIONARY_SIZE)
+    parser.add_argument('--recordings', nargs='+', default=[], help='Recordings to train the dictionary on')
+    parser.add_argument('--train-dictionary', help='Save the trained dictionary to this path')
+    args = parser.parse_args()
+    features = parse_features('/?features=' + args.features)
+
+    dictionary = None
+    if zstandard is None:
+        logger.warning("zstandard isn't installed, only measuring deflate")
+    else:
+        frames = [frame for path in args.recordings for frame in recording_frames(path)] or training_frames()
+        dictionary = train_dictionary([message_to_binary(message) for message in stream_messages(frames, features)],
+                                      size=args.dictionary_size)
+        if args.train_dictionary:
+            with open(args.train_dictionary, 'wb') as file:
+                file.write(dictionary)
+            logger.info(f"Saved a {len(dictionary)} byte dictionary trained on {len(frames)} frames to {args.train_dictionary}")
+
+    for scenario, (frame_count, action) in SCENARIOS.items():
+        messages = stream_messages(render_scenario(frame_count, action), features)
+        texts = [message.encode('utf-8') for message in messages]
+        text_bytes = sum(map(len, texts))
+        logger.info(f"{scenario}, features {sorted(features)}: {len(messages)} messages, "
+                    f"{text_bytes / len(messages):.0f} text bytes/frame")
+        for level in args.deflate_levels:
+            for window_bits in args.window_bits:
+                result = measure(texts, lambda payload: deflate(payload, level, window_bits),
+                                 lambda data: inflate(data, window_bits), text_bytes)
+                log_result(f"deflate level {level} w{window_bits}", result)
+        if zstandard is None:
+            continue
+        binaries = [message_to_binary(message) for message in messages]
+        log_result("binary", {'ratio': sum(map(len, binaries)) / text_bytes, 'compress_us_per_frame': 0,
+                              'decompress_us_per_frame': 0})
+        for level in args.zstd_levels:
+            for dictionary_data in (None, dictionary):
+                dictionary_data = None if dictionary_data is None else zstandard.ZstdCompressionDict(dictionary_data)
+                compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary_data)
+                decompressor = zstandard.ZstdDecompressor(dict_data=dictionary_data)
+                result = measure(binaries, compressor.compress, decompressor.decompress, text_bytes)
+                log_result(f"zstd level {level}{' dictionary' if dictionary_data is not None else ''}", result)
+
+
+if __name__ == "__main__":
+    main()
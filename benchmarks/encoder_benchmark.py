@@ -0,0 +1,174 @@
+"""
+Deterministic encoder benchmark over flappy.nes gameplay.
+Every scenario replays a fixed input sequence from a reset emulator, so the frames, and with them the message sizes,
+are the same on every run. Each scenario is encoded with the native encoder, with and without rectangles,
+and the messages are decoded with the vectorized Python decoder.
+
+Reports per scenario and mode: encode us/frame, bytes/frame, runs/row and decode us/frame.
+Results are saved as JSON and compared against a stored baseline. Sizes must not grow at all,
+times must stay within --time-tolerance of the baseline. Exits with code 1 on a regression.
+
+Run from the repository root:
+python -m benchmarks.encoder_benchmark
+python -m benchmarks.encoder_benchmark --update-baseline
+"""
+import argparse
+import sys
+from libs.Helpers.GeneralHelpers import *
+from libs.CtypesLibs.CPPFrameToString import FrameToString
+from libs.DisplayStrategies.DisplayStrategy import update_canvas
+from libs.DisplayStrategies.FrameDecoder import parse_message
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROM_PATH = os.path.join(os.path.dirname(BENCHMARKS_DIRECTORY), 'roms', 'flappy.nes')
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARKS_DIRECTORY, 'baselines', 'encoder_benchmark.json')
+DEFAULT_OUTPUT_PATH = os.path.join(BENCHMARKS_DIRECTORY, 'results', 'encoder_benchmark.json')
+
+BUTTON_A = 1
+BUTTON_START = 8
+
+# name -> (frame count, action for frame i)
+SCENARIOS = {
+    # The title screen without input. Nearly every frame is unchanged.
+    'static': (300, lambda i: 0),
+    # Start, then flap steadily, so pipes scroll across the screen.
+    'scrolling': (600, lambda i: BUTTON_START if i == 0 else (BUTTON_A if i % 20 == 0 else 0)),
+    # Start without ever flapping, so the bird keeps crashing. Crashes flash the whole screen and reset the game.
+    'flashes': (600, lambda i: BUTTON_START if i % 60 == 0 else 0),
+}
+MODES = {'plain': False, 'rectangles': True}
+
+# Deterministic metrics, which must not grow at all
+SIZE_METRICS = ('bytes_per_frame', 'runs_per_row')
+# Metrics that vary from run to run, and are compared with a tolerance
+TIME_METRICS = ('encode_us_per_frame', 'decode_us_per_frame')
+
+
+def render_scenario(frame_count: int, action) -> list:
+    from nes_py import NESEnv
+    emulator = NESEnv(ROM_PATH)
+    emulator.reset()
+    frames = []
+    for i in range(frame_count):
+        state, _, done, _ = emulator.step(action=action(i))
+        frames.append(state.astype('uint8'))
+        if done:
+            emulator.reset()
+    emulator.close()
+    return frames
+
+
+def encode_frames(frame_to_string: FrameToString, frames: list) -> list:
+    """Encodes the frames as a keyframe followed by deltas, like a client that stays connected receives them."""
+    messages = []
+    previous_frame = None
+    for frame in frames:
+        messages.append(frame_to_string.get_string(frame, previous_frame))
+        previous_frame = frame
+    return messages
+
+
+def measure(frames: list, rectangles: bool, repeats: int) -> dict:
+    frame_to_string = FrameToString(rectangles=rectangles)
+    messages = encode_frames(frame_to_string, frames)
+    # Best of several runs, which is the least disturbed by other processes
+    encode_seconds = min(timed(encode_frames, frame_to_string, frames) for _ in range(repeats))
+
+    canvas = np.zeros(frames[0].shape, dtype=np.uint8)
+    decode_seconds = timed(decode_messages, messages, canvas)
+    if not np.array_equal(canvas, frames[-1][..., ::-1]):
+        raise Exception("Decoded canvas doesn't match the last frame")
+
+    # Runs per row of the whole frame, since deltas only contain the rows that changed
+    total_runs = sum(len(parse_message(frame_to_string.get_string(frame, None), offset=OFFSET)) for frame in frames)
+    frame_count = len(frames)
+    return {
+        'encode_us_per_frame': encode_seconds / frame_count * 1e6,
+        'bytes_per_frame': sum(len(message.encode('utf-8')) for message in messages) / frame_count,
+        'runs_per_row': total_runs / (frame_count * frames[0].shape[0]),
+        'decode_us_per_frame': decode_seconds / frame_count * 1e6,
+    }
+
+
+def decode_messages(messages: list, canvas: np.ndarray):
+    for message in messages:
+        update_canvas(message=message, canvas=canvas, offset=OFFSET)
+
+
+def timed(function, *args) -> float:
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def run_suite(repeats: int = 5) -> dict:
+    """Returns scenario -> mode -> metric -> value."""
+    results = {}
+    for scenario, (frame_count, action) in SCENARIOS.items():
+        frames = render_scenario(frame_count, action)
+        results[scenario] = {mode: measure(frames, rectangles, repeats) for mode, rectangles in MODES.items()}
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, time_tolerance: float = None) -> list:
+    """
+    Returns a description of every metric that got worse than the baseline.
+    Times are only compared with a time_tolerance, e.g. 0.3 allows them to be 30% slower.
+    """
+    regressions = []
+    for scenario, modes in baseline.items():
+        for mode, baseline_metrics in modes.items():
+            metrics = results.get(scenario, {}).get(mode)
+            if metrics is None:
+                regressions.append(f"{scenario}/{mode}: missing from the results")
+                continue
+            for metric in SIZE_METRICS:
+                # Allow for the rounding of the stored values
+                if metrics[metric] > baseline_metrics[metric] * (1 + 1e-9):
+                    regressions.append(f"{scenario}/{mode}: {metric} grew from {baseline_metrics[metric]:.3f} "
+                                       f"to {metrics[metric]:.3f}")
+            if time_tolerance is None:
+                continue
+            for metric in TIME_METRICS:
+                if metrics[metric] > baseline_metrics[metric] * (1 + time_tolerance):
+                    regressions.append(f"{scenario}/{mode}: {metric} rose from {baseline_metrics[metric]:.1f} "
+                                       f"to {metrics[metric]:.1f}, more than {time_tolerance:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5, help='Encode every scenario this many times and keep the fastest')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_PATH)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.3)
+    args = parser.parse_args()
+
+    results = run_suite(args.repeats)
+    for scenario, modes in results.items():
+        for mode, metrics in modes.items():
+            logger.info(f"{scenario}/{mode}: encode {metrics['encode_us_per_frame']:.1f} us/frame, "
+                        f"{metrics['bytes_per_frame']:.1f} bytes/frame, {metrics['runs_per_row']:.2f} runs/row, "
+                        f"decode {metrics['decode_us_per_frame']:.1f} us/frame")
+    save_json_file(results, args.output)
+    logger.info(f"Saved results to {args.output}")
+
+    if args.update_baseline:
+        save_json_file(results, args.baseline)
+        logger.info(f"Saved results as the baseline {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        logger.info(f"No baseline at {args.baseline}, run with --update-baseline to store one")
+        return
+
+    regressions = find_regressions(results, load_json_file(args.baseline), args.time_tolerance)
+    for regression in regressions:
+        logger.error(regression)
+    if regressions:
+        sys.exit(1)
+    logger.info("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
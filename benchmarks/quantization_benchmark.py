@@ -0,0 +1,108 @@
+"""
+Measures what color quantization does to the encoded stream: runs per row, bytes per frame and encode time.
+Frames come from flappy.nes with a fixed input sequence, optionally scaled like NESGameServer.SCALE_PERCENTAGE,
+which blends neighbouring colors into many new ones.
+
+Run from the repository root:
+python -m benchmarks.quantization_benchmark --frames 600 --scale 75
+"""
+import argparse
+import cv2
+from libs.Helpers.GeneralHelpers import *
+from libs.Helpers.ColorQuantizer import ColorQuantizer
+from libs.CtypesLibs.CPPFrameToString import FrameToString
+from libs.DisplayStrategies.FrameDecoder import parse_message
+
+ROM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roms', 'flappy.nes')
+# Flap every 20 frames, and press start once a second to get past the title and game over screens
+FLAP_INTERVAL = 20
+START_INTERVAL = 60
+BUTTON_A = 1
+BUTTON_START = 8
+
+
+def render_frames(frame_count: int, scale_percentage: int) -> list:
+    from nes_py import NESEnv
+    emulator = NESEnv(ROM_PATH)
+    emulator.reset()
+    frames = []
+    for i in range(frame_count):
+        action = BUTTON_START if i % START_INTERVAL == 0 else (BUTTON_A if i % FLAP_INTERVAL == 0 else 0)
+        state, _, done, _ = emulator.step(action=action)
+        state = state.astype('uint8')
+        if scale_percentage < 100:
+            size = (DEFAULT_FRAME_WIDTH * scale_percentage // 100, DEFAULT_FRAME_HEIGHT * scale_percentage // 100)
+            state = cv2.resize(state, size, interpolation=cv2.INTER_LINEAR)
+        frames.append(state)
+        if done:
+            emulator.reset()
+    emulator.close()
+    return frames
+
+
+def most_common_colors(frames: list, count: int) -> np.ndarray:
+    pixels = np.concatenate([frame.reshape(-1, 3) for frame in frames])
+    colors, frequencies = np.unique(pixels, axis=0, return_counts=True)
+    return colors[np.argsort(frequencies)[::-1][:count]]
+
+
+def measure(frames: list, quantizer: ColorQuantizer) -> dict:
+    frame_to_string = FrameToString()
+    quantize_seconds = 0.0
+    encode_seconds = 0.0
+    total_bytes = 0
+    total_runs = 0
+    total_rows = 0
+    total_colors = 0
+    previous_frame = None
+    for frame in frames:
+        frame = frame.copy()
+        start_time = time.perf_counter()
+        if quantizer is not None:
+            quantizer.quantize(frame)
+        quantize_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        message = frame_to_string.get_string(frame, previous_frame)
+        encode_seconds += time.perf_counter() - start_time
+        previous_frame = frame
+
+        # Runs per row are counted on the whole frame, since deltas only contain the rows that changed
+        total_runs += len(parse_message(frame_to_string.get_string(frame, None), offset=OFFSET))
+        total_rows += frame.shape[0]
+        total_bytes += len(message.encode('utf-8'))
+        total_colors += len(np.unique(frame.reshape(-1, 3), axis=0))
+
+    frame_count = len(frames)
+    return {
+        'quantize_us_per_frame': quantize_seconds / frame_count * 1e6,
+        'encode_us_per_frame': encode_seconds / frame_count * 1e6,
+        'bytes_per_frame': total_bytes / frame_count,
+        'runs_per_row': total_runs / max(total_rows, 1),
+        'colors_per_frame': total_colors / frame_count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--scale', type=int, default=75, help='Scale percentage applied before quantizing')
+    parser.add_argument('--palette-size', type=int, default=16, help='Colors in the nearest palette setting')
+    args = parser.parse_args()
+
+    frames = render_frames(args.frames, args.scale)
+    settings = [('none', None)]
+    settings += [(f'{bits} bits', ColorQuantizer(bits=bits)) for bits in (6, 5, 4, 3)]
+    palette = most_common_colors(frames[::30], args.palette_size)
+    settings.append((f'{len(palette)} color palette', ColorQuantizer(palette=palette)))
+
+    logger.info(f"{len(frames)} frames at {args.scale}% scale")
+    for name, quantizer in settings:
+        result = measure(frames, quantizer)
+        logger.info(f"{name}: {result['colors_per_frame']:.0f} colors/frame, {result['runs_per_row']:.2f} runs/row, "
+                    f"{result['bytes_per_frame']:.0f} bytes/frame, encode {result['encode_us_per_frame']:.0f} us/frame, "
+                    f"quantize {result['quantize_us_per_frame']:.0f} us/frame")
+
+
+if __name__ == "__main__":
+    main()
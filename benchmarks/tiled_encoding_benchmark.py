@@ -0,0 +1,77 @@
+"""
+Measures how encode time scales with the number of native encoder threads, which encode a frame in horizontal bands.
+Frames are flappy.nes gameplay at --scale percent, where nearest-neighbour upscaling keeps the colors,
+plus busy frames of random pixels from a few colors, which are the worst case for a single thread.
+Every thread count has to produce the same messages as one thread.
+
+Run from the repository root:
+python -m benchmarks.tiled_encoding_benchmark --threads 1 2 4 8 --scale 100 200
+"""
+import argparse
+import cv2
+from libs.Helpers.GeneralHelpers import *
+from libs.CtypesLibs.CPPFrameToString import FrameToString
+from benchmarks.encoder_benchmark import SCENARIOS, render_scenario
+
+BUSY_FRAME_COUNT = 60
+BUSY_COLOR_COUNT = 4
+
+
+def scale_frames(frames: list, scale_percentage: int) -> list:
+    if scale_percentage == 100:
+        return frames
+    size = (DEFAULT_FRAME_WIDTH * scale_percentage // 100, DEFAULT_FRAME_HEIGHT * scale_percentage // 100)
+    return [cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST) for frame in frames]
+
+
+def busy_frames(frame_count: int, shape: tuple) -> list:
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (BUSY_COLOR_COUNT, 3), dtype=np.uint8)
+    return [colors[rng.integers(0, BUSY_COLOR_COUNT, shape[:2])] for _ in range(frame_count)]
+
+
+def encode_all(frames: list, frame_to_string: FrameToString, repeats: int):
+    """Returns the fastest encode time per frame in microseconds over the repeats, and the messages."""
+    best_seconds = None
+    messages = []
+    for _ in range(repeats):
+        messages = []
+        start_time = time.perf_counter()
+        previous_frame = None
+        for frame in frames:
+            messages.append(frame_to_string.get_bytes(frame, previous_frame))
+            previous_frame = frame
+        seconds = time.perf_counter() - start_time
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+    return best_seconds / len(frames) * 1e6, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--scale', type=int, nargs='+', default=[100, 200], help='Scale percentages of the frames')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--rectangles', action='store_true')
+    args = parser.parse_args()
+
+    gameplay = render_scenario(*SCENARIOS['scrolling'])
+    logger.info(f"{os.cpu_count()} CPUs, rectangles {args.rectangles}")
+    for scale_percentage in args.scale:
+        scaled = scale_frames(gameplay, scale_percentage)
+        for name, frames in (('gameplay', scaled), ('busy', busy_frames(BUSY_FRAME_COUNT, scaled[0].shape))):
+            single_thread_us = None
+            expected_messages = None
+            for thread_count in args.threads:
+                frame_to_string = FrameToString(rectangles=args.rectangles, thread_count=thread_count)
+                encode_us, messages = encode_all(frames, frame_to_string, args.repeats)
+                frame_to_string.close()
+                if expected_messages is None:
+                    single_thread_us, expected_messages = encode_us, messages
+                elif messages != expected_messages:
+                    raise Exception(f"{thread_count} threads produced different messages for {name} at {scale_percentage}%")
+                logger.info(f"{name} {frames[0].shape[1]}x{frames[0].shape[0]}, {thread_count} threads: "
+                            f"{encode_us:.0f} us/frame, speedup {single_thread_us / encode_us:.2f}")
+
+
+if __name__ == "__main__":
+    main()
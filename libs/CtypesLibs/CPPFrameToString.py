@@ -20,7 +20,18 @@ class BoolArray(ctypes.Structure):
 
 
 class FrameToString:
-    def __init__(self):
+    """
+    Wraps a native encoder context, which owns all of the encoder's scratch state.
+    The native calls release the GIL, so separate instances can encode on separate threads at once.
+    A single instance must only be used by one thread at a time, since it also reuses its output buffer.
+    """
+
+    def __init__(self, rectangles: bool = False, thread_count: int = 1):
+        """
+        With rectangles set, vertical runs of a color are encoded as rectangles spanning several rows.
+        With a thread_count above 1, frames are split into horizontal bands that are encoded on that many native threads,
+        counting the calling one. The output is the same for any thread_count.
+        """
         # Get the path of the Python file
         python_file_path = os.path.abspath(__file__)
 
@@ -41,29 +52,104 @@ class FrameToString:
         # Load the shared library
         self.mylib = ctypes.CDLL((shared_library_path), winmode=0)
 
-        self.frame_to_string = self.mylib.frame_to_string
-        self.frame_to_string.argtypes = [ctypes.POINTER(Array3D), ctypes.POINTER(Array3D), ctypes.c_char_p]
-        self.frame_to_string.restype = None
-
-    def get_string(self, current_state: np.ndarray, last_state: np.ndarray) -> str:
-        # Convert the ndarrays to C-compatible structures
-        current_array = Array3D((current_state.shape[0], current_state.shape[1], current_state.shape[2]),
-                                current_state.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte)))
-
-        # Create an empty char array for the output - 61440 pixels * (9 characters for length of rule) * (up to 4 bytes per character)
-        output = ctypes.create_string_buffer(61440 * 9 * 4 * 2)
-
+        self.rectangles = rectangles
+        self.encoder_create = self.mylib.encoder_create
+        self.encoder_create.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.encoder_create.restype = ctypes.c_void_p
+
+        self.encoder_encode = self.mylib.encoder_encode
+        self.encoder_encode.argtypes = [ctypes.c_void_p, ctypes.POINTER(Array3D), ctypes.POINTER(Array3D), ctypes.c_char_p, ctypes.c_int]
+        self.encoder_encode.restype = ctypes.c_int
+
+        self.encoder_reset = self.mylib.encoder_reset
+        self.encoder_reset.argtypes = [ctypes.c_void_p]
+        self.encoder_reset.restype = None
+
+        self.encoder_destroy = self.mylib.encoder_destroy
+        self.encoder_destroy.argtypes = [ctypes.c_void_p]
+        self.encoder_destroy.restype = None
+
+        self.frame_to_string_max_size = self.mylib.frame_to_string_max_size
+        self.frame_to_string_max_size.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.frame_to_string_max_size.restype = ctypes.c_int
+
+        self.detect_shift = self.mylib.detect_shift
+        self.detect_shift.argtypes = [ctypes.POINTER(Array3D), ctypes.POINTER(Array3D), ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+        self.detect_shift.restype = ctypes.c_int
+
+        # Reused by every call. The output buffer only grows when a larger frame comes in.
+        self.current_array = Array3D()
+        self.last_array = Array3D()
+        self.output = None
+        self.output_view = None
+        self.output_size = 0
+        self.shift = (ctypes.c_int * 4)()
+
+        self.thread_count = thread_count
+        self.context = self.encoder_create(int(rectangles), thread_count)
+
+    def reset(self):
+        """Frees the scratch storage of the encoder, which is otherwise kept for the largest frame encoded so far."""
+        self.encoder_reset(self.context)
+
+    def close(self):
+        if self.context is not None:
+            self.encoder_destroy(self.context)
+            self.context = None
+
+    def __del__(self):
+        # __init__ may have failed before the context was created
+        if getattr(self, 'context', None) is not None:
+            self.close()
+
+    def _ensure_output_size(self, rows: int, columns: int):
+        required_size = self.frame_to_string_max_size(rows, columns)
+        if required_size > self.output_size:
+            self.output = ctypes.create_string_buffer(required_size)
+            self.output_view = memoryview(self.output).cast('B')
+            self.output_size = required_size
+
+    @staticmethod
+    def _set_array(array: Array3D, state: np.ndarray):
+        array.shape[0], array.shape[1], array.shape[2] = state.shape
+        array.data = state.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+
+    def encode(self, current_state: np.ndarray, last_state: np.ndarray) -> int:
+        """Encodes into the output buffer and returns the encoded length in bytes."""
+        self._ensure_output_size(current_state.shape[0], current_state.shape[1])
+        self._set_array(self.current_array, current_state)
+
+        if self.context is None:
+            raise Exception("Encoder was closed")
         if last_state is None:
-            self.frame_to_string(ctypes.byref(current_array), None, output)
+            length = self.encoder_encode(self.context, ctypes.byref(self.current_array), None, self.output, self.output_size)
         else:
-            last_array = Array3D((last_state.shape[0], last_state.shape[1], last_state.shape[2]),
-                                 last_state.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte)))
-            self.frame_to_string(ctypes.byref(current_array), ctypes.byref(last_array), output)
-
-        # Convert the returned value to a Python string
-        string_result = output.value.decode()
+            self._set_array(self.last_array, last_state)
+            length = self.encoder_encode(self.context, ctypes.byref(self.current_array), ctypes.byref(self.last_array),
+                                         self.output, self.output_size)
+
+        if length < 0:
+            raise Exception(f"Output buffer of {self.output_size} bytes is too small for frame of shape {current_state.shape}")
+        return length
+
+    def get_shift(self, current_state: np.ndarray, last_state: np.ndarray, max_shift: int):
+        """Returns (first row, row count, dx, dy) of a band of rows that scrolled between the frames, or None."""
+        self._set_array(self.current_array, current_state)
+        self._set_array(self.last_array, last_state)
+        if not self.detect_shift(ctypes.byref(self.current_array), ctypes.byref(self.last_array), max_shift, self.shift):
+            return None
+        return tuple(self.shift)
+
+    def get_view(self, current_state: np.ndarray, last_state: np.ndarray) -> memoryview:
+        """Returns the UTF-8 encoded message without copying it. The view is only valid until the next call."""
+        length = self.encode(current_state, last_state)
+        return self.output_view[:length]
+
+    def get_bytes(self, current_state: np.ndarray, last_state: np.ndarray) -> bytes:
+        return self.get_view(current_state, last_state).tobytes()
 
-        return string_result
+    def get_string(self, current_state: np.ndarray, last_state: np.ndarray) -> str:
+        return str(self.get_view(current_state, last_state), 'utf-8')
 
 
 # Usage example:
@@ -1,22 +1,15 @@
 #include <string>
 #include <vector>
 #include <cstring>
-#include <sstream>
 #include <iostream>
-#include <unordered_map>
-#include <unordered_set>
-
-struct pair_hash
-{
-    template <class T1, class T2>
-    std::size_t operator()(const std::pair<T1, T2> &p) const
-    {
-        auto h1 = std::hash<T1>{}(p.first);
-        auto h2 = std::hash<T2>{}(p.second);
-
-        return h1 ^ h2;
-    }
-};
+#include <cstdint>
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
 
 extern "C"
 {
@@ -33,308 +26,912 @@ extern "C"
         bool *data;
     } BoolArray;
 
-    std::unordered_map<int, std::string> rgb_to_utf8_cache;
     const int OFFSET = 16;
     const int SURROGATE_RANGE_SIZE = 2048;
+    // Values below this are encoded with a lookup into utf8_table.
+    // This covers r * 1000 + g, and row * 1000 + span or column * 1000 + span for up to 256 rows or columns.
+    const int UTF8_TABLE_SIZE = 257 * 1000;
 
-    std::string encode_utf8(int unicode_codepoint)
+    struct Utf8Code
     {
-        std::string utf8_char;
+        unsigned char length;
+        unsigned char bytes[4];
+    };
 
-        if (unicode_codepoint == 0)
+    // Writes the UTF-8 encoding of a value at cursor and returns the cursor past it.
+    char *encode_utf8(char *cursor, int unicode_codepoint)
+    {
+        // Add the offset to the unicode_codepoint. This offset is used to avoid the reserved values at the beginning.
+        // A value of 0 would otherwise be null, and the offset also accounts for special characters like delimiters.
+        unicode_codepoint += OFFSET;
+
+        // Handling surrogates that are not legal unicode_codepoint values.
+        // If the unicode_codepoint is the lowest part of the surrogate range or higher, we add the size of the surrogate range to it.
+        // This will make it fall outside of the surrogate range.
+        // The decoding code must subtract the offset and add the surrogate range size back.
+        if (unicode_codepoint >= 0xD800)
+            unicode_codepoint += SURROGATE_RANGE_SIZE;
+
+        // Encoding the unicode to UTF-8 following the standard rules.
+        if (unicode_codepoint < 0x80)
+        {
+            // For unicode values less than 0x80, UTF-8 encoding is the same as the unicode value and is done with one byte.
+            *cursor++ = unicode_codepoint;
+        }
+        else if (unicode_codepoint < 0x800)
         {
-            // Be careful of this hitting when there is no offset.
-            // The codepoint would be 0, which is reserved for null and will cause problems.
-            // The offset should also account for special character like delimiters.
-            utf8_char.push_back(unicode_codepoint + OFFSET);
+            // For unicode values less than 0x800, the UTF-8 encoding is done with two bytes.
+            // The first byte starts with '110' followed by the 5 most significant bits of the unicode value.
+            // The second byte starts with '10' followed by the 6 least significant bits of the unicode value.
+            *cursor++ = 0xC0 | (unicode_codepoint >> 6);
+            *cursor++ = 0x80 | (unicode_codepoint & 0x3F);
+        }
+        else if (unicode_codepoint < 0x10000)
+        {
+            // For unicode values less than 0x10000, the UTF-8 encoding is done with three bytes.
+            // The first byte starts with '1110' followed by the 4 most significant bits of the unicode value.
+            // The remaining bytes start with '10' followed by the 6 next most significant bits of the unicode value.
+            *cursor++ = 0xE0 | (unicode_codepoint >> 12);
+            *cursor++ = 0x80 | ((unicode_codepoint >> 6) & 0x3F);
+            *cursor++ = 0x80 | (unicode_codepoint & 0x3F);
         }
         else
         {
-            // Add the offset to the unicode_codepoint. This offset is used to avoid the reserved values at the beginning.
-            unicode_codepoint += OFFSET;
+            // For unicode values greater than or equal to 0x10000, the UTF-8 encoding is done with four bytes.
+            // The first byte starts with '11110' followed by the 3 most significant bits of the unicode value.
+            // The remaining bytes start with '10' followed by the 6 next most significant bits of the unicode value.
+            *cursor++ = 0xF0 | (unicode_codepoint >> 18);
+            *cursor++ = 0x80 | ((unicode_codepoint >> 12) & 0x3F);
+            *cursor++ = 0x80 | ((unicode_codepoint >> 6) & 0x3F);
+            *cursor++ = 0x80 | (unicode_codepoint & 0x3F);
+        }
+        return cursor;
+    }
+
+    std::vector<Utf8Code> build_utf8_table()
+    {
+        std::vector<Utf8Code> table(UTF8_TABLE_SIZE);
+        for (int value = 0; value < UTF8_TABLE_SIZE; ++value)
+        {
+            char *end = encode_utf8(reinterpret_cast<char *>(table[value].bytes), value);
+            table[value].length = end - reinterpret_cast<char *>(table[value].bytes);
+        }
+        return table;
+    }
 
-            // Handling surrogates that are not legal unicode_codepoint values.
-            // If the unicode_codepoint is the lowest part of the surrogate range or higher, we add the size of the surrogate range to it.
-            // This will make it fall outside of the surrogate range.
-            // The decoding code must subtract the offset and add the surrogate range size back.
-            if (unicode_codepoint >= 0xD800)
-                unicode_codepoint += SURROGATE_RANGE_SIZE;
+    const std::vector<Utf8Code> &utf8_table()
+    {
+        // Built once, on first use
+        static const std::vector<Utf8Code> table = build_utf8_table();
+        return table;
+    }
 
-            // Encoding the unicode to UTF-8 following the standard rules.
-            if (unicode_codepoint < 0x80)
+    inline char *write_utf8(char *cursor, const Utf8Code *table, int value)
+    {
+        if (value >= UTF8_TABLE_SIZE)
+        {
+            return encode_utf8(cursor, value);
+        }
+        const Utf8Code &code = table[value];
+        std::memcpy(cursor, code.bytes, code.length);
+        return cursor + code.length;
+    }
+
+    // Groups the runs of one row by color, for rows of up to `capacity` columns.
+    // Colors keep the order they first appear in, and each color's runs stay in column order, so output is deterministic.
+    // Storage is allocated once per row width and reused for every row.
+    struct RowColorGroups
+    {
+        int capacity = 0;
+        int color_count = 0;
+        int run_count = 0;
+        int current_color = -1;
+
+        // Per color
+        std::vector<uint32_t> color_keys;
+        std::vector<int> color_first_run;
+        std::vector<int> color_last_run;
+
+        // Per run
+        std::vector<int> run_starts;
+        std::vector<int> run_spans;
+        std::vector<int> run_next;
+
+        // Open addressing table from color key to color index. Slots from earlier rows are told apart by generation.
+        std::vector<uint32_t> slot_keys;
+        std::vector<int> slot_colors;
+        std::vector<uint32_t> slot_generations;
+        uint32_t generation = 0;
+        uint32_t slot_mask = 0;
+
+        void reserve(int columns)
+        {
+            if (columns <= capacity)
             {
-                // For unicode values less than 0x80, UTF-8 encoding is the same as the unicode value and is done with one byte.
-                utf8_char.push_back(unicode_codepoint);
+                return;
             }
-            else if (unicode_codepoint < 0x800)
+            capacity = columns;
+            color_keys.resize(columns);
+            color_first_run.resize(columns);
+            color_last_run.resize(columns);
+            run_starts.resize(columns);
+            run_spans.resize(columns);
+            run_next.resize(columns);
+
+            // At least twice as many slots as colors, so probe sequences stay short
+            uint32_t slot_count = 16;
+            while (slot_count < 2 * static_cast<uint32_t>(columns))
             {
-                // For unicode values less than 0x800, the UTF-8 encoding is done with two bytes.
-                // The first byte starts with '110' followed by the 5 most significant bits of the unicode value.
-                // The second byte starts with '10' followed by the 6 least significant bits of the unicode value.
-                utf8_char.push_back(0xC0 | (unicode_codepoint >> 6));
-                utf8_char.push_back(0x80 | (unicode_codepoint & 0x3F));
+                slot_count <<= 1;
             }
-            else if (unicode_codepoint < 0x10000)
+            slot_keys.assign(slot_count, 0);
+            slot_colors.assign(slot_count, 0);
+            slot_generations.assign(slot_count, 0);
+            slot_mask = slot_count - 1;
+            generation = 0;
+        }
+
+        bool empty() const
+        {
+            return run_count == 0;
+        }
+
+        void clear()
+        {
+            color_count = 0;
+            run_count = 0;
+            current_color = -1;
+            if (++generation == 0)
             {
-                // For unicode values less than 0x10000, the UTF-8 encoding is done with three bytes.
-                // The first byte starts with '1110' followed by the 4 most significant bits of the unicode value.
-                // The remaining bytes start with '10' followed by the 6 next most significant bits of the unicode value.
-                utf8_char.push_back(0xE0 | (unicode_codepoint >> 12));
-                utf8_char.push_back(0x80 | ((unicode_codepoint >> 6) & 0x3F));
-                utf8_char.push_back(0x80 | (unicode_codepoint & 0x3F));
+                // Wrapped around, so stale slots could look current
+                std::fill(slot_generations.begin(), slot_generations.end(), 0);
+                generation = 1;
+            }
+        }
+
+        int find_or_add_color(uint32_t key)
+        {
+            uint32_t slot = (key * 2654435761u) >> 16 & slot_mask;
+            while (slot_generations[slot] == generation)
+            {
+                if (slot_keys[slot] == key)
+                {
+                    return slot_colors[slot];
+                }
+                slot = (slot + 1) & slot_mask;
+            }
+            slot_generations[slot] = generation;
+            slot_keys[slot] = key;
+            slot_colors[slot] = color_count;
+            color_keys[color_count] = key;
+            color_first_run[color_count] = -1;
+            return color_count++;
+        }
+
+        // Starts a new run of the pixel's color
+        void add_run(uint32_t key, int column)
+        {
+            int color = find_or_add_color(key);
+            int run = run_count++;
+            run_starts[run] = column;
+            run_spans[run] = 1;
+            run_next[run] = -1;
+            if (color_first_run[color] == -1)
+            {
+                color_first_run[color] = run;
             }
             else
             {
-                // For unicode values greater than or equal to 0x10000, the UTF-8 encoding is done with four bytes.
-                // The first byte starts with '11110' followed by the 3 most significant bits of the unicode value.
-                // The remaining bytes start with '10' followed by the 6 next most significant bits of the unicode value.
-                utf8_char.push_back(0xF0 | (unicode_codepoint >> 18));
-                utf8_char.push_back(0x80 | ((unicode_codepoint >> 12) & 0x3F));
-                utf8_char.push_back(0x80 | ((unicode_codepoint >> 6) & 0x3F));
-                utf8_char.push_back(0x80 | (unicode_codepoint & 0x3F));
+                run_next[color_last_run[color]] = run;
             }
+            color_last_run[color] = run;
+            current_color = color;
         }
-        return utf8_char;
-    }
 
-    std::pair<int, int> get_pixel_color_codes(unsigned char *pixel_data)
-    {
-        int r = pixel_data[0];
-        int g = pixel_data[1];
-        int b = pixel_data[2];
+        // Extends the run that was started last
+        void extend_run()
+        {
+            run_spans[run_count - 1]++;
+        }
 
-        // Combine R and G values into one integer and B into another
-        int rg = r * 1000 + g; // Assuming r and g are each < 1000
-        int b_val = b;
+        bool continues_run(uint32_t key) const
+        {
+            return current_color != -1 && color_keys[current_color] == key;
+        }
 
-        return std::make_pair(rg, b_val);
-    }
+        void end_run()
+        {
+            current_color = -1;
+        }
+
+        char *write(char *cursor, const Utf8Code *table) const
+        {
+            for (int color = 0; color < color_count; ++color)
+            {
+                uint32_t key = color_keys[color];
+                // Combine R and G values into one integer and B into another
+                cursor = write_utf8(cursor, table, (key >> 16) * 1000 + ((key >> 8) & 0xFF));
+                cursor = write_utf8(cursor, table, key & 0xFF);
+                for (int run = color_first_run[color]; run != -1; run = run_next[run])
+                {
+                    cursor = write_utf8(cursor, table, run_starts[run] * 1000 + run_spans[run]);
+                }
+                *cursor++ = '\x01';
+            }
+            return cursor;
+        }
+    };
 
-    void find_identical_rows(Array3D *current_frame, std::unordered_map<int, int> *identical_rows)
+    inline uint32_t get_pixel_color_key(const unsigned char *pixel_data)
     {
-        // Calculate the size of a row in bytes
-        int row_size_bytes = current_frame->shape[1] * current_frame->shape[2];
-        std::vector<unsigned char> row_data(row_size_bytes);
-        std::vector<unsigned char> prev_row_data(row_size_bytes);
+        return (static_cast<uint32_t>(pixel_data[0]) << 16) | (static_cast<uint32_t>(pixel_data[1]) << 8) | pixel_data[2];
+    }
 
-        int identical_row_start = -1;
-        int identical_row_count = 0;
+    inline bool rows_equal(const unsigned char *row, const unsigned char *other_row, int row_size_bytes)
+    {
+        // memcmp compares a word at a time
+        return std::memcmp(row, other_row, row_size_bytes) == 0;
+    }
 
-        for (int row_idx = 1; row_idx < current_frame->shape[0]; ++row_idx)
+    // Marks the columns whose pixels differ between the two rows in changed_columns,
+    // and widens the dirty span [first_changed_column, last_changed_column] to include them.
+    void mark_changed_columns(const unsigned char *current_row, const unsigned char *previous_row, int columns, int channels,
+                              unsigned char *changed_columns, int *first_changed_column, int *last_changed_column)
+    {
+        int row_size_bytes = columns * channels;
+        int byte_idx = 0;
+        // Compare 8 bytes at a time, and only look at single bytes within words that differ
+        for (; byte_idx + 8 <= row_size_bytes; byte_idx += 8)
         {
-            std::copy(current_frame->data + row_idx * row_size_bytes,
-                      current_frame->data + (row_idx + 1) * row_size_bytes,
-                      row_data.begin());
-
-            std::copy(current_frame->data + (row_idx - 1) * row_size_bytes,
-                      current_frame->data + row_idx * row_size_bytes,
-                      prev_row_data.begin());
-
-            if (row_data == prev_row_data)
+            uint64_t current_word, previous_word;
+            std::memcpy(&current_word, current_row + byte_idx, 8);
+            std::memcpy(&previous_word, previous_row + byte_idx, 8);
+            if (current_word == previous_word)
             {
-                // The row is identical to the previous one
-                if (identical_row_start == -1)
-                {
-                    identical_row_start = row_idx - 1;
-                }
-                identical_row_count++;
+                continue;
             }
-            else
+            for (int k = byte_idx; k < byte_idx + 8; ++k)
             {
-                // The row is not identical to the previous one
-                if (identical_row_start != -1)
+                if (current_row[k] != previous_row[k])
                 {
-                    // We have just left a range of identical rows
-                    (*identical_rows)[identical_row_start] = identical_row_count;
-
-                    identical_row_start = -1;
-                    identical_row_count = 0;
+                    changed_columns[k / channels] = 1;
                 }
             }
+            *first_changed_column = std::min(*first_changed_column, byte_idx / channels);
+            *last_changed_column = std::max(*last_changed_column, (byte_idx + 7) / channels);
         }
-
-        if (identical_row_start != -1)
+        for (; byte_idx < row_size_bytes; ++byte_idx)
         {
-            // Last row(s) were part of a range of identical rows
-            (*identical_rows)[identical_row_start] = identical_row_count;
+            if (current_row[byte_idx] != previous_row[byte_idx])
+            {
+                changed_columns[byte_idx / channels] = 1;
+                *first_changed_column = std::min(*first_changed_column, byte_idx / channels);
+                *last_changed_column = std::max(*last_changed_column, byte_idx / channels);
+            }
         }
     }
 
-    void frame_to_string(Array3D *current_frame, Array3D *previous_frame, char *output)
-    {
-        // Find ranges of identical rows
-        std::unordered_map<int, int> identical_rows;
-        find_identical_rows(current_frame, &identical_rows);
-
-        static Array3D *cached_previous_frame = nullptr;
-        static std::string cached_output;
+    // Rectangles spanning fewer rows than this are left to the row encoding, where a run in a row costs a single character.
+    const int MIN_RECTANGLE_ROWS = 4;
 
-        // Keep track of the rows where color_changed_at_current_pixel was true
-        static bool use_color_changed_rows = false;
-        static std::unordered_set<int> color_changed_rows;
-        std::unordered_set<int> new_color_changed_rows;
+    // Upper bound of the encoded size of a frame in bytes, including the NUL terminator.
+    // Worst case, every pixel is its own run of a new color: color (4 + 2 bytes), range (4 bytes) and delimiter A.
+    // Every row adds a row character (4 bytes) and delimiter B.
+    // A rectangle takes 16 bytes and covers at least MIN_RECTANGLE_ROWS pixels, so it never costs more than its pixels would.
+    int frame_to_string_max_size(int rows, int columns)
+    {
+        return rows * (columns * 11 + 5) + 1;
+    }
 
-        if (previous_frame != nullptr && previous_frame == cached_previous_frame)
+    // Builds the runs of a group of identical rows from the columns marked in changed_columns within
+    // [first_changed_column, last_changed_column], clears those marks, and writes the group.
+    char *write_row_group(char *cursor, const Utf8Code *table, RowColorGroups &row_colors,
+                          const unsigned char *current_row, int row_idx, int row_span, int channels,
+                          unsigned char *changed_columns, int first_changed_column, int last_changed_column)
+    {
+        row_colors.clear();
+        const unsigned char *current_pixel = current_row + first_changed_column * channels;
+        for (int col_idx = first_changed_column; col_idx <= last_changed_column; ++col_idx, current_pixel += channels)
         {
-            std::strncpy(output, cached_output.c_str(), cached_output.size());
-            output[cached_output.size()] = '\0';
-            return;
-        }
-
-        std::ostringstream ss;
-
-        int total_pixels = current_frame->shape[0] * current_frame->shape[1];
-        unsigned char *current_pixel = current_frame->data;
-        unsigned char *previous_pixel = previous_frame ? previous_frame->data : nullptr;
-        bool changes_made_for_previous_row = false;
+            if (!changed_columns[col_idx])
+            {
+                row_colors.end_run();
+                continue;
+            }
+            changed_columns[col_idx] = 0;
 
-        std::unordered_map<std::pair<int, int>, std::vector<std::pair<int, int>>, pair_hash> color_ranges_map;
-        std::pair<int, int> range_current_color = {-1, -1};
+            uint32_t color_key = get_pixel_color_key(current_pixel);
+            if (row_colors.continues_run(color_key))
+            {
+                row_colors.extend_run();
+            }
+            else
+            {
+                row_colors.add_run(color_key, col_idx);
+            }
+        }
 
-        bool first_row = true;
-        bool range_is_ongoing = false;
+        cursor = write_utf8(cursor, table, row_idx * 1000 + row_span);
+        cursor = row_colors.write(cursor, table);
+        *cursor++ = '\x02';
+        return cursor;
+    }
 
-        int skip_to_row_index = -1;
+    // Greedily covers the changed pixels in changed_pixels with single colored rectangles, in raster order.
+    // A rectangle is grown to the right first, then down for as long as the rows below match it.
+    // Rectangles of at least MIN_RECTANGLE_ROWS rows are written as a row group with one color and one range,
+    // which every decoder already paints across all rows of the group, and their pixels are cleared from changed_pixels.
+    char *write_rectangles(char *cursor, const Utf8Code *table, Array3D *current_frame,
+                           unsigned char *changed_pixels, const int *first_changed_columns, const int *last_changed_columns)
+    {
+        int rows = current_frame->shape[0];
+        int columns = current_frame->shape[1];
+        int channels = current_frame->shape[2];
+        int row_size_bytes = columns * channels;
 
-        for (int i = 0; i < total_pixels; ++i, current_pixel += current_frame->shape[2])
+        for (int row_idx = 0; row_idx + MIN_RECTANGLE_ROWS <= rows; ++row_idx)
         {
-            bool color_changed_at_current_pixel = false;
-            if (previous_frame)
+            unsigned char *changed_row = changed_pixels + row_idx * columns;
+            const unsigned char *current_row = current_frame->data + row_idx * row_size_bytes;
+            int col_idx = first_changed_columns[row_idx];
+            while (col_idx <= last_changed_columns[row_idx])
             {
-                for (int j = 0; j < current_frame->shape[2]; j++)
+                if (!changed_row[col_idx])
+                {
+                    col_idx++;
+                    continue;
+                }
+
+                const unsigned char *pixel = current_row + col_idx * channels;
+                int width = 1;
+                while (col_idx + width <= last_changed_columns[row_idx] && changed_row[col_idx + width] &&
+                       std::memcmp(pixel, pixel + width * channels, channels) == 0)
                 {
-                    if (current_pixel[j] != previous_pixel[j])
+                    width++;
+                }
+
+                int height = 1;
+                while (row_idx + height < rows && height < 999)
+                {
+                    const unsigned char *changed_below = changed_row + height * columns;
+                    if (std::memchr(changed_below + col_idx, 0, width) != nullptr)
                     {
-                        color_changed_at_current_pixel = true;
                         break;
                     }
+                    // The pixels below have to be the same color too, and the pixels in this row are all that color.
+                    if (std::memcmp(pixel + height * row_size_bytes, current_row + col_idx * channels, width * channels) != 0)
+                    {
+                        break;
+                    }
+                    height++;
                 }
-                previous_pixel += previous_frame->shape[2];
+
+                if (height >= MIN_RECTANGLE_ROWS)
+                {
+                    for (int covered_row_idx = 0; covered_row_idx < height; ++covered_row_idx)
+                    {
+                        std::memset(changed_row + covered_row_idx * columns + col_idx, 0, width);
+                    }
+                    uint32_t color_key = get_pixel_color_key(pixel);
+                    cursor = write_utf8(cursor, table, row_idx * 1000 + height);
+                    cursor = write_utf8(cursor, table, (color_key >> 16) * 1000 + ((color_key >> 8) & 0xFF));
+                    cursor = write_utf8(cursor, table, color_key & 0xFF);
+                    cursor = write_utf8(cursor, table, col_idx * 1000 + width);
+                    *cursor++ = '\x01';
+                    *cursor++ = '\x02';
+                }
+                col_idx += width;
             }
-            else
+        }
+        return cursor;
+    }
+
+    // A fixed set of threads that run the calls of a task in parallel, together with the thread that hands them the task.
+    // The threads sleep between tasks.
+    class WorkerPool
+    {
+    public:
+        explicit WorkerPool(int thread_count)
+        {
+            // The calling thread does its share of the work too
+            for (int i = 1; i < thread_count; ++i)
             {
-                // previous_frame is nullptr, meaning a full frame update was sent, so we consider all pixels changed
-                color_changed_at_current_pixel = true;
+                threads.emplace_back(&WorkerPool::work, this);
+            }
+        }
+
+        ~WorkerPool()
+        {
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                stopping = true;
+            }
+            start_condition.notify_all();
+            for (std::thread &thread : threads)
+            {
+                thread.join();
             }
+        }
 
-            int row_idx = i / current_frame->shape[1]; // Row index
-            int col_idx = i % current_frame->shape[1]; // Column index
+        int thread_count() const
+        {
+            return static_cast<int>(threads.size()) + 1;
+        }
 
-            // If color_changed_at_current_pixel is true for this pixel, add its row to the new set
-            if (color_changed_at_current_pixel)
+        // Calls task(index) once for every index in [0, count), and returns once all the calls have returned.
+        void run(int count, const std::function<void(int)> &task)
+        {
+            if (threads.empty() || count <= 1)
             {
-                new_color_changed_rows.insert(row_idx);
+                for (int index = 0; index < count; ++index)
+                {
+                    task(index);
+                }
+                return;
+            }
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                current_task = &task;
+                task_count = count;
+                next_index = 0;
+                busy_threads = static_cast<int>(threads.size());
+                generation++;
             }
+            start_condition.notify_all();
+            run_claimed_calls();
 
-            // Check if color_changed_at_current_pixel was true once at this row during the previous frame
-            // If so, then we need to update the entire row. This is unfortunate and I probably don't need to send the entire row,
-            // but this was a way I could guarantee no artifacting.
-            // TODO: find a way to not send entire row. Maybe just neighboring pixels?
-            if (use_color_changed_rows && !color_changed_at_current_pixel && color_changed_rows.count(row_idx) > 0)
+            std::unique_lock<std::mutex> lock(mutex);
+            done_condition.wait(lock, [this] { return busy_threads == 0; });
+            current_task = nullptr;
+        }
+
+    private:
+        std::vector<std::thread> threads;
+        std::mutex mutex;
+        std::condition_variable start_condition;
+        std::condition_variable done_condition;
+        const std::function<void(int)> *current_task = nullptr;
+        int task_count = 0;
+        std::atomic<int> next_index{0};
+        int busy_threads = 0;
+        uint64_t generation = 0;
+        bool stopping = false;
+
+        void run_claimed_calls()
+        {
+            for (int index = next_index++; index < task_count; index = next_index++)
             {
-                color_changed_at_current_pixel = true;
+                (*current_task)(index);
             }
+        }
 
-            if (skip_to_row_index != -1)
+        void work()
+        {
+            uint64_t seen_generation = 0;
+            std::unique_lock<std::mutex> lock(mutex);
+            while (true)
             {
-                if (row_idx < skip_to_row_index)
+                start_condition.wait(lock, [&] { return stopping || generation != seen_generation; });
+                if (stopping)
                 {
-                    continue;
+                    return;
                 }
-                else
+                seen_generation = generation;
+                lock.unlock();
+                run_claimed_calls();
+                lock.lock();
+                if (--busy_threads == 0)
                 {
-                    skip_to_row_index = -1;
+                    done_condition.notify_one();
                 }
             }
+        }
+    };
+
+    // A group of identical rows in the current frame, which is sent once with a row span
+    struct RowGroup
+    {
+        int row_idx;
+        int row_span;
+    };
+
+    // The scratch storage of encoding one band of row groups, so bands can be encoded at the same time
+    struct BandEncoder
+    {
+        RowColorGroups row_colors;
+
+        // Columns that changed in the current group of rows, within its dirty span
+        std::vector<unsigned char> changed_columns;
+
+        // The encoded band, when it isn't written straight into the output
+        std::vector<char> output;
+        int length = 0;
+    };
+
+    // Bands get at least this many rows, since every band costs a handoff to a thread and a copy of its output
+    const int MIN_BAND_ROWS = 16;
+    // More bands than threads, so a thread that finishes early can take another band
+    const int BANDS_PER_THREAD = 2;
+
+    // The state of one encoder: its options, its threads and the scratch storage of encode_frame, which is reused between frames.
+    // Nothing else is shared between encoders apart from the read-only UTF-8 table,
+    // so encoders can run on different threads at once, as long as each encoder is only used by one thread at a time.
+    struct EncoderContext
+    {
+        bool rectangles;
+        std::unique_ptr<WorkerPool> pool;
+
+        explicit EncoderContext(bool rectangles = false, int thread_count = 1)
+            : rectangles(rectangles), pool(new WorkerPool(thread_count))
+        {
+        }
 
-            if (col_idx == 0)
+        std::vector<RowGroup> row_groups;
+        // First row group of every band, followed by the number of row groups
+        std::vector<int> band_starts;
+        std::vector<BandEncoder> bands;
+
+        // Changed pixels of the whole frame and the dirty span of every row, only needed to find rectangles
+        std::vector<unsigned char> changed_pixels;
+        std::vector<int> first_changed_columns;
+        std::vector<int> last_changed_columns;
+    };
+
+    // Builds the runs of the row groups [first_group, end_group) from the changes in them, and writes them.
+    char *write_row_groups(char *cursor, const Utf8Code *table, BandEncoder &band, const RowGroup *row_groups, int first_group, int end_group,
+                           Array3D *current_frame, Array3D *previous_frame, bool rectangles, const unsigned char *changed_pixels,
+                           const int *first_changed_columns, const int *last_changed_columns)
+    {
+        int columns = current_frame->shape[1];
+        int channels = current_frame->shape[2];
+        int row_size_bytes = columns * channels;
+        std::vector<unsigned char> &changed_columns = band.changed_columns;
+        changed_columns.assign(columns, 0);
+        band.row_colors.reserve(columns);
+
+        for (int group_idx = first_group; group_idx < end_group; ++group_idx)
+        {
+            int row_idx = row_groups[group_idx].row_idx;
+            int row_span = row_groups[group_idx].row_span;
+            unsigned char *current_row = current_frame->data + row_idx * row_size_bytes;
+
+            int first_changed_column = columns;
+            int last_changed_column = -1;
+            if (rectangles)
             {
-                if (!color_ranges_map.empty())
+                // Every row of the group gets the current colors, so send the columns that are left in any of them.
+                for (int group_row_idx = row_idx; group_row_idx < row_idx + row_span; ++group_row_idx)
                 {
-                    changes_made_for_previous_row = true;
-                    if (identical_rows.find(row_idx - 1) != identical_rows.end())
-                    {
-                        int combined_row_number = (row_idx - 1) * 1000 + (identical_rows[row_idx - 1] + 1);
-                        skip_to_row_index = row_idx + identical_rows[row_idx - 1];
-                        ss << encode_utf8(combined_row_number);
-                    }
-                    else
+                    const unsigned char *changed_row = changed_pixels + group_row_idx * columns;
+                    for (int col_idx = first_changed_columns[group_row_idx]; col_idx <= last_changed_columns[group_row_idx]; ++col_idx)
                     {
-                        ss << encode_utf8((row_idx - 1) * 1000 + 1);
+                        if (changed_row[col_idx])
+                        {
+                            changed_columns[col_idx] = 1;
+                            first_changed_column = std::min(first_changed_column, col_idx);
+                            last_changed_column = std::max(last_changed_column, col_idx);
+                        }
                     }
                 }
-
-                for (auto &color_ranges : color_ranges_map)
+            }
+            else if (previous_frame)
+            {
+                // Every row of the group gets the current colors, so send the columns that changed in any of them.
+                for (int group_row_idx = row_idx; group_row_idx < row_idx + row_span; ++group_row_idx)
                 {
-                    ss << encode_utf8(color_ranges.first.first);
-                    ss << encode_utf8(color_ranges.first.second);
-                    for (auto &range : color_ranges.second)
+                    unsigned char *previous_row = previous_frame->data + group_row_idx * row_size_bytes;
+                    if (rows_equal(current_row, previous_row, row_size_bytes))
                     {
-                        int combined = range.first * 1000 + range.second;
-                        ss << encode_utf8(combined);
+                        continue;
                     }
-                    ss << '\x01';
+                    mark_changed_columns(current_row, previous_row, columns, channels,
+                                         changed_columns.data(), &first_changed_column, &last_changed_column);
                 }
+            }
+            else
+            {
+                // previous_frame is nullptr, meaning a full frame update was sent, so we consider all pixels changed
+                std::fill(changed_columns.begin(), changed_columns.end(), 1);
+                first_changed_column = 0;
+                last_changed_column = columns - 1;
+            }
 
-                color_ranges_map.clear();
+            if (last_changed_column != -1)
+            {
+                cursor = write_row_group(cursor, table, band.row_colors, current_row, row_idx, row_span, channels,
+                                         changed_columns.data(), first_changed_column, last_changed_column);
+            }
+        }
+        return cursor;
+    }
 
-                if (changes_made_for_previous_row)
-                {
-                    ss << '\x02';
-                    first_row = false;
-                }
-                changes_made_for_previous_row = false;
-                range_is_ongoing = false;
-                range_current_color = {-1, -1};
+    // Splits [0, count) into band_count contiguous ranges and calls task(first, end) for every range, on the context's threads.
+    void run_in_bands(EncoderContext *context, int count, int band_count, const std::function<void(int, int)> &task)
+    {
+        context->pool->run(band_count, [&](int band_idx)
+                           { task(count * band_idx / band_count, count * (band_idx + 1) / band_count); });
+    }
+
+    // Encodes current_frame, as a delta against previous_frame if it isn't null, into output.
+    // With rectangles set on the context, vertical runs of a color are sent as rectangles before the remaining pixels are sent by row.
+    // With more than one thread, the row groups are split into horizontal bands that are encoded at the same time
+    // and concatenated in order. Bands only split between row groups, so the output is the same as with one thread.
+    int encode_frame(EncoderContext *context, Array3D *current_frame, Array3D *previous_frame, char *output, int output_capacity)
+    {
+        if (output_capacity < frame_to_string_max_size(current_frame->shape[0], current_frame->shape[1]))
+        {
+            return -1;
+        }
+        const Utf8Code *table = utf8_table().data();
+        char *cursor = output;
+
+        int rows = current_frame->shape[0];
+        int columns = current_frame->shape[1];
+        int channels = current_frame->shape[2];
+        int row_size_bytes = columns * channels;
+        bool rectangles = context->rectangles;
+        int thread_count = context->pool->thread_count();
+        int band_count = thread_count == 1 ? 1 : std::max(1, std::min(thread_count * BANDS_PER_THREAD, rows / MIN_BAND_ROWS));
+
+        std::vector<unsigned char> &changed_pixels = context->changed_pixels;
+        std::vector<int> &first_changed_columns = context->first_changed_columns;
+        std::vector<int> &last_changed_columns = context->last_changed_columns;
+        if (rectangles)
+        {
+            changed_pixels.assign(rows * columns, previous_frame ? 0 : 1);
+            first_changed_columns.assign(rows, previous_frame ? columns : 0);
+            last_changed_columns.assign(rows, previous_frame ? -1 : columns - 1);
+            if (previous_frame)
+            {
+                run_in_bands(context, rows, band_count, [&](int first_row_idx, int end_row_idx)
+                             {
+                    for (int row_idx = first_row_idx; row_idx < end_row_idx; ++row_idx)
+                    {
+                        unsigned char *current_row = current_frame->data + row_idx * row_size_bytes;
+                        unsigned char *previous_row = previous_frame->data + row_idx * row_size_bytes;
+                        if (!rows_equal(current_row, previous_row, row_size_bytes))
+                        {
+                            mark_changed_columns(current_row, previous_row, columns, channels, changed_pixels.data() + row_idx * columns,
+                                                 &first_changed_columns[row_idx], &last_changed_columns[row_idx]);
+                        }
+                    } });
             }
+            // Rectangles are found greedily in raster order, so this stays on one thread
+            cursor = write_rectangles(cursor, table, current_frame, changed_pixels.data(),
+                                      first_changed_columns.data(), last_changed_columns.data());
+        }
 
-            std::pair<int, int> rgb_int = get_pixel_color_codes(current_pixel);
-            if (color_changed_at_current_pixel && rgb_int != range_current_color)
+        // Rows that are identical to the first row of a group in the current frame are sent once, as a row span.
+        // Groups are found up front, so bands can start at group boundaries and a group is never split between bands.
+        std::vector<RowGroup> &row_groups = context->row_groups;
+        row_groups.clear();
+        for (int row_idx = 0; row_idx < rows;)
+        {
+            unsigned char *current_row = current_frame->data + row_idx * row_size_bytes;
+            int row_span = 1;
+            while (row_idx + row_span < rows && row_span < 999 &&
+                   rows_equal(current_row, current_row + row_span * row_size_bytes, row_size_bytes))
             {
-                color_ranges_map[rgb_int].push_back({col_idx, 1});
-                range_current_color = rgb_int;
-                range_is_ongoing = true;
+                row_span++;
             }
-            else if (color_changed_at_current_pixel && color_ranges_map.find(range_current_color) != color_ranges_map.end() && range_is_ongoing)
+            row_groups.push_back({row_idx, row_span});
+            row_idx += row_span;
+        }
+        int group_count = static_cast<int>(row_groups.size());
+        band_count = std::min(band_count, group_count);
+
+        if (static_cast<int>(context->bands.size()) < band_count)
+        {
+            context->bands.resize(band_count);
+        }
+        if (band_count <= 1)
+        {
+            cursor = write_row_groups(cursor, table, context->bands[0], row_groups.data(), 0, group_count, current_frame, previous_frame,
+                                      rectangles, changed_pixels.data(), first_changed_columns.data(), last_changed_columns.data());
+            *cursor = '\0';
+            return static_cast<int>(cursor - output);
+        }
+
+        // Bands cover about the same amount of rows, and start at the first group at or below their first row
+        std::vector<int> &band_starts = context->band_starts;
+        band_starts.resize(band_count + 1);
+        for (int band_idx = 0, group_idx = 0; band_idx <= band_count; ++band_idx)
+        {
+            while (group_idx < group_count && row_groups[group_idx].row_idx < rows * band_idx / band_count)
             {
-                color_ranges_map[range_current_color].back().second++;
+                group_idx++;
             }
-            else
+            band_starts[band_idx] = group_idx;
+        }
+
+        context->pool->run(band_count, [&](int band_idx)
+                           {
+            BandEncoder &band = context->bands[band_idx];
+            int first_group = band_starts[band_idx];
+            int end_group = band_starts[band_idx + 1];
+            int band_rows = first_group == end_group ? 0 : row_groups[end_group - 1].row_idx + row_groups[end_group - 1].row_span - row_groups[first_group].row_idx;
+            band.output.resize(frame_to_string_max_size(band_rows, columns));
+            char *band_end = write_row_groups(band.output.data(), table, band, row_groups.data(), first_group, end_group,
+                                              current_frame, previous_frame, rectangles, changed_pixels.data(),
+                                              first_changed_columns.data(), last_changed_columns.data());
+            band.length = static_cast<int>(band_end - band.output.data()); });
+
+        for (int band_idx = 0; band_idx < band_count; ++band_idx)
+        {
+            const BandEncoder &band = context->bands[band_idx];
+            std::memcpy(cursor, band.output.data(), band.length);
+            cursor += band.length;
+        }
+        *cursor = '\0';
+        return static_cast<int>(cursor - output);
+    }
+
+    // Every this many rows is sampled to pick the shift
+    const int SHIFT_SAMPLE_ROWS = 4;
+    // A shift is only worth a command if it makes at least this many more pixels match
+    const int MIN_SHIFT_GAIN = 256;
+
+    // Counts the pixels of a row in current_frame that equal their pixel in previous_frame
+    // after the whole frame is shifted by dx columns and dy rows. Pixels with no source keep their previous value.
+    int count_shifted_matches(Array3D *current_frame, Array3D *previous_frame, int row_idx, int dx, int dy)
+    {
+        int rows = current_frame->shape[0];
+        int columns = current_frame->shape[1];
+        int channels = current_frame->shape[2];
+        int row_size_bytes = columns * channels;
+        const unsigned char *current_row = current_frame->data + row_idx * row_size_bytes;
+        const unsigned char *previous_row = previous_frame->data + row_idx * row_size_bytes;
+        int source_row_idx = row_idx - dy;
+        bool has_source_row = source_row_idx >= 0 && source_row_idx < rows;
+        const unsigned char *source_row = has_source_row ? previous_frame->data + source_row_idx * row_size_bytes : previous_row;
+
+        int matches = 0;
+        for (int col_idx = 0; col_idx < columns; ++col_idx)
+        {
+            int source_col_idx = col_idx - dx;
+            const unsigned char *reference_pixel = (has_source_row && source_col_idx >= 0 && source_col_idx < columns)
+                                                       ? source_row + source_col_idx * channels
+                                                       : previous_row + col_idx * channels;
+            const unsigned char *current_pixel = current_row + col_idx * channels;
+            bool match = true;
+            for (int j = 0; j < channels; ++j)
             {
-                range_is_ongoing = false;
-                range_current_color = {-1, -1};
+                match &= current_pixel[j] == reference_pixel[j];
             }
+            matches += match;
         }
+        return matches;
+    }
 
-        // Handle the last row if necessary
-        if (!color_ranges_map.empty())
+    // Looks for a band of rows that moved by up to max_shift pixels between previous_frame and current_frame,
+    // horizontally or vertically, like a scrolling playfield under a static status bar.
+    // On success, writes {first row, row count, dx, dy} to shift and returns 1, otherwise returns 0.
+    int detect_shift(Array3D *current_frame, Array3D *previous_frame, int max_shift, int *shift)
+    {
+        int rows = current_frame->shape[0];
+        for (int i = 0; i < 3; ++i)
         {
-            // Write the index of the final row, which is the total amount of rows - 1
-            int row_idx = current_frame->shape[0] - 1;
-            ss << encode_utf8((row_idx - 1) * 1000 + (identical_rows[row_idx - 1] + 1));
+            if (current_frame->shape[i] != previous_frame->shape[i])
+            {
+                return 0;
+            }
+        }
 
-            for (auto &color_ranges : color_ranges_map)
+        std::vector<int> unshifted_matches(rows);
+        for (int row_idx = 0; row_idx < rows; row_idx += SHIFT_SAMPLE_ROWS)
+        {
+            unshifted_matches[row_idx] = count_shifted_matches(current_frame, previous_frame, row_idx, 0, 0);
+        }
+
+        // Try horizontal and vertical shifts, smallest first, and keep the one that gains the most matches on sampled rows
+        int best_gain = 0;
+        int best_dx = 0;
+        int best_dy = 0;
+        for (int distance = 1; distance <= max_shift; ++distance)
+        {
+            const int candidates[4][2] = {{distance, 0}, {-distance, 0}, {0, distance}, {0, -distance}};
+            for (const auto &candidate : candidates)
             {
-                ss << encode_utf8(color_ranges.first.first);
-                ss << encode_utf8(color_ranges.first.second);
-                for (auto &range : color_ranges.second)
+                int gain = 0;
+                for (int row_idx = 0; row_idx < rows; row_idx += SHIFT_SAMPLE_ROWS)
                 {
-                    int combined = range.first * 1000 + range.second;
-                    ss << encode_utf8(combined);
+                    int matches = count_shifted_matches(current_frame, previous_frame, row_idx, candidate[0], candidate[1]);
+                    gain += std::max(0, matches - unshifted_matches[row_idx]);
+                }
+                if (gain > best_gain)
+                {
+                    best_gain = gain;
+                    best_dx = candidate[0];
+                    best_dy = candidate[1];
                 }
-                ss << '\x01';
             }
-            ss << '\x02';
+        }
+        if (best_gain * SHIFT_SAMPLE_ROWS < MIN_SHIFT_GAIN)
+        {
+            return 0;
         }
 
-        // At the end of the function, assign new_color_changed_rows to color_changed_rows
-        color_changed_rows = new_color_changed_rows;
-        // We only need to update entire rows every other frame; it still looks fine.
-        use_color_changed_rows == true ? use_color_changed_rows = false : use_color_changed_rows = true;
+        // The band is the run of rows that don't lose matches when shifted, with the largest gain overall
+        int best_band_gain = 0;
+        int best_band_start = 0;
+        int best_band_end = 0;
+        int band_start = 0;
+        int band_gain = 0;
+        for (int row_idx = 0; row_idx < rows; ++row_idx)
+        {
+            int gain = count_shifted_matches(current_frame, previous_frame, row_idx, best_dx, best_dy) -
+                       count_shifted_matches(current_frame, previous_frame, row_idx, 0, 0);
+            if (gain < 0 || row_idx - band_start >= 999)
+            {
+                band_start = row_idx + 1;
+                band_gain = 0;
+                continue;
+            }
+            band_gain += gain;
+            if (band_gain > best_band_gain)
+            {
+                best_band_gain = band_gain;
+                best_band_start = band_start;
+                best_band_end = row_idx + 1;
+            }
+        }
+        if (best_band_gain < MIN_SHIFT_GAIN)
+        {
+            return 0;
+        }
 
-        cached_previous_frame = previous_frame;
-        cached_output = ss.str();
-        std::strncpy(output, cached_output.c_str(), cached_output.size());
-        output[cached_output.size()] = '\0';
+        shift[0] = best_band_start;
+        shift[1] = best_band_end - best_band_start;
+        shift[2] = best_dx;
+        shift[3] = best_dy;
+        return 1;
+    }
+
+    // Creates an encoder, which sends vertical runs of a color as rectangles if rectangles isn't 0,
+    // and splits frames into bands that are encoded on thread_count threads, counting the calling thread.
+    // It has to be freed with encoder_destroy.
+    EncoderContext *encoder_create(int rectangles, int thread_count)
+    {
+        // Build the table now rather than during the first encode
+        utf8_table();
+        return new EncoderContext(rectangles != 0, std::max(1, thread_count));
+    }
+
+    // Encodes current_frame, as a delta against previous_frame if it isn't null, into output.
+    // Returns the amount of bytes written, not counting the NUL terminator,
+    // or -1 if output_capacity is below frame_to_string_max_size for the frame.
+    int encoder_encode(EncoderContext *context, Array3D *current_frame, Array3D *previous_frame, char *output, int output_capacity)
+    {
+        return encode_frame(context, current_frame, previous_frame, output, output_capacity);
+    }
+
+    // Frees the scratch storage of the encoder, e.g. after the frame size went down. Its threads are kept.
+    void encoder_reset(EncoderContext *context)
+    {
+        context->row_groups = std::vector<RowGroup>();
+        context->band_starts = std::vector<int>();
+        context->bands = std::vector<BandEncoder>();
+        context->changed_pixels = std::vector<unsigned char>();
+        context->first_changed_columns = std::vector<int>();
+        context->last_changed_columns = std::vector<int>();
+    }
+
+    void encoder_destroy(EncoderContext *context)
+    {
+        delete context;
+    }
+
+    // Encodes a single frame with a temporary encoder. Prefer an encoder from encoder_create for a stream of frames.
+    int frame_to_string(Array3D *current_frame, Array3D *previous_frame, char *output, int output_capacity)
+    {
+        EncoderContext context;
+        return encode_frame(&context, current_frame, previous_frame, output, output_capacity);
+    }
+
+    // Same as frame_to_string, but sends vertical runs of a color as rectangles.
+    int frame_to_rectangles_string(Array3D *current_frame, Array3D *previous_frame, char *output, int output_capacity)
+    {
+        EncoderContext context(true);
+        return encode_frame(&context, current_frame, previous_frame, output, output_capacity);
     }
-}
\ No newline at end of file
+}
@@ -1,8 +1,10 @@
 from libs.DisplayStrategies.DisplayStrategy import *
 
 class AdvancedDisplayStrategy(DisplayStrategy):
-    def __init__(self, host: str, port: int, scale_percentage: int):
-        super().__init__(host=host, port=port, scale_percentage=scale_percentage)
+    def __init__(self, host: str, port: int, scale_percentage: int, features: frozenset = frozenset(),
+                 zstd_dictionary_path: str = None):
+        super().__init__(host=host, port=port, scale_percentage=scale_percentage, features=features,
+                         zstd_dictionary_path=zstd_dictionary_path)
 
     def display(self):
         return self.show_frame('NES Emulator Frame Viewer (Canvas)')
@@ -11,5 +13,7 @@ class AdvancedDisplayStrategy(DisplayStrategy):
         update_canvas(message=message,
                       canvas=canvas if canvas is not None else self.canvas,
                       offset=OFFSET,
-                      display_canvas_every_update=display_canvas_every_update
+                      display_canvas_every_update=display_canvas_every_update,
+                      palette=self.palette,
+                      row_cache=self.row_cache
                       )
\ No newline at end of file
@@ -1,5 +1,9 @@
 from abc import ABC, abstractmethod
 from ..Helpers.GeneralHelpers import *
+from .FrameDecoder import decode_message, Palette
+from ..Protocol.FrameProtocol import FEATURE_PALETTE, FEATURE_ROW_CACHE, FEATURE_ZSTD, SHIFT_COMMAND, features_to_path
+from ..Protocol.RowCache import RowCache
+from ..Protocol.ZstdCodec import ZstdCodec
 
 ## Orig
 def rgb_to_utf8(r: int, g: int, b: int, offset: int = 0) -> str:
@@ -50,7 +54,21 @@ def utf8_to_rgb(utf8_chars: str, offset: int = 0) -> tuple:
     return (b, g, r)
 
 
-def update_canvas(message: str, canvas: np.ndarray, offset: int, display_canvas_every_update: bool = False):
+def update_canvas(message, canvas: np.ndarray, offset: int, display_canvas_every_update: bool = False,
+                  palette: Palette = None, row_cache: RowCache = None):
+    """
+    Applies a message to the canvas. Streams negotiated with FEATURE_PALETTE need that stream's palette,
+    and streams negotiated with FEATURE_ROW_CACHE need that stream's row cache, which mirrors the server's.
+    Streams negotiated with FEATURE_BINARY send bytes messages.
+    """
+    if (display_canvas_every_update and palette is None and row_cache is None and isinstance(message, str)
+            and not message.startswith(chr(SHIFT_COMMAND))):
+        # Showing the canvas after every column needs the per-pixel walk.
+        return update_canvas_per_pixel(message=message, canvas=canvas, offset=offset, display_canvas_every_update=True)
+    decode_message(message=message, canvas=canvas, offset=offset, palette=palette, row_cache=row_cache)
+
+
+def update_canvas_per_pixel(message: str, canvas: np.ndarray, offset: int, display_canvas_every_update: bool = False):
     i = 0
 
     # This flag will help us know when to end the outer loop, if we reach the end of the message
@@ -110,10 +128,16 @@ def get_start_index_and_range_length(char: str, offset: int) -> (int, int):
     return start, range_length
 
 class DisplayStrategy(ABC):
-    def __init__(self, host: str, port: int, scale_percentage: int):
+    def __init__(self, host: str, port: int, scale_percentage: int, features: frozenset = frozenset(),
+                 zstd_dictionary_path: str = None):
         self.host = host
         self.port = port
         self.scale_percentage = scale_percentage
+        # Optional protocol features to ask the server for
+        self.features = features
+        # Decompresses FEATURE_ZSTD messages, with the dictionary the server uses
+        self.zstd_codec = ZstdCodec(zstd_dictionary_path) if FEATURE_ZSTD in features else None
+        self.reinitialize_stream_state()
         self.new_frame_width = int(DEFAULT_FRAME_WIDTH * (self.scale_percentage / 100))
         self.new_frame_height = int(DEFAULT_FRAME_HEIGHT * (self.scale_percentage / 100))
         # new_frame_height is the amount of rows to create
@@ -132,6 +156,11 @@ class DisplayStrategy(ABC):
     def reinitialize_canvas(self):
         self.canvas = np.zeros((self.new_frame_height, self.new_frame_width, 3), dtype=np.uint8)
 
+    def reinitialize_stream_state(self):
+        # A new connection starts with a keyframe, which carries its own palette and row cache tables
+        self.palette = Palette() if FEATURE_PALETTE in self.features else None
+        self.row_cache = RowCache() if FEATURE_ROW_CACHE in self.features else None
+
     def show_frame(self, window_name: str):
         # Display the image represented by self.canvas in a window with the specified window_name
         cv2.imshow(window_name, self.canvas)
@@ -145,21 +174,20 @@ class DisplayStrategy(ABC):
         return True  # Return True to indicate program should continue
 
     async def receive_frames(self):
-        uri = f"ws://{self.host}:{self.port}"
+        uri = f"ws://{self.host}:{self.port}{features_to_path(self.features)}"
         logger.info(f"Using display strategy: {self.__class__.__name__}")
-        # TODO: delete this, only here for debug! Is a memory leak!
-        messages = []
         while True:
             try:
                 async with websockets.connect(uri, max_size=1024 * 1024 * 10) as websocket:
+                    self.reinitialize_stream_state()
                     while True:
                         message = await websocket.recv()
-                        messages.append(message)
                         # Encoding as UTF-8, but in Logix we will decode the RGB character as UTF-32.
                         # This still works because the unicode code points are identical for both.
-                        #print(message)
-                        message_bytes = len(message.encode('utf-8'))
-                        logger.info(f"Received message with {message_bytes} bytes, {len(message)} chars.")
+                        # Binary messages of FEATURE_BINARY arrive as bytes
+                        logger.debug("Received message with %d chars or bytes.", len(message))
+                        if self.zstd_codec is not None:
+                            message = self.zstd_codec.decompress(message)
                         self.update_canvas(message=message)
                         if not self.display():
                             break
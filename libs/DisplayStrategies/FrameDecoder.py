@@ -0,0 +1,220 @@
+from ..Helpers.GeneralHelpers import *
+from ..Protocol.FrameProtocol import *
+from ..Protocol.RowCache import RowCache
+
+# Below this many runs, painting run by run with slice assignments is cheaper than building scatter indices.
+SLICE_ASSIGNMENT_MAX_RUNS = 32
+# Runs covering at least this many pixels, like rectangles spanning several rows, are always painted with a slice assignment.
+SLICE_ASSIGNMENT_MIN_AREA = 256
+
+
+class FrameRuns:
+    """
+    A decoded message as flat, equally sized arrays. Run i paints
+    rows [row_starts[i], row_starts[i] + row_spans[i]) and
+    columns [column_starts[i], column_starts[i] + column_spans[i]) with colors[i].
+    Runs are kept in message order, so later runs overwrite earlier ones.
+    shift is (first row, row count, dx, dy) of a shift command to apply before painting, or None.
+    """
+
+    def __init__(self, row_starts: np.ndarray, row_spans: np.ndarray, colors: np.ndarray,
+                 column_starts: np.ndarray, column_spans: np.ndarray):
+        self.row_starts = row_starts
+        self.row_spans = row_spans
+        self.colors = colors
+        self.column_starts = column_starts
+        self.column_spans = column_spans
+        self.shift = None
+
+    def __len__(self):
+        return len(self.row_starts)
+
+    @classmethod
+    def empty(cls):
+        no_values = np.empty(0, dtype=np.int64)
+        return cls(row_starts=no_values, row_spans=no_values, colors=np.empty((0, 3), dtype=np.uint8),
+                   column_starts=no_values, column_spans=no_values)
+
+
+class Palette:
+    """The palette of a stream using FEATURE_PALETTE, kept in canvas (b, g, r) channel order."""
+
+    def __init__(self):
+        self.colors = np.zeros((0, 3), dtype=np.uint8)
+
+    def update(self, start: int, colors: np.ndarray):
+        # A table starting at index 0 replaces the palette
+        self.colors = np.concatenate((self.colors[:start], colors))
+
+
+def values_to_colors(rg_values: np.ndarray, b_values: np.ndarray) -> np.ndarray:
+    # Channels are stored as (b, g, r) so cv displays them correctly, matching utf8_to_rgb.
+    return np.stack((b_values, rg_values % 1000, rg_values // 1000), axis=1).astype(np.uint8)
+
+
+def apply_palette_command(codepoints: np.ndarray, offset: int, palette: Palette) -> np.ndarray:
+    """Applies a palette table at the start of the message, and returns the rest of the message."""
+    table, codepoints = split_palette_command(codepoints)
+    if len(table) == 0:
+        return codepoints
+    values = decode_values(table[1:-1], offset)
+    palette.update(start=int(values[0]), colors=values_to_colors(values[1::2], values[2::2]))
+    return codepoints
+
+
+def apply_row_cache(codepoints: np.ndarray, offset: int, row_cache: RowCache) -> np.ndarray:
+    """
+    Applies a row cache table at the start of the message, and returns the rest of the message
+    with row references replaced by the cached rows. Rows of messages without a table update the cache.
+    """
+    update = True
+    if len(codepoints) >= 2 and codepoints[0] == ROW_CACHE_COMMAND:
+        count = int(decode_values(codepoints[1:2], offset)[0])
+        ends = (np.flatnonzero(codepoints[2:] == END_OF_ROW)[:count] + 2).tolist()
+        starts = [2] + [end + 1 for end in ends[:-1]]
+        row_cache.replace([(int(decode_values(codepoints[start:start + 1], offset)[0]), codepoints[start + 1:end].copy())
+                           for start, end in zip(starts, ends)])
+        codepoints = codepoints[ends[-1] + 1 if ends else 2:]
+        # A keyframe leaves the cache as its table describes it
+        update = False
+
+    commands, body = split_canvas_commands(codepoints)
+    parts = [commands]
+    copied = 0
+    for start, end in split_row_groups(body):
+        row_body = body[start + 1:end]
+        if len(row_body) == 2 and row_body[0] == ROW_REFERENCE_COMMAND:
+            parts.append(body[copied:start + 1])
+            parts.append(row_cache.get(int(decode_values(row_body[1:], offset)[0]), touch=update))
+            copied = end
+        elif update and row_cache.is_cacheable(row_body):
+            row_cache.add(row_body)
+    parts.append(body[copied:])
+    return np.concatenate(parts)
+
+
+def read_shift_command(codepoints: np.ndarray, offset: int):
+    """Returns the shift command at the start of the message as (first row, row count, dx, dy) or None, and the rest of the message."""
+    commands, codepoints = split_canvas_commands(codepoints)
+    if len(commands) == 0:
+        return None, codepoints
+    region, movement = decode_values(commands[1:3], offset)
+    shift = (int(region // 1000), int(region % 1000), int(movement // 1000 - SHIFT_BIAS), int(movement % 1000 - SHIFT_BIAS))
+    return shift, codepoints
+
+
+def parse_message(message, offset: int, palette: Palette = None, row_cache: RowCache = None) -> FrameRuns:
+    """
+    Parses a frame message into flat run arrays without walking it character by character.
+    The message is a str, or bytes for a stream using FEATURE_BINARY.
+    Messages of a stream using FEATURE_PALETTE must be parsed with that stream's palette,
+    and messages of a stream using FEATURE_ROW_CACHE with that stream's row cache, in order.
+    """
+    codepoints = binary_to_codepoints(message) if isinstance(message, bytes) else message_to_codepoints(message)
+    color_width = 2
+    if palette is not None:
+        codepoints = apply_palette_command(codepoints, offset, palette)
+        color_width = 1
+    if row_cache is not None:
+        codepoints = apply_row_cache(codepoints, offset, row_cache)
+    shift, codepoints = read_shift_command(codepoints, offset)
+
+    length = len(codepoints)
+    if length == 0:
+        runs = FrameRuns.empty()
+        runs.shift = shift
+        return runs
+
+    is_row, is_color, _, is_range = classify_codepoints(codepoints, color_width)
+    # The per-character decoder never applies a range that is the last character of the message.
+    is_range[-1] = False
+
+    values = decode_values(codepoints, offset)
+
+    row_ids = np.cumsum(is_row) - 1
+    color_ids = np.cumsum(is_color) - 1
+
+    row_values = values[is_row]
+    color_positions = np.flatnonzero(is_color)
+    color_positions = color_positions[color_positions + color_width - 1 < length]
+    if palette is None:
+        colors = values_to_colors(values[color_positions], values[color_positions + 1])
+    else:
+        colors = palette.colors[values[color_positions]]
+
+    range_positions = np.flatnonzero(is_range)
+    range_values = values[range_positions]
+    range_row_values = row_values[row_ids[range_positions]]
+
+    runs = FrameRuns(row_starts=range_row_values // 1000,
+                     row_spans=range_row_values % 1000,
+                     colors=colors[color_ids[range_positions]],
+                     column_starts=range_values // 1000,
+                     column_spans=range_values % 1000)
+    runs.shift = shift
+    return runs
+
+
+def paint_runs(canvas: np.ndarray, runs: FrameRuns):
+    """Paints runs onto the canvas in message order."""
+    if len(runs) <= SLICE_ASSIGNMENT_MAX_RUNS:
+        for i in range(len(runs)):
+            row_start = runs.row_starts[i]
+            column_start = runs.column_starts[i]
+            canvas[row_start:row_start + runs.row_spans[i], column_start:column_start + runs.column_spans[i]] = runs.colors[i]
+        return
+
+    height, width = canvas.shape[0], canvas.shape[1]
+    # Clip runs to the canvas, the same way slice assignments would.
+    row_spans = np.clip(np.minimum(runs.row_starts + runs.row_spans, height) - runs.row_starts, 0, None)
+    column_spans = np.clip(np.minimum(runs.column_starts + runs.column_spans, width) - runs.column_starts, 0, None)
+    areas = row_spans * column_spans
+
+    # Run ids that later runs must win over, per pixel. Only needed if large and small runs are painted separately.
+    last_large_runs = None
+    large_run_ids = np.flatnonzero(areas >= SLICE_ASSIGNMENT_MIN_AREA)
+    if len(large_run_ids) > 0:
+        areas = np.where(areas >= SLICE_ASSIGNMENT_MIN_AREA, 0, areas)
+        if areas.any():
+            last_large_runs = np.full((height, width), -1)
+        for i in large_run_ids:
+            rows = slice(runs.row_starts[i], runs.row_starts[i] + row_spans[i])
+            columns = slice(runs.column_starts[i], runs.column_starts[i] + column_spans[i])
+            canvas[rows, columns] = runs.colors[i]
+            if last_large_runs is not None:
+                last_large_runs[rows, columns] = i
+
+    total_pixels = int(areas.sum())
+    if total_pixels == 0:
+        return
+
+    # Expand every remaining run into the flat indices of the pixels it covers.
+    run_ids = np.repeat(np.arange(len(areas)), areas)
+    pixel_ids = np.arange(total_pixels) - np.repeat(np.cumsum(areas) - areas, areas)
+    run_column_spans = column_spans[run_ids]
+    rows = runs.row_starts[run_ids] + pixel_ids // run_column_spans
+    columns = runs.column_starts[run_ids] + pixel_ids % run_column_spans
+
+    if last_large_runs is not None:
+        # Drop pixels that a later large run has already painted over
+        later_writes = run_ids > last_large_runs[rows, columns]
+        run_ids, rows, columns = run_ids[later_writes], rows[later_writes], columns[later_writes]
+        total_pixels = len(run_ids)
+    colors = runs.colors[run_ids]
+
+    # Assignment order isn't guaranteed for repeated indices, so if runs overlap keep only the last write to each pixel.
+    flat_indices = rows * width + columns
+    if np.bincount(flat_indices, minlength=height * width).max() > 1:
+        last_writes = np.full(height * width, -1)
+        np.maximum.at(last_writes, flat_indices, np.arange(total_pixels))
+        last_writes = last_writes[last_writes >= 0]
+        rows, columns, colors = rows[last_writes], columns[last_writes], colors[last_writes]
+
+    canvas[rows, columns] = colors
+
+
+def decode_message(message, canvas: np.ndarray, offset: int, palette: Palette = None, row_cache: RowCache = None):
+    runs = parse_message(message=message, offset=offset, palette=palette, row_cache=row_cache)
+    if runs.shift is not None:
+        shift_region(canvas, *runs.shift)
+    paint_runs(canvas=canvas, runs=runs)
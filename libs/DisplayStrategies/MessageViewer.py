@@ -1,35 +1,44 @@
 from libs.Helpers.GeneralHelpers import *
 from libs.DisplayStrategies.DisplayStrategy import *
+from libs.Recording.StreamReader import StreamReader
 
 
 class MessageViewer:
-    def __init__(self, messages, cycle_mode=False, display_canvas_every_update=False, start_index=0, end_index=-1, window_name=""):
-        self.messages = messages
-        self.end_index = end_index if end_index != -1 else len(messages) - 1
+    """
+    Steps through a recording made with StreamRecorder.
+    Stepping forward applies the next message to the canvas, jumping anywhere else rebuilds the frame from the keyframe before it.
+    """
+
+    def __init__(self, recording: StreamReader, cycle_mode=False, display_canvas_every_update=False, start_index=0, end_index=-1, window_name=""):
+        self.recording = recording
+        self.end_index = end_index if end_index != -1 else len(recording) - 1
         self.start_index = start_index
         self.index = start_index
         self.previous_index = -1
         self.cycle_mode = cycle_mode
         self.window_name = window_name
-        self.frame_height = DEFAULT_FRAME_HEIGHT
-        self.frame_width = DEFAULT_FRAME_WIDTH
+        self.frame_height = recording.height
+        self.frame_width = recording.width
         self.display_canvas_every_update = display_canvas_every_update
         self.reinitialize_canvas()
-        logger.info(f"MessageViewer initialized with {len(self.messages)} messages. Start index: {self.start_index}"
+        logger.info(f"MessageViewer initialized with {len(self.recording)} messages. Start index: {self.start_index}"
                     f" End index: {self.end_index} Cycle mode: {self.cycle_mode}")
 
     def reinitialize_canvas(self):
         self.canvas = np.zeros((self.frame_height, self.frame_width, 3), dtype=np.uint8)
 
     def display_message(self):
-        message = self.messages[self.index]
-        update_canvas(message=message,
-                      canvas=self.canvas,
-                      display_canvas_every_update=self.display_canvas_every_update,
-                      offset=OFFSET
-                      )
-        if self.previous_index != self.index:
-            logger.info(f"Displayed frame {self.index}")
+        if self.previous_index == self.index:
+            return
+        if self.index == self.previous_index + 1:
+            update_canvas(message=self.recording.get_message(self.index),
+                          canvas=self.canvas,
+                          display_canvas_every_update=self.display_canvas_every_update,
+                          offset=self.recording.offset
+                          )
+        else:
+            self.recording.render(self.index, canvas=self.canvas)
+        logger.info(f"Displayed frame {self.index}")
         self.previous_index = self.index
 
     def display(self):
@@ -55,12 +64,11 @@ class MessageViewer:
             self.index = max(0, self.index - 1)
         elif key == 'KEY_RIGHT':
             if self.cycle_mode and self.index + 1 >= self.end_index:
-                # If we are at the end of the list, go back to the start and reinitialize canvas
+                # If we are at the end of the list, go back to the start, which is rebuilt from its keyframe
                     self.index = self.start_index
-                    self.reinitialize_canvas()
                     logger.info(f"Cycle mode: Reset index to {self.index} after reaching end of list (index {self.end_index})")
             else:
-                self.index = min(len(self.messages) - 1, self.index + 1)
+                self.index = min(len(self.recording) - 1, self.index + 1)
 
         return True
 
@@ -0,0 +1,68 @@
+import numpy as np
+import cv2
+
+
+class ColorQuantizer:
+    """
+    Reduces the colors of a frame before it's encoded, so more neighbouring pixels share a color and runs get longer.
+
+    With bits below 8, every channel keeps its top bits. The kept bits are repeated into the dropped ones,
+    so the range still reaches from 0 to 255 instead of getting darker.
+    With a palette, every pixel becomes the nearest palette color. Nearest colors are looked up once per distinct color
+    and kept in a table, since frames only have a few colors and they repeat from frame to frame.
+    """
+
+    def __init__(self, bits: int = 8, palette: np.ndarray = None):
+        self.bits = None
+        self.channel_table = None
+        self.set_bits(bits)
+        self.palette = None
+        self.palette_lookup = None
+        if palette is not None:
+            self.set_palette(palette)
+
+    def set_bits(self, bits: int):
+        if bits < 1 or bits > 8:
+            raise Exception(f"Color bits must be between 1 and 8, not {bits}")
+        values = np.arange(256)
+        kept = values >> (8 - bits)
+        # Repeat the kept bits until all 8 are filled, e.g. 5 bits abcde become abcdeabc
+        quantized = np.zeros(256, dtype=np.int64)
+        filled = 0
+        while filled < 8:
+            quantized |= (kept << 8 >> bits) >> filled
+            filled += bits
+        self.channel_table = quantized.astype(np.uint8)
+        self.bits = bits
+
+    def set_palette(self, palette: np.ndarray):
+        """palette is an (N, 3) array of colors in the channel order of the frames, with N up to 255."""
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+        if len(palette) == 0 or len(palette) > 255:
+            raise Exception(f"Palette must have between 1 and 255 colors, not {len(palette)}")
+        self.palette = palette
+        # Packed 24 bit color -> palette index, or 255 if it hasn't been looked up yet
+        self.palette_lookup = np.full(1 << 24, 255, dtype=np.uint8)
+
+    def is_identity(self) -> bool:
+        return self.bits == 8 and self.palette is None
+
+    def quantize(self, frame: np.ndarray) -> np.ndarray:
+        """Quantizes a uint8 (rows, columns, 3) frame in place and returns it."""
+        if self.bits < 8:
+            cv2.LUT(frame, self.channel_table, dst=frame)
+        if self.palette is not None:
+            frame[...] = self.palette[self.get_palette_indices(frame)]
+        return frame
+
+    def get_palette_indices(self, frame: np.ndarray) -> np.ndarray:
+        keys = (frame[..., 0].astype(np.int32) << 16) | (frame[..., 1].astype(np.int32) << 8) | frame[..., 2]
+        indices = self.palette_lookup[keys]
+        unknown = indices == 255
+        if unknown.any():
+            new_keys = np.unique(keys[unknown])
+            new_colors = np.stack((new_keys >> 16, (new_keys >> 8) & 0xFF, new_keys & 0xFF), axis=1)
+            distances = ((new_colors[:, None, :] - self.palette[None, :, :].astype(np.int32)) ** 2).sum(axis=2)
+            self.palette_lookup[new_keys] = np.argmin(distances, axis=1)
+            indices = self.palette_lookup[keys]
+        return indices
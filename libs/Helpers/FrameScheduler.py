@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+# The NES PPU outputs this many frames per second (NTSC)
+NES_FRAME_RATE = 60.0988
+
+
+class FrameScheduler:
+    """
+    Paces rendering at a fixed rate, and decides which rendered frames get published at a lower rate.
+
+    Render and publish deadlines are absolute times on a monotonic clock that advance by whole periods,
+    so a late tick doesn't push back every following tick and the achieved rates match the targets on average.
+    Publishing is decided against the scheduled render time rather than the time since the last publish,
+    so a publish rate that isn't a divisor of the render rate isn't rounded down to one (45 FPS doesn't become 30 FPS).
+    """
+
+    # If rendering falls this many periods behind, skip ahead instead of rendering a burst of frames to catch up.
+    MAX_LAG_PERIODS: int = 3
+    REPORT_INTERVAL: float = 1.0
+
+    def __init__(self, render_rate: float = NES_FRAME_RATE, publish_rate: float = NES_FRAME_RATE, clock=time.monotonic):
+        self.clock = clock
+        self.render_rate = render_rate
+        self.publish_rate = publish_rate
+        self.render_period = 1.0 / render_rate
+        self.publish_period = 1.0 / publish_rate
+        self.next_render_time = None
+        self.next_publish_time = None
+
+        self.report_start_time = None
+        self.rendered_count = 0
+        self.published_count = 0
+
+    def set_publish_rate(self, publish_rate: float):
+        """Changes the publish rate from the next publish on."""
+        self.publish_rate = publish_rate
+        self.publish_period = 1.0 / publish_rate
+
+    def start(self, now: float = None):
+        now = self.clock() if now is None else now
+        self.next_render_time = now
+        self.next_publish_time = now
+        self.report_start_time = now
+        self.rendered_count = 0
+        self.published_count = 0
+
+    def advance(self, now: float) -> bool:
+        """Takes the render tick that was due at next_render_time. Returns whether its frame should be published."""
+        if self.next_render_time is None:
+            self.start(now)
+
+        scheduled_time = self.next_render_time
+        if now - scheduled_time > self.MAX_LAG_PERIODS * self.render_period:
+            # Too far behind, e.g. after a long stall. Resync rather than catch up.
+            skipped_periods = int((now - scheduled_time) / self.render_period)
+            scheduled_time += skipped_periods * self.render_period
+            self.next_publish_time = max(self.next_publish_time, scheduled_time)
+        self.next_render_time = scheduled_time + self.render_period
+        self.rendered_count += 1
+
+        # Allow for floating point error when the publish period is a multiple of the render period.
+        publish = scheduled_time >= self.next_publish_time - self.render_period * 1e-6
+        if publish:
+            self.next_publish_time += self.publish_period
+            if self.next_publish_time <= scheduled_time:
+                self.next_publish_time = scheduled_time + self.publish_period
+            self.published_count += 1
+        return publish
+
+    async def wait_for_next_frame(self) -> bool:
+        """Sleeps until the next render deadline. Returns whether the frame rendered now should be published."""
+        if self.next_render_time is None:
+            self.start()
+
+        delay = self.next_render_time - self.clock()
+        if delay > 0:
+            # A late wakeup doesn't delay the ticks after it, since advance keeps deadlines on their grid
+            await asyncio.sleep(delay)
+
+        return self.advance(self.clock())
+
+    def report_due(self) -> bool:
+        return self.report_start_time is not None and self.clock() - self.report_start_time >= self.REPORT_INTERVAL
+
+    def pop_achieved_rates(self):
+        """Returns the (render, publish) rates achieved since the last call, and starts a new measurement."""
+        now = self.clock()
+        elapsed = max(now - self.report_start_time, 1e-9)
+        rates = (self.rendered_count / elapsed, self.published_count / elapsed)
+        self.report_start_time = now
+        self.rendered_count = 0
+        self.published_count = 0
+        return rates
+
+    def format_rates(self, rates) -> str:
+        render_rate, publish_rate = rates
+        return (f"Rendered FPS: {render_rate:.1f}/{self.render_rate:.1f} "
+                f"Published FPS: {publish_rate:.1f}/{self.publish_rate:.1f}")
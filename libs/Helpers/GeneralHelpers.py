@@ -1,5 +1,6 @@
 import cProfile
 import pstats
+import io
 import numpy as np
 import asyncio
 import websockets
@@ -35,6 +36,13 @@ class SpeedProfiler:
         stats.sort_stats(pstats.SortKey.CUMULATIVE)
         stats.print_stats(num_results)
 
+    def format_stats(self, num_results=20) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(self.pr, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+        stats.print_stats(num_results)
+        return stream.getvalue()
+
 
 def load_json_file(file_path):
     file_path = os.path.abspath(file_path)
@@ -47,4 +55,12 @@ def save_json_file(data, file_path):
     folder_path = os.path.dirname(file_path)
     os.makedirs(folder_path, exist_ok=True)
     with open(file_path, 'w') as f:
-        json.dump(data, f, indent=2, separators=(',', ': '))
\ No newline at end of file
+        json.dump(data, f, indent=2, separators=(',', ': '))
+
+def put_latest(queue: asyncio.Queue, item) -> bool:
+    """Puts an item into a bounded queue without waiting, dropping the oldest item if the queue is full. Returns whether one was dropped."""
+    dropped = queue.full()
+    if dropped:
+        queue.get_nowait()
+    queue.put_nowait(item)
+    return dropped
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class RingHistogram:
+    """
+    The last `capacity` samples of a value, in a ring buffer allocated up front.
+    Recording a sample is O(1) and doesn't allocate, so it can sit on the per-frame path.
+    Summaries are computed over the samples still in the buffer.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.samples = np.zeros(capacity, dtype=np.float64)
+        # Samples ever recorded, including ones that have been overwritten
+        self.count = 0
+
+    def record(self, value: float):
+        self.samples[self.count % self.capacity] = value
+        self.count += 1
+
+    def summary(self) -> dict:
+        window = self.samples[:min(self.count, self.capacity)]
+        if len(window) == 0:
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(window, [50, 95, 99])
+        return {'count': self.count, 'mean': float(window.mean()), 'p50': float(p50), 'p95': float(p95),
+                'p99': float(p99), 'max': float(window.max())}
+
+
+class Metrics:
+    """
+    Counters and histograms of the hot path, e.g. step and encode times, message sizes and dropped frames.
+    Histograms are created on their first sample and then reused, counters are plain integers.
+    """
+
+    # About a minute of samples at 60 FPS
+    HISTOGRAM_CAPACITY: int = 4096
+
+    def __init__(self):
+        # name -> RingHistogram
+        self.histograms = {}
+        # name -> int
+        self.counters = {}
+
+    def record(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = RingHistogram(self.HISTOGRAM_CAPACITY)
+        histogram.record(value)
+
+    def increment(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self) -> dict:
+        return {'counters': dict(self.counters),
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    def format_summary(self) -> str:
+        """One line with the median and 95th percentile of every histogram, and every counter."""
+        parts = []
+        for name, histogram in sorted(self.histograms.items()):
+            summary = histogram.summary()
+            if summary['count']:
+                parts.append(f"{name} p50 {summary['p50']:.3g} p95 {summary['p95']:.3g}")
+        parts.extend(f"{name} {count}" for name, count in sorted(self.counters.items()))
+        return ", ".join(parts)
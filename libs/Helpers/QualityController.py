@@ -0,0 +1,108 @@
+import time
+
+
+class QualityLevel:
+    """
+    Settings for one step of stream quality.
+    resolution_percentage is the resolution frames are rendered at before being scaled back up to the stream size,
+    so clients keep the same canvas. color_bits is the amount of bits kept per color channel.
+    """
+
+    def __init__(self, resolution_percentage: int, color_bits: int, publish_rate: float):
+        self.resolution_percentage = resolution_percentage
+        self.color_bits = color_bits
+        self.publish_rate = publish_rate
+
+    def __repr__(self):
+        return (f"QualityLevel(resolution_percentage={self.resolution_percentage}, "
+                f"color_bits={self.color_bits}, publish_rate={self.publish_rate})")
+
+
+class QualityController:
+    """
+    Moves between quality levels, ordered from best to worst, to keep the stream within its targets:
+    bytes per second, latency from capture to the clients' mailboxes, encode time, and the clients' send backlog,
+    which is the time a message waits in a mailbox until it's sent and the deliveries dropped because a newer frame arrived first.
+    Quality drops by a level as soon as an interval misses a target,
+    and only goes back up after several intervals well within all of them, so it doesn't oscillate.
+    """
+
+    ADJUST_INTERVAL: float = 2.0
+    STABLE_INTERVALS_TO_UPGRADE: int = 3
+    # An interval counts as well within the targets below this fraction of them
+    UPGRADE_HEADROOM: float = 0.6
+    # An interval with more dropped deliveries than this misses the backlog target. Upgrading needs an interval without any.
+    MAX_DROPPED_DELIVERIES: int = 2
+
+    def __init__(self, levels: list, target_bytes_per_second: float, target_latency: float,
+                 target_send_latency: float = None, target_encode_time: float = None, clock=time.monotonic):
+        if not levels:
+            raise Exception("QualityController needs at least one quality level")
+        self.levels = levels
+        self.target_bytes_per_second = target_bytes_per_second
+        self.target_latency = target_latency
+        # None to not watch send latency or encode time
+        self.target_send_latency = target_send_latency
+        self.target_encode_time = target_encode_time
+        self.clock = clock
+        self.level_index = 0
+        self.stable_intervals = 0
+        self.interval_start_time = clock()
+        self.interval_bytes = 0
+        self.interval_max_latency = 0.0
+        self.interval_max_encode_time = 0.0
+        self.interval_max_send_latency = 0.0
+        self.interval_dropped_deliveries = 0
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.levels[self.level_index]
+
+    def record_frame(self, message_bytes: int, latency: float, encode_time: float = 0.0):
+        self.interval_bytes += message_bytes
+        self.interval_max_latency = max(self.interval_max_latency, latency)
+        self.interval_max_encode_time = max(self.interval_max_encode_time, encode_time)
+
+    def record_deliveries(self, max_send_latency: float, dropped_deliveries: int):
+        """Records the clients' send backlog: the longest a message waited to be sent, and how many deliveries were dropped."""
+        self.interval_max_send_latency = max(self.interval_max_send_latency, max_send_latency)
+        self.interval_dropped_deliveries += dropped_deliveries
+
+    def get_load(self, elapsed: float) -> float:
+        """How close the interval came to its targets, as the largest fraction of a target reached."""
+        loads = [self.interval_bytes / elapsed / self.target_bytes_per_second,
+                 self.interval_max_latency / self.target_latency]
+        if self.target_send_latency is not None:
+            loads.append(self.interval_max_send_latency / self.target_send_latency)
+        if self.target_encode_time is not None:
+            loads.append(self.interval_max_encode_time / self.target_encode_time)
+        return max(loads)
+
+    def update(self) -> bool:
+        """Ends the interval once it's long enough, and returns whether the level changed."""
+        now = self.clock()
+        elapsed = now - self.interval_start_time
+        if elapsed < self.ADJUST_INTERVAL:
+            return False
+
+        load = self.get_load(elapsed)
+        dropped_deliveries = self.interval_dropped_deliveries
+        self.interval_start_time = now
+        self.interval_bytes = 0
+        self.interval_max_latency = 0.0
+        self.interval_max_encode_time = 0.0
+        self.interval_max_send_latency = 0.0
+        self.interval_dropped_deliveries = 0
+
+        previous_index = self.level_index
+        if load > 1.0 or dropped_deliveries > self.MAX_DROPPED_DELIVERIES:
+            self.stable_intervals = 0
+            self.level_index = min(self.level_index + 1, len(self.levels) - 1)
+        elif load < self.UPGRADE_HEADROOM and dropped_deliveries == 0:
+            self.stable_intervals += 1
+            if self.stable_intervals >= self.STABLE_INTERVALS_TO_UPGRADE:
+                self.stable_intervals = 0
+                self.level_index = max(self.level_index - 1, 0)
+        else:
+            self.stable_intervals = 0
+        return self.level_index != previous_index
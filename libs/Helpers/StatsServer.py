@@ -0,0 +1,81 @@
+import asyncio
+import json
+import logging
+from urllib.parse import urlparse, parse_qs
+
+from libs.Helpers.GeneralHelpers import SpeedProfiler
+from libs.Helpers.Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StatsServer:
+    """
+    A small local HTTP endpoint for looking at a running server:
+    GET /stats returns the metrics as JSON, and GET /profile?seconds=10 profiles the event loop thread for that long
+    and returns the slowest functions, so profiling only costs anything while someone asks for it.
+    """
+
+    MAX_PROFILE_SECONDS: float = 60.0
+    PROFILE_RESULTS: int = 40
+
+    def __init__(self, host: str, port: int, metrics: Metrics):
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self.profiling = False
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_request, self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Stats served at http://{self.host}:{self.port}/stats and /profile?seconds=10")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # Headers aren't needed, but are read so the client doesn't see the connection reset
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', 'Only GET is supported\n'
+            else:
+                status, content_type, body = await self.respond(request_line[1])
+            payload = body.encode('utf-8')
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, target: str):
+        """Returns (status, content type, body) for a request target like /profile?seconds=5."""
+        url = urlparse(target)
+        if url.path == '/stats':
+            return '200 OK', 'application/json', json.dumps(self.metrics.snapshot(), indent=2)
+        if url.path == '/profile':
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                return '400 Bad Request', 'text/plain', 'seconds must be a number\n'
+            if self.profiling:
+                return '409 Conflict', 'text/plain', 'A profile is already running\n'
+            return '200 OK', 'text/plain', await self.profile(min(max(seconds, 0.0), self.MAX_PROFILE_SECONDS))
+        return '404 Not Found', 'text/plain', 'Try /stats or /profile?seconds=10\n'
+
+    async def profile(self, seconds: float) -> str:
+        # cProfile only sees the thread it's enabled on, which is the event loop's
+        self.profiling = True
+        profiler = SpeedProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.pr.disable()
+            self.profiling = False
+        return profiler.format_stats(self.PROFILE_RESULTS)
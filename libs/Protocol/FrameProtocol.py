@@ -0,0 +1,194 @@
+"""
+Shared pieces of the frame message format. See the README for the layout of a message.
+
+Control characters sit below OFFSET, so they never collide with encoded values.
+Optional features are negotiated per client through the websocket path, e.g. ws://host:9001/?features=palette
+"""
+from urllib.parse import urlparse, parse_qs
+from ..Helpers.GeneralHelpers import *
+
+END_OF_COLOR = 1
+END_OF_ROW = 2
+# Followed by one character for first row * 1000 + row count, and one for (dx + SHIFT_BIAS) * 1000 + (dy + SHIFT_BIAS).
+# Moves those rows by dx columns and dy rows before the runs of the message are painted, see shift_region.
+SHIFT_COMMAND = 3
+SHIFT_BIAS = 128
+# Takes the place of a row's colors and ranges, followed by the slot of the row cache entry holding them.
+ROW_REFERENCE_COMMAND = 4
+# Followed by the index of the first entry, then two characters per color, then END_OF_COLOR.
+PALETTE_COMMAND = 5
+# Followed by the number of entries, then per entry its slot, its colors and ranges, and END_OF_ROW. Replaces the row cache.
+ROW_CACHE_COMMAND = 6
+# Leads a FEATURE_ZSTD message, followed by a zstd frame holding the FEATURE_BINARY message. Never starts any other message.
+ZSTD_COMMAND = 7
+
+# Colors are sent once in a palette table and runs reference them by a one character index.
+FEATURE_PALETTE = 'palette'
+# Scrolling is sent as a shift command, followed by the runs that still differ.
+FEATURE_SHIFT = 'shift'
+# Rows whose colors and ranges were sent recently are sent as a reference to a row cache the client keeps.
+FEATURE_ROW_CACHE = 'rowcache'
+# Messages are sent as binary websocket messages, with every character as a varint instead of UTF-8. For clients that can read bytes.
+FEATURE_BINARY = 'binary'
+# Binary messages are compressed with zstd, optionally with a dictionary both ends load. Implies FEATURE_BINARY.
+FEATURE_ZSTD = 'zstd'
+SUPPORTED_FEATURES = frozenset([FEATURE_PALETTE, FEATURE_SHIFT, FEATURE_ROW_CACHE, FEATURE_BINARY, FEATURE_ZSTD])
+
+# Bits of a value per varint byte. The high bit is set on every byte but the last one of a value.
+VARINT_BITS = 7
+# Enough for every codepoint
+VARINT_MAX_BYTES = 3
+
+
+def parse_features(path: str) -> frozenset:
+    """Reads the features a client asked for from its connection path, ignoring unsupported ones."""
+    query = parse_qs(urlparse(path or '').query)
+    requested = set()
+    for value in query.get('features', []):
+        requested.update(feature.strip() for feature in value.split(','))
+    if FEATURE_ZSTD in requested:
+        requested.add(FEATURE_BINARY)
+    return frozenset(requested & SUPPORTED_FEATURES)
+
+
+def features_to_path(features) -> str:
+    if not features:
+        return '/'
+    return '/?features=' + ','.join(sorted(features))
+
+
+def message_to_codepoints(message: str) -> np.ndarray:
+    return np.frombuffer(message.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+
+
+def codepoints_to_message(codepoints: np.ndarray) -> str:
+    return codepoints.astype(np.uint32).tobytes().decode('utf-32-le')
+
+
+def codepoints_to_binary(codepoints: np.ndarray) -> bytes:
+    """
+    Packs codepoints as little-endian base 128 varints, for FEATURE_BINARY.
+    Values are packed as value + offset like in text, so control characters keep their meaning,
+    but without the surrogate range adjustment, which only exists because text can't hold surrogates.
+    """
+    values = codepoints.copy()
+    values[values >= 0xD800 + SURROGATE_RANGE_SIZE] -= SURROGATE_RANGE_SIZE
+    lengths = np.ones(len(values), dtype=np.int64)
+    for i in range(1, VARINT_MAX_BYTES):
+        lengths += values >= 1 << (VARINT_BITS * i)
+    starts = np.cumsum(lengths) - lengths
+    payload = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for i in range(VARINT_MAX_BYTES):
+        has_byte = lengths > i
+        continues = np.where(lengths[has_byte] > i + 1, 0x80, 0)
+        payload[starts[has_byte] + i] = (values[has_byte] >> (VARINT_BITS * i)) & 0x7F | continues
+    return payload.tobytes()
+
+
+def binary_to_codepoints(payload: bytes) -> np.ndarray:
+    """Unpacks the varints of a FEATURE_BINARY message into the codepoints its text form would have."""
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    codepoints = np.add.reduceat((data & 0x7F).astype(np.int64) << (VARINT_BITS * positions), starts)
+    codepoints[codepoints >= 0xD800] += SURROGATE_RANGE_SIZE
+    return codepoints
+
+
+def message_to_binary(message: str) -> bytes:
+    return codepoints_to_binary(message_to_codepoints(message))
+
+
+def decode_values(codepoints: np.ndarray, offset: int) -> np.ndarray:
+    """Reverses the offset and surrogate range adjustments made by the encoder."""
+    values = codepoints - offset
+    values[values >= 0xD800] -= SURROGATE_RANGE_SIZE
+    return values
+
+
+def encode_values(values: np.ndarray, offset: int) -> np.ndarray:
+    """Applies the offset and moves values out of the surrogate range, like the native encoder."""
+    codepoints = values + offset
+    codepoints[codepoints >= 0xD800] += SURROGATE_RANGE_SIZE
+    return codepoints
+
+
+def shift_command(row_start: int, row_count: int, dx: int, dy: int, offset: int) -> str:
+    values = np.array([row_start * 1000 + row_count, (dx + SHIFT_BIAS) * 1000 + (dy + SHIFT_BIAS)])
+    return chr(SHIFT_COMMAND) + codepoints_to_message(encode_values(values, offset))
+
+
+def split_palette_command(codepoints: np.ndarray):
+    """Splits off the palette table that leads a message, if there is one. Returns (table, rest)."""
+    if len(codepoints) == 0 or codepoints[0] != PALETTE_COMMAND:
+        return codepoints[:0], codepoints
+    end = 2 + int(np.argmax(codepoints[2:] == END_OF_COLOR))
+    return codepoints[:end + 1], codepoints[end + 1:]
+
+
+def split_row_groups(codepoints: np.ndarray) -> list:
+    """Returns (start, end) of every row group of a message body, where start is its row character and end its END_OF_ROW."""
+    ends = np.flatnonzero(codepoints == END_OF_ROW).tolist()
+    return list(zip([0] + [end + 1 for end in ends[:-1]], ends))
+
+
+def split_canvas_commands(codepoints: np.ndarray):
+    """
+    Splits off the commands that lead a message body and act on the canvas, like SHIFT_COMMAND.
+    Returns (commands, body). Transcoders pass the commands through unchanged.
+    """
+    if len(codepoints) >= 3 and codepoints[0] == SHIFT_COMMAND:
+        return codepoints[:3], codepoints[3:]
+    return codepoints[:0], codepoints
+
+
+def shift_region(canvas: np.ndarray, row_start: int, row_count: int, dx: int, dy: int):
+    """
+    Moves the pixels of rows [row_start, row_start + row_count) by dx columns and dy rows, within those rows.
+    Pixels with no source inside the region keep their value, and the residual runs of the message repaint them.
+    """
+    region = canvas[row_start:row_start + row_count]
+    height, width = region.shape[0], region.shape[1]
+    if abs(dx) >= width or abs(dy) >= height:
+        return
+    destination_rows = slice(max(dy, 0), height + min(dy, 0))
+    destination_columns = slice(max(dx, 0), width + min(dx, 0))
+    source_rows = slice(max(-dy, 0), height + min(-dy, 0))
+    source_columns = slice(max(-dx, 0), width + min(-dx, 0))
+    # numpy copies overlapping sources before assigning
+    region[destination_rows, destination_columns] = region[source_rows, source_columns]
+
+
+def classify_codepoints(codepoints: np.ndarray, color_width: int = 2):
+    """
+    Finds the role of every character of a message body.
+    Returns boolean masks (is_row, is_color, is_color_rest, is_range), where is_color marks
+    the first character of a color and is_color_rest the remaining ones.
+    """
+    length = len(codepoints)
+    is_end_of_color = codepoints == END_OF_COLOR
+    is_end_of_row = codepoints == END_OF_ROW
+
+    # A row character opens the message and follows every end of row delimiter.
+    is_row = np.zeros(length + 1, dtype=bool)
+    is_row[0] = True
+    is_row[np.flatnonzero(is_end_of_row) + 1] = True
+    is_row = is_row[:length]
+
+    # A color directly follows the row character,
+    # and follows every end of color delimiter that isn't followed by an end of row delimiter.
+    next_is_end_of_row = np.zeros(length, dtype=bool)
+    next_is_end_of_row[:-1] = is_end_of_row[1:]
+    is_color = np.zeros(length + 1, dtype=bool)
+    is_color[np.flatnonzero(is_row) + 1] = True
+    is_color[np.flatnonzero(is_end_of_color & ~next_is_end_of_row) + 1] = True
+    is_color = is_color[:length]
+    is_color_rest = np.zeros(length, dtype=bool)
+    for i in range(1, color_width):
+        is_color_rest[i:] |= is_color[:-i]
+
+    is_range = ~(is_end_of_color | is_end_of_row | is_row | is_color | is_color_rest)
+    return is_row, is_color, is_color_rest, is_range
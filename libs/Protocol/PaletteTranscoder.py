@@ -0,0 +1,71 @@
+from .FrameProtocol import *
+
+# A delta that would grow the palette past this makes the palette start over with a keyframe.
+# A keyframe always fits, however many colors it has.
+PALETTE_MAX_SIZE = 65536
+
+
+class PaletteTranscoder:
+    """
+    Rewrites messages for clients using FEATURE_PALETTE, replacing every two character color with a one character palette index.
+
+    The palette is shared by all of those clients and only grows, so a delta only carries the entries it adds,
+    while a keyframe carries the whole table. Deltas must be transcoded in frame order.
+    When the palette has to start over, epoch changes, and clients need a keyframe of the new epoch before applying deltas again.
+    """
+
+    def __init__(self, offset: int = OFFSET, max_size: int = PALETTE_MAX_SIZE):
+        self.offset = offset
+        self.max_size = max_size
+        self.epoch = 0
+        self.reset()
+
+    def reset(self):
+        # Color key -> palette index
+        self.indices = {}
+        # The two color codepoints of every entry, in palette order
+        self.entries = np.empty(0, dtype=np.int64)
+
+    def transcode(self, message: str, keyframe: bool):
+        """Returns the palette message, or None if this delta can't be sent and clients need a keyframe instead."""
+        commands, codepoints = split_canvas_commands(message_to_codepoints(message))
+        if len(codepoints) == 0:
+            return message
+
+        _, is_color, is_color_rest, _ = classify_codepoints(codepoints, color_width=2)
+        color_positions = np.flatnonzero(is_color)
+        keys = (codepoints[color_positions] << 21) | codepoints[color_positions + 1]
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        indices = np.array([self.indices.get(key, -1) for key in unique_keys.tolist()], dtype=np.int64)
+
+        missing = indices < 0
+        if keyframe and missing.any():
+            # Clients that are up to date never saw these colors, so the palette can't just grow. Start over.
+            self.reset()
+            self.epoch += 1
+            indices[:] = -1
+            missing[:] = True
+        elif not keyframe and len(self.indices) + int(missing.sum()) > self.max_size:
+            return None
+
+        start = len(self.indices)
+        new_keys = unique_keys[missing]
+        indices[missing] = np.arange(start, start + len(new_keys))
+        self.indices.update(zip(new_keys.tolist(), indices[missing].tolist()))
+        new_entries = np.stack((new_keys >> 21, new_keys & 0x1FFFFF), axis=1).reshape(-1)
+        self.entries = np.concatenate((self.entries, new_entries))
+
+        body = codepoints.copy()
+        body[color_positions] = encode_values(indices[inverse], self.offset)
+        body = np.concatenate((commands, body[~is_color_rest]))
+
+        if keyframe:
+            table_start, table_entries = 0, self.entries
+        elif len(new_keys) > 0:
+            table_start, table_entries = start, new_entries
+        else:
+            return codepoints_to_message(body)
+
+        header = np.concatenate(([PALETTE_COMMAND], encode_values(np.array([table_start]), self.offset),
+                                 table_entries, [END_OF_COLOR]))
+        return codepoints_to_message(np.concatenate((header, body)))
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from .FrameProtocol import *
+
+# Entries the server and every FEATURE_ROW_CACHE client keep. A keyframe carries all of them.
+ROW_CACHE_SIZE = 128
+# Shorter rows aren't cached, since a reference takes 2 characters and entries are also resent in keyframes.
+ROW_CACHE_MIN_LENGTH = 8
+
+
+class RowCache:
+    """
+    The most recently used row bodies (the colors and ranges of a row group, without its row character and END_OF_ROW)
+    of a FEATURE_ROW_CACHE stream, keyed by their codepoints, each in a numbered slot.
+
+    The server and its clients apply the same lookups and inserts, in message order, so both always agree on the slots.
+    Once full, an insert takes the slot of the least recently used entry.
+    """
+
+    def __init__(self, size: int = ROW_CACHE_SIZE, min_length: int = ROW_CACHE_MIN_LENGTH):
+        self.size = size
+        self.min_length = min_length
+        self.clear()
+
+    def clear(self):
+        # Body bytes -> slot, from least to most recently used
+        self.slots = OrderedDict()
+        # Slot -> body codepoints
+        self.bodies = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def is_cacheable(self, body: np.ndarray) -> bool:
+        return len(body) >= self.min_length
+
+    def find(self, body: np.ndarray, touch: bool = True):
+        """Returns the slot holding the body, or None. With touch set, the entry becomes the most recently used."""
+        key = body.tobytes()
+        slot = self.slots.get(key)
+        if slot is not None and touch:
+            self.slots.move_to_end(key)
+        return slot
+
+    def get(self, slot: int, touch: bool = True) -> np.ndarray:
+        """Returns the body in the slot. With touch set, the entry becomes the most recently used."""
+        body = self.bodies[slot]
+        if touch:
+            self.slots.move_to_end(body.tobytes())
+        return body
+
+    def add(self, body: np.ndarray) -> int:
+        """Puts a body that isn't cached yet into a free slot, or the least recently used one, and returns the slot."""
+        if len(self.slots) < self.size:
+            slot = len(self.slots)
+        else:
+            _, slot = self.slots.popitem(last=False)
+        self.slots[body.tobytes()] = slot
+        # A copy, so the entry doesn't hold on to the whole message
+        self.bodies[slot] = body.copy()
+        return slot
+
+    def entries(self) -> list:
+        """Returns (slot, body) of every entry, from least to most recently used."""
+        return [(slot, self.bodies[slot]) for slot in self.slots.values()]
+
+    def replace(self, entries: list):
+        """Replaces the cache with (slot, body) entries, given from least to most recently used."""
+        self.clear()
+        for slot, body in entries:
+            self.slots[body.tobytes()] = slot
+            self.bodies[slot] = body
@@ -0,0 +1,62 @@
+from .FrameProtocol import *
+from .RowCache import RowCache, ROW_CACHE_SIZE, ROW_CACHE_MIN_LENGTH
+
+
+class RowCacheTranscoder:
+    """
+    Rewrites messages for clients using FEATURE_ROW_CACHE. The body of a row group that is in the row cache is replaced
+    with a reference to its slot, and bodies that aren't are added to the cache.
+
+    The cache is shared by all of those clients, and deltas must be transcoded in frame order.
+    A delta updates the cache the same way clients applying it update theirs.
+    A keyframe starts with a table of the whole cache as it is after this frame's delta, and then only looks entries up,
+    so a client that applies the keyframe instead of the delta ends up with the same cache.
+    """
+
+    def __init__(self, offset: int = OFFSET, size: int = ROW_CACHE_SIZE, min_length: int = ROW_CACHE_MIN_LENGTH):
+        self.offset = offset
+        self.cache = RowCache(size=size, min_length=min_length)
+        # Epoch of the palette the color indices of the cached bodies belong to
+        self.palette_epoch = 0
+
+    def transcode(self, message: str, keyframe: bool, palette_epoch: int = 0) -> str:
+        if palette_epoch != self.palette_epoch:
+            # The palette started over, so cached bodies would paint the wrong colors. Clients get a keyframe with an empty table.
+            self.cache.clear()
+            self.palette_epoch = palette_epoch
+        if len(message) == 0:
+            return message
+
+        palette_table, codepoints = split_palette_command(message_to_codepoints(message))
+        commands, body = split_canvas_commands(codepoints)
+        parts = [palette_table]
+        if keyframe:
+            parts.append(self.encode_table())
+        parts.append(commands)
+        parts.extend(self.reference_cached_rows(body, update=not keyframe))
+        return codepoints_to_message(np.concatenate(parts))
+
+    def encode_table(self) -> np.ndarray:
+        parts = [[ROW_CACHE_COMMAND], encode_values(np.array([len(self.cache)]), self.offset)]
+        for slot, body in self.cache.entries():
+            parts.extend((encode_values(np.array([slot]), self.offset), body, [END_OF_ROW]))
+        return np.concatenate(parts)
+
+    def reference_cached_rows(self, body: np.ndarray, update: bool) -> list:
+        """Returns the parts of the body with cached rows replaced by references. With update set, the cache learns the other rows."""
+        parts = []
+        copied = 0
+        for start, end in split_row_groups(body):
+            row_body = body[start + 1:end]
+            if not self.cache.is_cacheable(row_body):
+                continue
+            slot = self.cache.find(row_body, touch=update)
+            if slot is None:
+                if update:
+                    self.cache.add(row_body)
+                continue
+            parts.append(body[copied:start + 1])
+            parts.append(np.concatenate(([ROW_REFERENCE_COMMAND], encode_values(np.array([slot]), self.offset))))
+            copied = end
+        parts.append(body[copied:])
+        return parts
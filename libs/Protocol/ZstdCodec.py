@@ -0,0 +1,55 @@
+from .FrameProtocol import ZSTD_COMMAND
+
+try:
+    import zstandard
+except ImportError:
+    # Optional. Without it, FEATURE_ZSTD clients are sent uncompressed binary messages, which they read as they are.
+    zstandard = None
+
+ZSTD_LEVEL = 3
+# Large enough for the rows and palette tables a game keeps sending, small enough to stay in cache while compressing
+ZSTD_DICTIONARY_SIZE = 65536
+
+
+def is_zstd_message(message) -> bool:
+    return isinstance(message, bytes) and message[:1] == bytes([ZSTD_COMMAND])
+
+
+def train_dictionary(messages: list, size: int = ZSTD_DICTIONARY_SIZE) -> bytes:
+    """Trains a dictionary on FEATURE_BINARY messages, e.g. from recordings of the game it will be used for."""
+    if zstandard is None:
+        raise Exception("Training a zstd dictionary needs the zstandard package: pip install zstandard")
+    return zstandard.train_dictionary(size, messages).as_bytes()
+
+
+class ZstdCodec:
+    """
+    Compresses FEATURE_BINARY messages for FEATURE_ZSTD clients, and decompresses them on the client.
+    Both ends must load the same dictionary, or none. Frames name the ID of their dictionary, so a mismatch fails to decompress
+    instead of painting garbage.
+    """
+
+    def __init__(self, dictionary_path: str = None, level: int = ZSTD_LEVEL):
+        if zstandard is None:
+            raise Exception("FEATURE_ZSTD needs the zstandard package: pip install zstandard")
+        self.dictionary = None
+        if dictionary_path is not None:
+            with open(dictionary_path, 'rb') as file:
+                self.dictionary = zstandard.ZstdCompressionDict(file.read())
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=self.dictionary)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+    @staticmethod
+    def is_available() -> bool:
+        return zstandard is not None
+
+    def compress(self, payload: bytes) -> bytes:
+        """Returns the payload as a FEATURE_ZSTD message, or the payload itself if compressing doesn't make it smaller."""
+        message = bytes([ZSTD_COMMAND]) + self.compressor.compress(payload)
+        return message if len(message) < len(payload) else payload
+
+    def decompress(self, message):
+        """Returns the FEATURE_BINARY message a FEATURE_ZSTD message holds. Other messages are returned as they are."""
+        if not is_zstd_message(message):
+            return message
+        return self.decompressor.decompress(message[1:])
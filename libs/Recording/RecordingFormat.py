@@ -0,0 +1,29 @@
+"""
+On-disk format of a recorded frame stream.
+
+A recording starts with a file header, which holds the frame size, followed by one record per frame: a record header and the frame's UTF-8 message.
+Every record is either a delta against the frame before it, or a keyframe that paints the whole canvas,
+and the recorder makes every KEYFRAME_INTERVAL-th frame a keyframe so any frame can be rebuilt from a nearby one.
+When a recording is closed, an index of (frame number, file offset) for every keyframe and a trailer pointing at it
+are appended. A recording that wasn't closed, e.g. because the server crashed, has no trailer,
+and readers rebuild the index by walking the record headers.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'NESREC\x00\x01'
+VERSION = 2
+# magic, version, keyframe interval, value offset of the messages, frame width, frame height, padding
+FILE_HEADER = struct.Struct('<8sHHHHH6x')
+# Version 1 recordings don't store the frame size, their frames are DEFAULT_FRAME_WIDTH x DEFAULT_FRAME_HEIGHT
+FILE_HEADER_V1 = struct.Struct('<8sHHH2x')
+# message length in bytes, flags, seconds since the first frame
+RECORD_HEADER = struct.Struct('<IBd')
+# index offset, keyframe count, frame count, magic
+TRAILER = struct.Struct('<QQQ8s')
+TRAILER_MAGIC = b'NESRIDX\x00'
+INDEX_ENTRY = np.dtype([('frame', '<u8'), ('offset', '<u8')])
+
+FLAG_KEYFRAME = 1
+
+KEYFRAME_INTERVAL = 60
@@ -0,0 +1,113 @@
+import mmap
+import numpy as np
+
+from libs.Helpers.GeneralHelpers import DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH
+from libs.DisplayStrategies.DisplayStrategy import update_canvas
+from libs.Recording.RecordingFormat import *
+
+
+class StreamReader:
+    """
+    Reads a recording, see RecordingFormat, through a memory map. Memory use doesn't grow with the recording's length.
+    Any frame can be rebuilt by painting from the nearest keyframe before it, and reading frames in order is O(1) per frame.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.keyframe_interval, self.offset = FILE_HEADER_V1.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} isn't a frame stream recording")
+        if version == 1:
+            self.header_size = FILE_HEADER_V1.size
+            self.width, self.height = DEFAULT_FRAME_WIDTH, DEFAULT_FRAME_HEIGHT
+        elif version == VERSION:
+            self.header_size = FILE_HEADER.size
+            self.width, self.height = FILE_HEADER.unpack_from(self.map, 0)[4:6]
+        else:
+            raise Exception(f"{path} is a version {version} recording, only versions up to {VERSION} are supported")
+
+        self.frame_count, self.keyframes = self._read_index()
+        # (frame number, file offset) of the record after the last one read, so reading in order doesn't search
+        self.cursor = (0, self.header_size)
+
+    def _read_index(self):
+        """Returns (frame count, keyframe index). Rebuilds the index from the records if the recording has no trailer."""
+        if len(self.map) >= self.header_size + TRAILER.size:
+            index_offset, keyframe_count, frame_count, magic = TRAILER.unpack_from(self.map, len(self.map) - TRAILER.size)
+            if magic == TRAILER_MAGIC:
+                keyframes = np.frombuffer(self.map, dtype=INDEX_ENTRY, count=keyframe_count, offset=index_offset)
+                return frame_count, keyframes
+
+        # Walk the record headers. A record cut off at the end is left out.
+        keyframes = []
+        frame_count = 0
+        position = self.header_size
+        while position + RECORD_HEADER.size <= len(self.map):
+            length, flags, _ = RECORD_HEADER.unpack_from(self.map, position)
+            if position + RECORD_HEADER.size + length > len(self.map):
+                break
+            if flags & FLAG_KEYFRAME:
+                keyframes.append((frame_count, position))
+            position += RECORD_HEADER.size + length
+            frame_count += 1
+        return frame_count, np.array(keyframes, dtype=INDEX_ENTRY)
+
+    def __len__(self):
+        return self.frame_count
+
+    def get_keyframe_before(self, index: int):
+        """Returns (frame number, file offset) of the last keyframe at or before the frame, or the first frame without one."""
+        position = np.searchsorted(self.keyframes['frame'], index, side='right') - 1
+        if position < 0:
+            return 0, self.header_size
+        return int(self.keyframes['frame'][position]), int(self.keyframes['offset'][position])
+
+    def _find_record(self, index: int) -> int:
+        """Returns the file offset of the frame's record."""
+        if not 0 <= index < self.frame_count:
+            raise IndexError(f"Frame {index} is out of range for a recording of {self.frame_count} frames")
+        frame, position = self.get_keyframe_before(index)
+        cursor_frame, cursor_position = self.cursor
+        if frame <= cursor_frame <= index:
+            frame, position = cursor_frame, cursor_position
+        while frame < index:
+            length, _, _ = RECORD_HEADER.unpack_from(self.map, position)
+            position += RECORD_HEADER.size + length
+            frame += 1
+        return position
+
+    def get_record(self, index: int):
+        """Returns (message, is keyframe, seconds since the first frame) of a frame."""
+        position = self._find_record(index)
+        length, flags, timestamp = RECORD_HEADER.unpack_from(self.map, position)
+        start = position + RECORD_HEADER.size
+        self.cursor = (index + 1, start + length)
+        return str(self.map[start:start + length], 'utf-8'), bool(flags & FLAG_KEYFRAME), timestamp
+
+    def get_message(self, index: int) -> str:
+        return self.get_record(index)[0]
+
+    def render(self, index: int, canvas: np.ndarray = None) -> np.ndarray:
+        """Paints the frame onto the canvas, which is cleared first, by applying the messages from the keyframe before it."""
+        if canvas is None:
+            canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        else:
+            canvas[...] = 0
+        keyframe, _ = self.get_keyframe_before(index)
+        for frame in range(keyframe, index + 1):
+            update_canvas(message=self.get_message(frame), canvas=canvas, offset=self.offset)
+        return canvas
+
+    def close(self):
+        # The index may be a view of the map
+        self.keyframes = None
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,78 @@
+import time
+import numpy as np
+
+from libs.Helpers.GeneralHelpers import OFFSET, DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH
+from libs.Recording.RecordingFormat import *
+
+
+class StreamRecorder:
+    """
+    Appends frame messages to a recording, see RecordingFormat.
+    Only the keyframe index is kept in memory, so a recording can go on for hours.
+    """
+
+    # Records are written through a buffer of this many bytes
+    BUFFER_SIZE: int = 1024 * 1024
+
+    def __init__(self, path: str, keyframe_interval: int = KEYFRAME_INTERVAL, offset: int = OFFSET,
+                 width: int = DEFAULT_FRAME_WIDTH, height: int = DEFAULT_FRAME_HEIGHT):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.offset = offset
+        self.file = open(path, 'wb', buffering=self.BUFFER_SIZE)
+        self.frame_count = 0
+        self.set_frame_size(width, height)
+        self.position = FILE_HEADER.size
+        self.frames_since_keyframe = 0
+        self.start_time = None
+        # (frame number, file offset) of every keyframe
+        self.keyframes = []
+
+    def set_frame_size(self, width: int, height: int):
+        """Writes the file header for frames of this size. Only possible before the first frame."""
+        if self.frame_count > 0:
+            raise Exception("The frame size of a recording can't change after its first frame")
+        self.width = width
+        self.height = height
+        self.file.seek(0)
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, self.keyframe_interval, self.offset, width, height))
+
+    def is_keyframe_due(self) -> bool:
+        """Whether the next frame should be recorded as a keyframe. The first frame always is."""
+        return self.frame_count == 0 or self.frames_since_keyframe + 1 >= self.keyframe_interval
+
+    def write(self, message: str, keyframe: bool, capture_time: float = None):
+        if self.frame_count == 0 and not keyframe:
+            raise Exception("A recording must start with a keyframe")
+        capture_time = time.monotonic() if capture_time is None else capture_time
+        if self.start_time is None:
+            self.start_time = capture_time
+
+        payload = message.encode('utf-8')
+        if keyframe:
+            self.keyframes.append((self.frame_count, self.position))
+            self.frames_since_keyframe = 0
+        else:
+            self.frames_since_keyframe += 1
+        self.file.write(RECORD_HEADER.pack(len(payload), FLAG_KEYFRAME if keyframe else 0, capture_time - self.start_time))
+        self.file.write(payload)
+        self.position += RECORD_HEADER.size + len(payload)
+        self.frame_count += 1
+
+    def close(self):
+        """Appends the keyframe index and the trailer."""
+        index = np.array(self.keyframes, dtype=INDEX_ENTRY)
+        self.file.write(index.tobytes())
+        self.file.write(TRAILER.pack(self.position, len(index), self.frame_count, TRAILER_MAGIC))
+        self.file.close()
+
+
+def record_messages(messages: list, path: str, offset: int = OFFSET):
+    """
+    Writes a list of messages, e.g. ones saved with save_json_file, as a recording.
+    The first message is taken as a keyframe, and the rest as deltas.
+    """
+    recorder = StreamRecorder(path, offset=offset)
+    for i, message in enumerate(messages):
+        recorder.write(message, keyframe=i == 0, capture_time=float(i))
+    recorder.close()
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+from nes_py import NESEnv
+
+from libs.Helpers.FrameScheduler import FrameScheduler, NES_FRAME_RATE
+from libs.Sessions.SharedFrameRing import SharedFrameRing, NES_FRAME_SHAPE
+
+logger = logging.getLogger(__name__)
+
+
+async def emulate(emulator: NESEnv, frame_ring: SharedFrameRing, stop_event, render_rate: float):
+    emulator.reset()
+    scheduler = FrameScheduler(render_rate=render_rate, publish_rate=render_rate)
+    while not stop_event.is_set():
+        await scheduler.wait_for_next_frame()
+        state, _, done, _ = emulator.step(action=frame_ring.get_action())
+        # The emulator's screen is a BGRx buffer of its own, so converting it to RGB is the one copy,
+        # which goes straight into a slot of the ring.
+        frame_ring.write(state)
+        if done:
+            # A session keeps running until it's stopped, so start the game over
+            emulator.reset()
+
+
+def run_emulator(rom_path: str, frame_ring_name: str, frame_ring_lock, slot_count: int, stop_event,
+                 render_rate: float = NES_FRAME_RATE):
+    """
+    Target of a session's worker process.
+    Steps the ROM at render_rate with the action in the frame ring, and writes every frame into it until stop_event is set.
+    """
+    frame_ring = SharedFrameRing(frame_ring_lock, NES_FRAME_SHAPE, slot_count=slot_count, name=frame_ring_name)
+    emulator = NESEnv(rom_path)
+    try:
+        asyncio.run(emulate(emulator, frame_ring, stop_event, render_rate))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+        frame_ring.close()
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from libs.Helpers.FrameScheduler import FrameScheduler
+from libs.Sessions.EmulatorWorker import run_emulator
+from libs.Sessions.SharedFrameRing import SharedFrameRing, NES_FRAME_SHAPE
+from libs.Websockets.ControllerWebsocket import ControllerWebsocket
+from libs.Websockets.FrameWebsocket import FrameWebsocket
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    One emulator running in its own worker process, with its own controller and frame clients.
+    The worker writes frames into a SharedFrameRing, and the session encodes and broadcasts them from the front end's event loop,
+    reading them straight from the ring's shared memory. Controller actions go the other way through the same shared memory.
+    """
+
+    PUBLISH_FRAME_RATE: float = 45.0
+    FRAME_RING_SLOTS: int = SharedFrameRing.MIN_SLOT_COUNT
+    # Seconds between keyframes sent to every client, like NESGameServer's full_frame_interval
+    FULL_FRAME_INTERVAL: float = 30.0
+    # Seconds to wait for the worker to exit after asking it to stop, before terminating it
+    STOP_TIMEOUT: float = 5.0
+
+    def __init__(self, session_id: str, rom_path: str, host: str, rectangles: bool = True):
+        self.session_id = session_id
+        self.rom_path = rom_path
+        # Connections are handed over by the SessionManager, so these never start servers of their own.
+        self.controller = ControllerWebsocket(host, None, on_action=self.set_action)
+        self.frame = FrameWebsocket(host, None, rectangles=rectangles)
+        self.controller_websockets = set()
+        # When the last client left, or when the session started
+        self.idle_since = time.monotonic()
+
+        self.frame_ring = None
+        self.stop_event = None
+        self.process = None
+        self.publish_task = None
+        self.last_full_frame_time = time.time()
+
+    @property
+    def client_count(self) -> int:
+        return len(self.frame.frame_websockets) + len(self.controller_websockets)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, context):
+        """Starts the worker process from a multiprocessing context, and publishing its frames."""
+        self.frame_ring = SharedFrameRing(context.Lock(), NES_FRAME_SHAPE, slot_count=self.FRAME_RING_SLOTS)
+        self.stop_event = context.Event()
+        self.process = context.Process(target=run_emulator,
+                                       args=(self.rom_path, self.frame_ring.name, self.frame_ring.lock,
+                                             self.FRAME_RING_SLOTS, self.stop_event),
+                                       name=f"Session-{self.session_id}", daemon=True)
+        self.process.start()
+        self.publish_task = asyncio.create_task(self.publish_frames())
+        logger.info(f"Session {self.session_id} started with {self.rom_path} in process {self.process.pid}")
+
+    async def stop(self):
+        self.stop_event.set()
+        self.publish_task.cancel()
+        await asyncio.gather(self.publish_task, return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.process.join, self.STOP_TIMEOUT)
+        if self.process.is_alive():
+            logger.error(f"Session {self.session_id} didn't stop, terminating it")
+            self.process.terminate()
+            await loop.run_in_executor(None, self.process.join)
+
+        # Closed before the ring, so no client can reach it once it's gone
+        for websocket in list(self.frame.frame_websockets) + list(self.controller_websockets):
+            await websocket.close()
+        self.frame.encoder_executor.shutdown(wait=True)
+        # Drop the encoder's reference into the ring before closing it
+        self.frame.previous_frame = None
+        self.frame_ring.close()
+        logger.info(f"Session {self.session_id} stopped")
+
+    def set_action(self, action: int):
+        # A controller may still send a press while the session is stopping
+        if not self.stop_event.is_set():
+            self.frame_ring.set_action(action)
+
+    async def handle_frame_connection(self, websocket, path: str):
+        try:
+            await self.frame.handle_connection(websocket, path)
+        finally:
+            self.idle_since = time.monotonic()
+
+    async def handle_controller_connection(self, websocket, path: str):
+        self.controller_websockets.add(websocket)
+        try:
+            await self.controller.handle_connection(websocket, path)
+        finally:
+            self.controller_websockets.discard(websocket)
+            self.idle_since = time.monotonic()
+
+    async def publish_frames(self):
+        scheduler = FrameScheduler(render_rate=self.PUBLISH_FRAME_RATE, publish_rate=self.PUBLISH_FRAME_RATE)
+        last_sequence = 0
+        # Slots of the frames the encoder still uses: the newest, and the one its delta was encoded against
+        pinned_slots = deque()
+        while True:
+            await scheduler.wait_for_next_frame()
+            if self.frame_ring.latest_sequence == last_sequence:
+                # The worker hasn't rendered anything new, e.g. while it's starting
+                continue
+            slot, frame, last_sequence = self.frame_ring.acquire_latest()
+            pinned_slots.append(slot)
+
+            kept_slots = 1
+            try:
+                # Encoded without copying the frame out of shared memory
+                keyframe = time.time() - self.last_full_frame_time >= self.FULL_FRAME_INTERVAL
+                encoded_frame = await self.frame.encode_frame_async(frame, keyframe=keyframe, capture_time=time.monotonic())
+                if keyframe:
+                    self.last_full_frame_time = time.time()
+                # Returns once every client's message was prepared, which is the last use of the previous frame
+                await self.frame.broadcast(encoded_frame)
+            except Exception as e:
+                logger.error(f"Session {self.session_id} couldn't publish a frame: {e}")
+                # It's unknown which frame the encoder got to, so drop them all and continue with a keyframe
+                self.frame.previous_frame = None
+                kept_slots = 0
+            finally:
+                while len(pinned_slots) > kept_slots:
+                    self.frame_ring.release(pinned_slots.popleft())
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+import time
+import websockets
+from urllib.parse import urlparse, parse_qs
+
+from libs.Sessions.Session import Session
+from libs.Websockets.BaseWebsocket import get_request_path
+from libs.Websockets.FramedMessage import deflate_extensions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_ID = 'default'
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def parse_session_path(path: str):
+    """
+    Reads (session ID, ROM file name) from a connection path like /flappy?rom=flappy.nes&features=shift.
+    The session ID is the first path segment, or DEFAULT_SESSION_ID without one. Returns None for an invalid ID.
+    The ROM is None when the path doesn't pick one.
+    """
+    parsed = urlparse(path or '')
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    session_id = segments[0] if segments else DEFAULT_SESSION_ID
+    if not SESSION_ID_PATTERN.match(session_id):
+        return None
+    roms = parse_qs(parsed.query).get('rom')
+    return session_id, (roms[0] if roms else None)
+
+
+class SessionManager:
+    """
+    Runs an emulator session per session ID, each in its own worker process, behind one controller and one frame endpoint.
+    Clients pick a session with the first segment of their connection path, e.g. ws://localhost:9001/flappy?features=shift,
+    and the client starting a session can pick its ROM from the ROM directory with ?rom=flappy.nes.
+    Sessions start when their first client connects, and stop after they've had no clients for IDLE_TIMEOUT seconds.
+    """
+
+    IDLE_TIMEOUT: float = 30.0
+    MONITOR_INTERVAL: float = 1.0
+    # Every session needs a core for its emulator, plus some time on the front end's encoder threads
+    MAX_SESSIONS: int = max(1, (os.cpu_count() or 2) - 1)
+    RECTANGLE_ENCODING: bool = True
+
+    def __init__(self, host: str, controller_port: int, frame_port: int, rom_directory: str, default_rom: str):
+        self.host = host
+        self.controller_port = controller_port
+        self.frame_port = frame_port
+        self.rom_directory = os.path.abspath(rom_directory)
+        self.default_rom = default_rom
+        # session ID -> Session
+        self.sessions = {}
+        self.servers = []
+        # Workers are spawned rather than forked, since the front end already runs threads
+        self.context = multiprocessing.get_context('spawn')
+
+    def get_rom_path(self, rom: str):
+        """Returns the path of a ROM in the ROM directory, or None if there is no such ROM."""
+        # Only file names are accepted, so clients can't reach outside the ROM directory
+        rom_path = os.path.join(self.rom_directory, os.path.basename(rom or self.default_rom))
+        return rom_path if os.path.isfile(rom_path) else None
+
+    def get_session(self, path: str):
+        """Returns the session a connection path addresses, starting it if needed, or None if it can't be started."""
+        parsed = parse_session_path(path)
+        if parsed is None:
+            return None
+        session_id, rom = parsed
+        session = self.sessions.get(session_id)
+        if session is not None:
+            return session
+
+        if len(self.sessions) >= self.MAX_SESSIONS:
+            logger.error(f"Can't start session {session_id}, {self.MAX_SESSIONS} sessions are already running")
+            return None
+        rom_path = self.get_rom_path(rom)
+        if rom_path is None:
+            logger.error(f"Can't start session {session_id}, ROM {rom} wasn't found in {self.rom_directory}")
+            return None
+        session = Session(session_id, rom_path, self.host, rectangles=self.RECTANGLE_ENCODING)
+        session.start(self.context)
+        self.sessions[session_id] = session
+        return session
+
+    async def handle_frame_connection(self, websocket, path=None):
+        path = get_request_path(websocket, path)
+        session = self.get_session(path)
+        if session is None:
+            await websocket.close(code=1008, reason="No such session")
+            return
+        await session.handle_frame_connection(websocket, path)
+
+    async def handle_controller_connection(self, websocket, path=None):
+        path = get_request_path(websocket, path)
+        session = self.get_session(path)
+        if session is None:
+            await websocket.close(code=1008, reason="No such session")
+            return
+        await session.handle_controller_connection(websocket, path)
+
+    async def start(self):
+        """Starts both endpoints. Ports given as 0 are replaced by the ones the system picked."""
+        controller_server = await websockets.serve(self.handle_controller_connection, self.host, self.controller_port)
+        # Every session's FrameWebsocket compresses each message once for all of its permessage-deflate clients
+        frame_server = await websockets.serve(self.handle_frame_connection, self.host, self.frame_port,
+                                              compression=None, extensions=deflate_extensions())
+        self.servers = [controller_server, frame_server]
+        self.controller_port = controller_server.sockets[0].getsockname()[1]
+        self.frame_port = frame_server.sockets[0].getsockname()[1]
+        logger.info(f"Sessions served at ws://{self.host}:{self.controller_port}/<session> for controllers "
+                    f"and ws://{self.host}:{self.frame_port}/<session> for frames")
+
+    async def stop_session(self, session_id: str):
+        # Removed first, so a client connecting meanwhile starts a new session instead of joining this one
+        session = self.sessions.pop(session_id)
+        await session.stop()
+
+    async def monitor_sessions(self):
+        """Stops sessions that have been idle for IDLE_TIMEOUT seconds, and ones whose worker exited."""
+        while True:
+            await asyncio.sleep(self.MONITOR_INTERVAL)
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if not session.is_alive():
+                    logger.error(f"Session {session_id}'s worker exited with code {session.process.exitcode}")
+                    await self.stop_session(session_id)
+                elif session.client_count == 0 and now - session.idle_since >= self.IDLE_TIMEOUT:
+                    logger.info(f"Session {session_id} has been idle for {self.IDLE_TIMEOUT} seconds")
+                    await self.stop_session(session_id)
+
+    async def close(self):
+        for session_id in list(self.sessions):
+            await self.stop_session(session_id)
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+    async def main(self):
+        await self.start()
+        try:
+            await self.monitor_sessions()
+        finally:
+            await self.close()
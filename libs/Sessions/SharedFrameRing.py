@@ -0,0 +1,144 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+from libs.Helpers.GeneralHelpers import DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH
+
+NES_FRAME_SHAPE = (DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3)
+
+
+class SharedFrameRing:
+    """
+    A ring of frame slots in shared memory, written by an emulator process and read by the front end,
+    plus the controller action going the other way.
+
+    Every slot carries the sequence number of the frame in it, 0 while empty and WRITING while it's being written.
+    The writer fills slots in place and round robin, skipping the newest frame and any slot a reader has pinned.
+    A reader pins the newest frame and uses it straight from shared memory, e.g. through FrameToString's Array3D pointers,
+    until it releases it. Readers may pin up to slot_count - 2 slots, so the writer always has one to fill.
+    All slot bookkeeping happens under a lock shared by both processes, which makes the sequences and pins consistent.
+    """
+
+    # Indices of the int64 header fields
+    LATEST_SEQUENCE = 0
+    LATEST_SLOT = 1
+    ACTION = 2
+    HEADER_FIELDS = 8
+
+    WRITING = -1
+    # The one being written, the newest, and two a reader needs for a delta: the frame and the one it's encoded against
+    MIN_SLOT_COUNT = 4
+    # Frames start on a cache line
+    ALIGNMENT = 64
+
+    def __init__(self, lock, shape: tuple = NES_FRAME_SHAPE, slot_count: int = MIN_SLOT_COUNT, name: str = None):
+        """
+        Creates the shared memory, or attaches to the existing block called name.
+        lock is a multiprocessing lock, which every process using the ring must share.
+        """
+        if slot_count < self.MIN_SLOT_COUNT:
+            raise Exception(f"A frame ring needs at least {self.MIN_SLOT_COUNT} slots, not {slot_count}")
+        self.lock = lock
+        self.shape = tuple(shape)
+        self.slot_count = slot_count
+        self.owner = name is None
+
+        fields = self.HEADER_FIELDS + 2 * slot_count
+        frames_offset = -(-fields * 8 // self.ALIGNMENT) * self.ALIGNMENT
+        frame_size = -(-int(np.prod(self.shape)) // self.ALIGNMENT) * self.ALIGNMENT
+        size = frames_offset + slot_count * frame_size
+        self.shared_memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+
+        fields = np.ndarray((fields,), dtype=np.int64, buffer=self.shared_memory.buf)
+        self.header = fields[:self.HEADER_FIELDS]
+        self.slot_sequences = fields[self.HEADER_FIELDS:self.HEADER_FIELDS + slot_count]
+        self.slot_pins = fields[self.HEADER_FIELDS + slot_count:]
+        self.frames = [np.ndarray(self.shape, dtype=np.uint8, buffer=self.shared_memory.buf,
+                                  offset=frames_offset + slot * frame_size) for slot in range(slot_count)]
+        if self.owner:
+            fields[:] = 0
+            self.header[self.LATEST_SLOT] = -1
+        # Slot of the frame being written, or last written, by this process
+        self.write_slot = -1
+
+    @property
+    def name(self) -> str:
+        return self.shared_memory.name
+
+    @property
+    def latest_sequence(self) -> int:
+        """Sequence number of the newest complete frame, or 0 if nothing was written yet."""
+        return int(self.header[self.LATEST_SEQUENCE])
+
+    def begin_write(self) -> np.ndarray:
+        """Returns the slot to write the next frame into, which readers won't see until end_write."""
+        with self.lock:
+            latest_slot = self.header[self.LATEST_SLOT]
+            for step in range(1, self.slot_count + 1):
+                slot = (self.write_slot + step) % self.slot_count
+                if slot != latest_slot and self.slot_pins[slot] == 0:
+                    break
+            else:
+                raise Exception("Every slot of the frame ring is in use")
+            self.slot_sequences[slot] = self.WRITING
+        self.write_slot = slot
+        return self.frames[slot]
+
+    def end_write(self):
+        """Publishes the slot returned by begin_write as the newest frame."""
+        with self.lock:
+            sequence = self.header[self.LATEST_SEQUENCE] + 1
+            self.slot_sequences[self.write_slot] = sequence
+            self.header[self.LATEST_SLOT] = self.write_slot
+            self.header[self.LATEST_SEQUENCE] = sequence
+
+    def write(self, frame: np.ndarray):
+        np.copyto(self.begin_write(), frame)
+        self.end_write()
+
+    def acquire_latest(self):
+        """
+        Pins the newest complete frame and returns (slot, frame, sequence), or None if nothing was written yet.
+        frame is a view of the shared memory, which stays unchanged until release(slot).
+        """
+        with self.lock:
+            slot = int(self.header[self.LATEST_SLOT])
+            if slot < 0:
+                return None
+            if self.slot_pins[slot] == 0 and np.count_nonzero(self.slot_pins) >= self.slot_count - 2:
+                raise Exception(f"Readers can't pin more than {self.slot_count - 2} slots of the frame ring")
+            self.slot_pins[slot] += 1
+            return slot, self.frames[slot], int(self.slot_sequences[slot])
+
+    def release(self, slot: int):
+        with self.lock:
+            self.slot_pins[slot] -= 1
+
+    def read(self, out: np.ndarray = None):
+        """Copies the newest complete frame. Returns (frame, sequence), or (None, 0) if nothing was written yet."""
+        acquired = self.acquire_latest()
+        if acquired is None:
+            return None, 0
+        slot, frame, sequence = acquired
+        try:
+            if out is None:
+                return frame.copy(), sequence
+            np.copyto(out, frame)
+            return out, sequence
+        finally:
+            self.release(slot)
+
+    def set_action(self, action: int):
+        self.header[self.ACTION] = action
+
+    def get_action(self) -> int:
+        return int(self.header[self.ACTION])
+
+    def close(self):
+        # The arrays point into the shared memory, which can't be closed while they exist
+        self.header = None
+        self.slot_sequences = None
+        self.slot_pins = None
+        self.frames = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
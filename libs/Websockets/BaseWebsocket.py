@@ -5,6 +5,14 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+
+def get_request_path(websocket, path: str = None) -> str:
+    """The path a connection was opened with. Newer websockets versions no longer pass it to the handler."""
+    if path is None and getattr(websocket, 'request', None) is not None:
+        return websocket.request.path
+    return path
+
+
 class BaseWebsocket:
 
     def __init__(self, host, port):
@@ -12,9 +20,13 @@ class BaseWebsocket:
         self.port = port
 
     async def start(self):
-        server = await websockets.serve(self.handle_connection, self.host, self.port)
+        server = await websockets.serve(self.handle_connection, self.host, self.port, **self.get_serve_options())
         logger.info(f"{self.__class__.__name__} WebSocket server started at ws://{self.host}:{self.port}")
         await server.wait_closed()
 
+    def get_serve_options(self) -> dict:
+        """Keyword arguments for websockets.serve, like the extensions to offer."""
+        return {}
+
     async def handle_connection(self, websocket, path):
         raise NotImplementedError
\ No newline at end of file
@@ -15,16 +15,20 @@ class ControllerWebsocket(BaseWebsocket):
         'right': 128,
     }
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, on_action=None):
         super().__init__(host, port)
         self.current_action = 0
+        # Called with the new action after every message, e.g. to hand it to an emulator in another process
+        self.on_action = on_action
 
-    async def handle_connection(self, websocket, path):
+    async def handle_connection(self, websocket, path=None):
         logger.info("Controller WebSocket connection established")
         async for message in websocket:
-            logger.info(f"Received message: {message}")
+            logger.debug("Received message: %s", message)
             if message == "release":
                 self.current_action = 0
             else:
                 self.current_action = self.BUTTON_MAP.get(message, self.current_action)
+            if self.on_action is not None:
+                self.on_action(self.current_action)
 
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+class EncodedFrame:
+    """
+    A published frame. message is a delta against previous_frame, the frame with the previous sequence number,
+    unless is_keyframe is set. A keyframe message for clients that missed
+    that previous frame is encoded on demand and kept in keyframe_message.
+    """
+
+    def __init__(self, sequence: int, frame: np.ndarray, message: str, is_keyframe: bool, previous_frame: np.ndarray = None,
+                 message_size: int = None, capture_time: float = None, encode_time: float = None):
+        self.sequence = sequence
+        self.frame = frame
+        self.message = message
+        self.is_keyframe = is_keyframe
+        self.previous_frame = previous_frame
+        # UTF-8 size of message in bytes
+        self.message_size = len(message.encode('utf-8')) if message_size is None else message_size
+        # time.monotonic() when the frame was rendered, if known
+        self.capture_time = capture_time
+        # Seconds the encoder took for message, if known
+        self.encode_time = encode_time
+        self.keyframe_message = message if is_keyframe else None
+        # (features, keyframe) -> (FramedMessage, epoch), for clients with that set of optional features.
+        # The value is None if that delta can't be sent.
+        self.variant_messages = {}
+        # The delta for FEATURE_SHIFT clients, encoded on demand
+        self.shift_message = None
@@ -0,0 +1,47 @@
+import time
+
+
+class FrameClient:
+    """Per-connection state of a frame websocket client."""
+
+    def __init__(self, websocket, features: frozenset = frozenset(), deflate_window_bits: int = None):
+        self.websocket = websocket
+        # Optional protocol features negotiated through the connection path
+        self.features = features
+        # Window size of the permessage-deflate compression negotiated for the connection, or None without it
+        self.deflate_window_bits = deflate_window_bits
+        # Sequence number of the last frame handed to the connection, which the client will have once it's sent.
+        # -1 until it has received a keyframe, or after a frame was dropped.
+        self.last_sequence = -1
+        # Epoch of the feature state (e.g. the palette) the last delivered frame was encoded with
+        self.epoch = 0
+        # Mailbox of depth 1: the newest (sequence, message, epoch) waiting to be sent, or None
+        self.pending_delivery = None
+        # time.monotonic() when the pending delivery was posted, for measuring send latency
+        self.posted_time = None
+        # Task sending this client's pending deliveries, while there are any
+        self.sender_task = None
+
+    def is_up_to_date_for(self, sequence: int, epoch: int = 0) -> bool:
+        """Whether a delta against the frame before `sequence`, encoded in `epoch`, can be applied by this client."""
+        return self.last_sequence == sequence - 1 and self.epoch == epoch
+
+    def drop_pending_delivery(self) -> bool:
+        """Drops an unsent delivery. The client then needs a keyframe, since later deltas build on the dropped frame."""
+        if self.pending_delivery is None:
+            return False
+        self.pending_delivery = None
+        self.last_sequence = -1
+        return True
+
+    def post(self, sequence: int, message, epoch: int):
+        self.pending_delivery = (sequence, message, epoch)
+        self.posted_time = time.monotonic()
+
+    def take_pending_delivery(self):
+        """Returns the pending delivery and records it as delivered, or None if there is nothing to send."""
+        delivery = self.pending_delivery
+        if delivery is not None:
+            self.pending_delivery = None
+            self.last_sequence, _, self.epoch = delivery
+        return delivery
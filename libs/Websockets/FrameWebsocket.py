@@ -1,20 +1,73 @@
 import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from libs.Websockets.BaseWebsocket import *
+from libs.Websockets.EncodedFrame import EncodedFrame
+from libs.Websockets.FrameClient import FrameClient
+from libs.Websockets.FramedMessage import FramedMessage, DEFLATE_LEVEL, DEFLATE_WINDOW_BITS, deflate_extensions, \
+    get_deflate_window_bits
 from libs.CtypesLibs.CPPFrameToString import FrameToString
+from libs.Protocol.FrameProtocol import FEATURE_BINARY, FEATURE_PALETTE, FEATURE_ROW_CACHE, FEATURE_SHIFT, FEATURE_ZSTD, \
+    parse_features, shift_command, shift_region, message_to_binary
+from libs.Protocol.PaletteTranscoder import PaletteTranscoder
+from libs.Protocol.RowCacheTranscoder import RowCacheTranscoder
+from libs.Protocol.ZstdCodec import ZstdCodec, is_zstd_message
+from libs.Recording.StreamRecorder import StreamRecorder
+from libs.Recording.RecordingFormat import KEYFRAME_INTERVAL
+from libs.Helpers.GeneralHelpers import OFFSET
+from libs.Helpers.Metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
 class FrameWebsocket(BaseWebsocket):
+    # Scrolling by up to this many pixels per frame is sent to FEATURE_SHIFT clients as a shift command
+    MAX_SHIFT: int = 8
+    # Deltas shorter than this are sent as they are, without looking for a shift
+    SHIFT_MIN_MESSAGE_LENGTH: int = 256
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, rectangles: bool = False, encoder_threads: int = 1, metrics: Metrics = None,
+                 deflate: bool = True, deflate_window_bits: int = DEFLATE_WINDOW_BITS, deflate_level: int = DEFLATE_LEVEL,
+                 zstd_dictionary_path: str = None):
         super().__init__(host, port)
-        self.frame_websockets = set()
+        self.metrics = Metrics() if metrics is None else metrics
+        # websocket -> FrameClient
+        self.frame_websockets = {}
         self.previous_frame = None
-        self.cpp_frame_to_string = FrameToString()
+        self.message_size = 0
+        self.sequence = -1
+        self.cpp_frame_to_string = FrameToString(rectangles=rectangles, thread_count=encoder_threads)
+        # features -> PaletteTranscoder. Every set of features sends different deltas, so each needs its own palette.
+        self.palette_transcoders = {}
+        # features -> RowCacheTranscoder, for the same reason
+        self.row_cache_transcoders = {}
+        # All encoding and transcoding runs on this one thread, in submission order.
+        # This keeps the blocking native calls off the event loop, and the encoder state is never used concurrently.
+        self.encoder_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='FrameEncoder')
+        # Records every broadcast frame while set, see start_recording
+        self.recorder = None
+        # The clients' send backlog since the last pop_delivery_stats
+        self.max_send_latency = 0.0
+        self.dropped_deliveries = 0
+        # Offer permessage-deflate, which every client library can read. Each message is compressed once, see FramedMessage.
+        self.deflate = deflate
+        self.deflate_window_bits = deflate_window_bits
+        self.deflate_level = deflate_level
+        # Compresses messages for FEATURE_ZSTD clients. Without the zstandard package they're sent uncompressed.
+        self.zstd_codec = ZstdCodec(zstd_dictionary_path) if ZstdCodec.is_available() else None
+        if self.zstd_codec is None and zstd_dictionary_path is not None:
+            logger.warning("zstandard isn't installed, so FEATURE_ZSTD clients are sent uncompressed messages")
+
+    def get_serve_options(self) -> dict:
+        if not self.deflate:
+            return {'compression': None}
+        return {'compression': None, 'extensions': deflate_extensions(self.deflate_window_bits, self.deflate_level)}
 
     def _frame_to_string_common(self, current_frame, previous_frame) -> str:
-        message = self.cpp_frame_to_string.get_string(current_frame, previous_frame)
+        view = self.cpp_frame_to_string.get_view(current_frame, previous_frame)
+        # UTF-8 size of the message, before it's decoded into a str
+        self.message_size = view.nbytes
+        message = str(view, 'utf-8')
         self.previous_frame = current_frame
         return message
 
@@ -26,35 +79,224 @@ class FrameWebsocket(BaseWebsocket):
         message = self._frame_to_string_common(current_frame, previous_frame=self.previous_frame)
         return message
 
-    async def broadcast(self, message):
-        message_size_bytes = len(message)
-        logger.info(f"Message size: {message_size_bytes} chars")
+    def encode_frame(self, current_frame, keyframe: bool = False, capture_time: float = None) -> EncodedFrame:
+        # A delta can only be encoded against a frame of the same size
+        is_keyframe = keyframe or self.previous_frame is None or self.previous_frame.shape != current_frame.shape
+        previous_frame = None if is_keyframe else self.previous_frame
+        start_time = time.perf_counter()
+        message = self.full_frame_to_string(current_frame) if is_keyframe else self.frame_to_string(current_frame)
+        encode_time = time.perf_counter() - start_time
+        self.metrics.record('encode_ms', encode_time * 1000)
+        if is_keyframe:
+            self.metrics.increment('keyframes')
+        self.sequence += 1
+        return EncodedFrame(sequence=self.sequence, frame=current_frame, message=message, is_keyframe=is_keyframe,
+                            previous_frame=previous_frame, message_size=self.message_size, capture_time=capture_time,
+                            encode_time=encode_time)
+
+    async def encode_frame_async(self, current_frame, keyframe: bool = False, capture_time: float = None) -> EncodedFrame:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.encoder_executor, self.encode_frame, current_frame, keyframe, capture_time)
+
+    def get_keyframe_message(self, encoded_frame: EncodedFrame) -> str:
+        if encoded_frame.keyframe_message is None:
+            encoded_frame.keyframe_message = self.cpp_frame_to_string.get_string(encoded_frame.frame, None)
+        return encoded_frame.keyframe_message
+
+    def get_shift_message(self, encoded_frame: EncodedFrame) -> str:
+        """Returns the delta for FEATURE_SHIFT clients: a shift command for scrolled rows, then the runs that still differ."""
+        if encoded_frame.shift_message is None:
+            encoded_frame.shift_message = encoded_frame.message
+            if len(encoded_frame.message) >= self.SHIFT_MIN_MESSAGE_LENGTH:
+                shift = self.cpp_frame_to_string.get_shift(encoded_frame.frame, encoded_frame.previous_frame, self.MAX_SHIFT)
+                if shift is not None:
+                    # The residual is encoded against what the client will have after applying the shift.
+                    reference_frame = encoded_frame.previous_frame.copy()
+                    shift_region(reference_frame, *shift)
+                    message = (shift_command(*shift, offset=OFFSET) +
+                               self.cpp_frame_to_string.get_string(encoded_frame.frame, reference_frame))
+                    if len(message) < len(encoded_frame.message):
+                        encoded_frame.shift_message = message
+        return encoded_frame.shift_message
+
+    def get_palette_transcoder(self, features: frozenset) -> PaletteTranscoder:
+        if features not in self.palette_transcoders:
+            self.palette_transcoders[features] = PaletteTranscoder()
+        return self.palette_transcoders[features]
+
+    def get_row_cache_transcoder(self, features: frozenset) -> RowCacheTranscoder:
+        if features not in self.row_cache_transcoders:
+            self.row_cache_transcoders[features] = RowCacheTranscoder()
+        return self.row_cache_transcoders[features]
 
-        if message_size_bytes == 0:
+    def get_epoch(self, features: frozenset) -> int:
+        return self.get_palette_transcoder(features).epoch if FEATURE_PALETTE in features else 0
+
+    def get_variant_message(self, features: frozenset, encoded_frame: EncodedFrame, keyframe: bool):
+        """Returns (FramedMessage, epoch) for clients with these features, or None if the delta can't be sent."""
+        keyframe = keyframe or encoded_frame.is_keyframe
+        key = (features, keyframe)
+        if key not in encoded_frame.variant_messages:
+            if keyframe:
+                message = self.get_keyframe_message(encoded_frame)
+            elif FEATURE_SHIFT in features:
+                message = self.get_shift_message(encoded_frame)
+            else:
+                message = encoded_frame.message
+            if FEATURE_PALETTE in features:
+                message = self.get_palette_transcoder(features).transcode(message, keyframe=keyframe)
+            if message is not None and FEATURE_ROW_CACHE in features:
+                message = self.get_row_cache_transcoder(features).transcode(message, keyframe=keyframe,
+                                                                            palette_epoch=self.get_epoch(features))
+            if message is not None and FEATURE_BINARY in features:
+                message = message_to_binary(message)
+            if message and FEATURE_ZSTD in features and self.zstd_codec is not None:
+                message = self.compress_zstd(message)
+            # Encoded and framed here once, however many clients it's sent to
+            encoded_frame.variant_messages[key] = None if message is None else (FramedMessage(message), self.get_epoch(features))
+        return encoded_frame.variant_messages[key]
+
+    def compress_zstd(self, payload: bytes) -> bytes:
+        start_time = time.perf_counter()
+        message = self.zstd_codec.compress(payload)
+        self.metrics.record('zstd_ms', (time.perf_counter() - start_time) * 1000)
+        self.metrics.record('zstd_ratio', len(message) / len(payload))
+        return message
+
+    def prepare_deflate(self, message: FramedMessage, window_bits: int):
+        """Compresses the message for permessage-deflate clients with this window size, unless it already was."""
+        if len(message) == 0 or window_bits in message.deflate_frames or is_zstd_message(message.message):
+            # zstd messages don't get any smaller
             return
+        start_time = time.perf_counter()
+        size = message.deflate(window_bits, self.deflate_level)
+        self.metrics.record('deflate_ms', (time.perf_counter() - start_time) * 1000)
+        self.metrics.record('deflate_ratio', size / len(message.payload))
+
+    def get_message(self, client: FrameClient, encoded_frame: EncodedFrame):
+        """Returns (FramedMessage, epoch) to send to the client for this frame."""
+        if client.is_up_to_date_for(encoded_frame.sequence, self.get_epoch(client.features)):
+            delta = self.get_variant_message(client.features, encoded_frame, keyframe=False)
+            if delta is not None:
+                return delta
+        # The client joined or missed a frame, so the delta doesn't apply to its canvas.
+        return self.get_variant_message(client.features, encoded_frame, keyframe=True)
+
+    def prepare_deliveries(self, encoded_frame: EncodedFrame, clients: list) -> list:
+        """Returns (websocket, client, message, epoch) for every (websocket, client) pair."""
+        # Feature state like the palette must see every delta in order, whether or not a client ends up using it.
+        for features in {client.features for _, client in clients}:
+            self.get_variant_message(features, encoded_frame, keyframe=False)
+        deliveries = [(websocket, client, *self.get_message(client, encoded_frame)) for websocket, client in clients]
+        # Compressed here once per message and window size, however many clients it's sent to
+        for _, client, message, _ in deliveries:
+            if client.deflate_window_bits is not None:
+                self.prepare_deflate(message, client.deflate_window_bits)
+        return deliveries
 
-        failed_sockets = set()
+    def start_recording(self, path: str, keyframe_interval: int = KEYFRAME_INTERVAL):
+        """Records every frame broadcast from now on to path, whether or not clients are connected."""
+        self.recorder = StreamRecorder(path, keyframe_interval=keyframe_interval)
+        logger.info(f"Recording frames to {path}")
+
+    async def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            # Frames are recorded on the encoder thread, so close after the ones already submitted
+            await asyncio.get_running_loop().run_in_executor(self.encoder_executor, recorder.close)
+            logger.info(f"Recorded {recorder.frame_count} frames to {recorder.path}")
+
+    def record_frame(self, recorder: StreamRecorder, encoded_frame: EncodedFrame):
+        # The recorder adds keyframes of its own, so frames can be rebuilt without replaying from the start
+        if recorder.frame_count == 0:
+            recorder.set_frame_size(width=encoded_frame.frame.shape[1], height=encoded_frame.frame.shape[0])
+        keyframe = encoded_frame.is_keyframe or recorder.is_keyframe_due()
+        message = self.get_keyframe_message(encoded_frame) if keyframe else encoded_frame.message
+        recorder.write(message, keyframe=keyframe, capture_time=encoded_frame.capture_time)
+
+    def prepare_broadcast(self, encoded_frame: EncodedFrame, clients: list, recorder: StreamRecorder) -> list:
+        if recorder is not None:
+            self.record_frame(recorder, encoded_frame)
+        return self.prepare_deliveries(encoded_frame, clients)
+
+    async def broadcast(self, encoded_frame: EncodedFrame):
+        """
+        Hands the frame to every client's mailbox and returns without waiting for it to be sent.
+        Each client is sent to by its own task, so a slow client doesn't hold up the others or the caller.
+        If a client is still busy with an older frame when a newer one arrives, only the newest is kept.
+        """
+        self.metrics.record('message_bytes', encoded_frame.message_size)
+
+        clients = list(self.frame_websockets.items())
+        recorder = self.recorder
+        if not clients and recorder is None:
+            return
+
+        # Latest frame wins. Clients whose unsent frame is replaced get this one as a keyframe.
+        for _, client in clients:
+            if client.drop_pending_delivery():
+                self.metrics.increment('dropped_deliveries')
+                self.dropped_deliveries += 1
+
+        loop = asyncio.get_running_loop()
+        deliveries = await loop.run_in_executor(self.encoder_executor, self.prepare_broadcast, encoded_frame, clients, recorder)
+
+        for websocket, client, message, epoch in deliveries:
+            if websocket not in self.frame_websockets:
+                # Disconnected while the messages were being prepared
+                continue
+            client.post(encoded_frame.sequence, message, epoch)
+            if client.sender_task is None or client.sender_task.done():
+                client.sender_task = asyncio.create_task(self.send_pending_deliveries(websocket, client))
+
+    async def send_pending_deliveries(self, websocket, client: FrameClient):
+        while (delivery := client.take_pending_delivery()) is not None:
+            _, message, _ = delivery
+            # A newer delivery may be posted while this one is sent
+            posted_time = client.posted_time
+            if len(message) == 0:
+                # Nothing changed since the frame this client already has.
+                continue
 
-        for websocket in list(self.frame_websockets):
             try:
-                await websocket.send(message)
+                await message.send(websocket, client.deflate_window_bits)
+                send_latency = time.monotonic() - posted_time
+                self.metrics.record('send_latency_ms', send_latency * 1000)
+                self.max_send_latency = max(self.max_send_latency, send_latency)
             except websockets.exceptions.ConnectionClosedOK:
                 logger.info("Client disconnected")
-                failed_sockets.add(websocket)
+                self.frame_websockets.pop(websocket, None)
+                return
             except Exception as e:
                 logger.error(f"Error: {e}")
-                failed_sockets.add(websocket)
+                self.frame_websockets.pop(websocket, None)
+                return
+
+    def pop_delivery_stats(self):
+        """
+        Returns the longest time in seconds a message waited in a client's mailbox until it was sent,
+        and the number of deliveries dropped for a newer frame, since the last call.
+        """
+        stats = (self.max_send_latency, self.dropped_deliveries)
+        self.max_send_latency = 0.0
+        self.dropped_deliveries = 0
+        return stats
 
-        # Remove failed sockets from active set
-        self.frame_websockets.difference_update(failed_sockets)
+    async def wait_for_deliveries(self):
+        """Waits until every client's mailbox has been sent."""
+        sender_tasks = [client.sender_task for client in list(self.frame_websockets.values()) if client.sender_task is not None]
+        await asyncio.gather(*sender_tasks)
 
-    async def handle_connection(self, websocket, path):
-        self.frame_websockets.add(websocket)
-        logger.info("Frame WebSocket connection established")
+    async def handle_connection(self, websocket, path=None):
+        features = parse_features(get_request_path(websocket, path))
+        self.frame_websockets[websocket] = FrameClient(websocket, features=features,
+                                                       deflate_window_bits=get_deflate_window_bits(websocket))
+        logger.info(f"Frame WebSocket connection established with features: {sorted(features)}, "
+                    f"deflate window bits: {self.frame_websockets[websocket].deflate_window_bits}")
         try:
             while True:
                 _ = await websocket.recv()
         except websockets.exceptions.ConnectionClosed:
             logger.info("Frame WebSocket connection closed")
         finally:
-            self.frame_websockets.remove(websocket)
+            self.frame_websockets.pop(websocket, None)
@@ -1,8 +1,14 @@
 from asyncio import Queue
+from concurrent.futures import ThreadPoolExecutor
 from nes_py import NESEnv
 from libs.Websockets.ControllerWebsocket import ControllerWebsocket
 from libs.Websockets.FrameWebsocket import FrameWebsocket
 from libs.Helpers.GeneralHelpers import *
+from libs.Helpers.FrameScheduler import FrameScheduler, NES_FRAME_RATE
+from libs.Helpers.QualityController import QualityController, QualityLevel
+from libs.Helpers.ColorQuantizer import ColorQuantizer
+from libs.Helpers.Metrics import Metrics
+from libs.Helpers.StatsServer import StatsServer
 import time
 import numpy as np
 import cv2
@@ -21,15 +27,12 @@ handler.setFormatter(formatter)
 # Add the handler to the logger
 logger.addHandler(handler)
 
-speed_profiler = SpeedProfiler()
-speed_profiler.start()
-
 # Initialize NES emulator and load ROM
 
 class NESGameServer:
-    # 60.0 with 100 scale runs fine, but is delayed for the viewer when there is substantial movement.
-    MAX_RENDER_FRAME_RATE: float = 60.0
-    # TODO: For some reason I'm getting 20 FPS if this is 30, and 30 FPS if this is 40.
+    # Emulate at the NES's native frame rate.
+    MAX_RENDER_FRAME_RATE: float = NES_FRAME_RATE
+    # Any rate up to the render rate is achieved on average, by publishing a subset of the rendered frames.
     MAX_PUBLISH_FRAME_RATE: float = 45.0
     #MAX_PUBLISH_FRAME_RATE: float = 120.0
     SEND_FULL_FRAMES_ONLY: bool = False
@@ -46,28 +49,95 @@ class NESGameServer:
     # Reduces amount of changed pixels, so this can improve FPS.
     SCANLINES_ENABLED: bool = False
 
+    # Colors frames are reduced to before encoding, as an (N, 3) RGB array, or None to keep them.
+    # Fewer colors make longer runs. The NES itself only has 54 colors, so this matters most with scaling or low color bits.
+    COLOR_PALETTE = None
+
+    # Send vertical runs of a color as rectangles, which existing clients already decode. Makes messages about 15% smaller.
+    RECTANGLE_ENCODING: bool = True
+
+    # Native threads a frame is encoded on, in horizontal bands. Half the CPUs, up to 4, leaves room for emulation and sending.
+    ENCODER_THREADS: int = max(1, min(4, (os.cpu_count() or 1) // 2))
+
+    # Offer permessage-deflate to clients, with FramedMessage.DEFLATE_WINDOW_BITS and DEFLATE_LEVEL.
+    # Every message is compressed once on the encoder thread, however many clients it's sent to.
+    DEFLATE_COMPRESSION: bool = True
+    # Dictionary for FEATURE_ZSTD clients, or None to compress without one. Clients must load the same file.
+    # Train one on the game being served with python -m benchmarks.compression_benchmark --train-dictionary <path>
+    ZSTD_DICTIONARY_PATH: str = None
+
+    # Run emulation, encoding and broadcasting as separate stages, so a slow encode doesn't hold up emulation,
+    # controller input or sending. The emulator steps on its own thread and frames are encoded on FrameWebsocket's encoder thread.
+    PIPELINED: bool = True
+    # Rendered frames waiting to be encoded. If encoding falls behind, the oldest one is dropped.
+    RENDER_QUEUE_SIZE: int = 1
+    # Encoded frames waiting to be broadcast. Deltas can't be dropped, so the encoder waits when this is full.
+    PUBLISH_QUEUE_SIZE: int = 2
+
+    # Record every published frame to this file, for replaying with MessageViewer, or None to not record.
+    # A recording the server didn't get to close is still readable, its keyframe index is rebuilt when it's opened.
+    RECORDING_PATH: str = None
+
+    # Serves GET /stats and GET /profile?seconds=10 on localhost, or None to not serve them.
+    STATS_PORT = 9002
+    # Log a summary line of the metrics this often, in seconds
+    METRICS_SUMMARY_INTERVAL: float = 10.0
+
+    # Lower the resolution, color depth and publish rate while the stream misses these targets, and raise them again once it's well within.
+    ADAPTIVE_QUALITY: bool = True
+    # Bytes per second of the stream a client without optional features receives
+    TARGET_BYTES_PER_SECOND: float = 1_500_000
+    # Seconds from rendering a frame to handing it to the clients' mailboxes
+    TARGET_LATENCY: float = 0.1
+    # Seconds a message may wait in a client's mailbox until it's sent. Longer means a client's connection is backlogged.
+    TARGET_SEND_LATENCY: float = 0.1
+    # Seconds encoding a frame may take, half a publish period, leaving the rest for emulation and sending
+    TARGET_ENCODE_TIME: float = 0.5 / MAX_PUBLISH_FRAME_RATE
+    # From best to worst. The resolution is relative to the scaled frame size, which clients keep seeing.
+    QUALITY_LEVELS = [
+        QualityLevel(resolution_percentage=100, color_bits=8, publish_rate=MAX_PUBLISH_FRAME_RATE),
+        QualityLevel(resolution_percentage=100, color_bits=6, publish_rate=MAX_PUBLISH_FRAME_RATE),
+        QualityLevel(resolution_percentage=100, color_bits=5, publish_rate=min(MAX_PUBLISH_FRAME_RATE, 30.0)),
+        QualityLevel(resolution_percentage=75, color_bits=5, publish_rate=min(MAX_PUBLISH_FRAME_RATE, 30.0)),
+        QualityLevel(resolution_percentage=50, color_bits=4, publish_rate=min(MAX_PUBLISH_FRAME_RATE, 30.0)),
+        QualityLevel(resolution_percentage=50, color_bits=4, publish_rate=min(MAX_PUBLISH_FRAME_RATE, 20.0)),
+    ]
+
     def __init__(self, emulator:NESEnv, host, controller_port, frame_port):
         # WebSocket server configuration
         self.host = host
         self.controller_port = controller_port
         self.frame_port = frame_port
 
+        # Step and encode times, message sizes, queue depths, send latencies and dropped frames
+        self.metrics = Metrics()
+        self.last_metrics_summary_time = time.monotonic()
+        self.stats_server = None if self.STATS_PORT is None else StatsServer('localhost', self.STATS_PORT, self.metrics)
+
         # Create instances of ControllerWebsocket and FrameWebsocket
         self.controller = ControllerWebsocket(self.host, self.controller_port)
-        self.frame = FrameWebsocket(self.host, self.frame_port)
+        self.frame = FrameWebsocket(self.host, self.frame_port, rectangles=self.RECTANGLE_ENCODING,
+                                    encoder_threads=self.ENCODER_THREADS, metrics=self.metrics,
+                                    deflate=self.DEFLATE_COMPRESSION, zstd_dictionary_path=self.ZSTD_DICTIONARY_PATH)
 
         self.emulator = emulator
-        self.execution_count_rendered = 0
-        self.execution_count_published = 0
-
-        self.previous_fps_check_time = time.time()
+        self.scheduler = FrameScheduler(render_rate=self.MAX_RENDER_FRAME_RATE, publish_rate=self.MAX_PUBLISH_FRAME_RATE)
 
         self.last_full_frame_time = time.time()
-        self.full_frame_interval = 5.0  # 5 seconds
+        # Clients that join or miss a frame get a keyframe right away, so periodic full frames are only a safety net.
+        self.full_frame_interval = 30.0  # 30 seconds
+        self.force_keyframe = False
+
+        self.quality = QualityController(self.QUALITY_LEVELS, target_bytes_per_second=self.TARGET_BYTES_PER_SECOND,
+                                         target_latency=self.TARGET_LATENCY, target_send_latency=self.TARGET_SEND_LATENCY,
+                                         target_encode_time=self.TARGET_ENCODE_TIME)
+        self.resolution_percentage = 100
+        self.quantizer = ColorQuantizer(palette=self.COLOR_PALETTE)
+        self.apply_quality_level(self.quality.level)
 
-        self.last_render_time = time.time()
-        self.last_frame_publish_time = time.time()
-        self.queue = Queue()
+        self.render_queue = Queue(maxsize=self.RENDER_QUEUE_SIZE)
+        self.queue = Queue(maxsize=self.PUBLISH_QUEUE_SIZE)
+        self.emulator_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Emulator')
 
         self.new_frame_width = int(DEFAULT_FRAME_WIDTH * (self.SCALE_PERCENTAGE / 100))
         self.new_frame_height = int(DEFAULT_FRAME_HEIGHT * (self.SCALE_PERCENTAGE / 100))
@@ -77,8 +147,85 @@ class NESGameServer:
         logger.info(f"Scaled frame size: {self.new_frame_width}x{self.new_frame_height}")
 
     async def main(self):
+        if self.RECORDING_PATH is not None:
+            self.frame.start_recording(self.RECORDING_PATH)
         # Start the WebSocket servers and the frame production and consumption concurrently
-        await asyncio.gather(self.controller.start(), self.frame.start(), self.produce_frames(), self.consume_frames())
+        stages = [self.produce_frames(), self.consume_frames()]
+        if self.PIPELINED:
+            stages.append(self.encode_frames())
+        if self.stats_server is not None:
+            stages.append(self.stats_server.start())
+        try:
+            await asyncio.gather(self.controller.start(), self.frame.start(), *stages)
+        finally:
+            # Writes the recording's keyframe index and flushes its buffer, also when the server is interrupted
+            await self.frame.stop_recording()
+
+    def step_frame(self, action):
+        start_time = time.perf_counter()
+        state, _, done, _ = self.emulator.step(action=action)
+        self.metrics.record('step_ms', (time.perf_counter() - start_time) * 1000)
+        # ndarray w/ shape (240, 256, 3)
+        # This means a width of 256, height of 240, and 3 color channels. So 256x240x3 for widthXheightXchannels.
+        # This is the correct, standard NES resolution: 256x240.
+        # The ndarray shape can seem confusing, but think of it as 240 rows and 256 columns.
+
+        # Copy, since the emulator reuses its screen buffer and this frame may still be encoded after the next step.
+        state = state.astype('uint8')
+
+        if self.SCALE_PERCENTAGE < 100:
+            state = cv2.resize(state, (self.new_frame_width, self.new_frame_height), interpolation=self.SCALE_INTERPOLATION_METHOD)
+
+        resolution_percentage = self.resolution_percentage
+        if resolution_percentage < 100:
+            # Render at a lower resolution, then scale back up so clients keep the same canvas.
+            height, width = state.shape[0], state.shape[1]
+            reduced_size = (max(1, width * resolution_percentage // 100), max(1, height * resolution_percentage // 100))
+            state = cv2.resize(state, reduced_size, interpolation=self.SCALE_INTERPOLATION_METHOD)
+            state = cv2.resize(state, (width, height), interpolation=cv2.INTER_NEAREST)
+
+        if not self.quantizer.is_identity():
+            self.quantizer.quantize(state)
+
+        if self.SCANLINES_ENABLED:
+            # Set this RGB value for all pixels
+            state[::2, :, :] = 40
+
+            brightening_factor = 1.2  # Adjust this value to achieve the desired brightening effect
+            state[1::2, :, :] = np.clip(state[1::2, :, :] * brightening_factor, 0, 255).astype(int)
+
+        return state, done
+
+    def apply_quality_level(self, level: QualityLevel):
+        if level.resolution_percentage != self.resolution_percentage:
+            # Every pixel changes, so a keyframe costs no more than a delta
+            self.force_keyframe = True
+        self.resolution_percentage = level.resolution_percentage
+        self.quantizer.set_bits(level.color_bits)
+        self.scheduler.set_publish_rate(level.publish_rate)
+        logger.info(f"Quality: {level}")
+
+    def update_quality(self, encoded_frame):
+        latency = 0.0 if encoded_frame.capture_time is None else time.monotonic() - encoded_frame.capture_time
+        self.quality.record_frame(encoded_frame.message_size, latency, encoded_frame.encode_time or 0.0)
+        self.quality.record_deliveries(*self.frame.pop_delivery_stats())
+        if self.quality.update():
+            self.apply_quality_level(self.quality.level)
+
+    def is_keyframe_due(self) -> bool:
+        return (self.SEND_FULL_FRAMES_ONLY or self.force_keyframe or
+                time.time() - self.last_full_frame_time >= self.full_frame_interval)
+
+    async def encode_and_queue(self, state, capture_time: float = None):
+        keyframe = self.is_keyframe_due()
+        encoded_frame = await self.frame.encode_frame_async(state, keyframe=keyframe, capture_time=capture_time)
+        if keyframe:
+            self.last_full_frame_time = time.time()
+            self.force_keyframe = False
+
+        # Waits if the broadcaster is behind, which holds up encoding but not emulation in the pipelined mode.
+        self.metrics.record('publish_queue_depth', self.queue.qsize())
+        await self.queue.put(encoded_frame)
 
     async def produce_frames(self):
         # Reset the emulator
@@ -86,59 +233,45 @@ class NESGameServer:
 
         # Emulation loop
         done = False
+        self.scheduler.start()
         while not done:
-            if time.time() - self.last_render_time < 1.0 / self.MAX_RENDER_FRAME_RATE:
-                await asyncio.sleep(0)  # Yield control to the event loop
-                continue
-            self.last_render_time = time.time()
-
-            state, _, done, _ = self.emulator.step(action=self.controller.current_action)
-            # ndarray w/ shape (240, 256, 3)
-            # This means a width of 256, height of 240, and 3 color channels. So 256x240x3 for widthXheightXchannels.
-            # This is the correct, standard NES resolution: 256x240.
-            # The ndarray shape can seem confusing, but think of it as 240 rows and 256 columns.
-
-            if self.SCALE_PERCENTAGE < 100:
-                state = cv2.resize(state, (self.new_frame_width, self.new_frame_height), interpolation=self.SCALE_INTERPOLATION_METHOD)
-
-            if self.SCANLINES_ENABLED:
-                # Set this RGB value for all pixels
-                state[::2, :, :] = 40
-
-                brightening_factor = 1.2  # Adjust this value to achieve the desired brightening effect
-                state[1::2, :, :] = np.clip(state[1::2, :, :] * brightening_factor, 0, 255).astype(int)
-
-            # Has enough time has elapsed to publish a frame?
-            if time.time() - self.last_frame_publish_time >= 1.0 / self.MAX_PUBLISH_FRAME_RATE:
-                state = state.astype('uint8')
-                if self.SEND_FULL_FRAMES_ONLY or time.time() - self.last_full_frame_time >= self.full_frame_interval:
-                    utf8_data = self.frame.full_frame_to_string(state)
-                    self.last_full_frame_time = time.time()
-                    logger.info("Sent full frame.")
-                else:
-                    utf8_data = self.frame.frame_to_string(state)
+            # Sleeps until this frame is due, and tells whether it should be published.
+            publish = await self.scheduler.wait_for_next_frame()
 
-                # Put the frame into the queue
-                # Theoretically, if framerate is too high (> 60), the queue could fill up
-                # and frames could be produced faster than we send them.
-                await self.queue.put(utf8_data)
-                self.last_frame_publish_time = time.time()
-                self.execution_count_published += 1
+            if self.PIPELINED:
+                state, done = await asyncio.get_running_loop().run_in_executor(
+                    self.emulator_executor, self.step_frame, self.controller.current_action)
+            else:
+                state, done = self.step_frame(self.controller.current_action)
+            capture_time = time.monotonic()
+
+            if publish:
+                if self.PIPELINED:
+                    if put_latest(self.render_queue, (state, capture_time)):
+                        self.metrics.increment('dropped_renders')
+                else:
+                    await self.encode_and_queue(state, capture_time)
 
             self.emulator.render()
-            self.execution_count_rendered += 1
 
-            # If a second has passed since the last reset, log and reset the execution count
-            if time.time() - self.previous_fps_check_time >= 1.0:
-                logger.info(f"Rendered FPS: {self.execution_count_rendered} Published FPS: {self.execution_count_published}")
-                self.execution_count_rendered = 0
-                self.execution_count_published = 0
-                self.previous_fps_check_time = time.time()
+            # Log the achieved rates against the targets about once a second
+            if self.scheduler.report_due():
+                logger.info(self.scheduler.format_rates(self.scheduler.pop_achieved_rates()))
+                if time.monotonic() - self.last_metrics_summary_time >= self.METRICS_SUMMARY_INTERVAL:
+                    self.last_metrics_summary_time = time.monotonic()
+                    logger.info(f"Metrics: {self.metrics.format_summary()}")
+
+    async def encode_frames(self):
+        while True:
+            state, capture_time = await self.render_queue.get()
+            await self.encode_and_queue(state, capture_time)
 
     async def consume_frames(self):
         while True:
-            utf8_data = await self.queue.get()  # Wait until a frame is available
-            await self.frame.broadcast(utf8_data)  # Send the frame over the websocket
+            encoded_frame = await self.queue.get()  # Wait until a frame is available
+            await self.frame.broadcast(encoded_frame)  # Send the frame over the websocket
+            if self.ADAPTIVE_QUALITY:
+                self.update_quality(encoded_frame)
 
 if __name__ == "__main__":
     HOST = 'localhost'
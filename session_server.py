@@ -0,0 +1,19 @@
+from libs.Sessions.SessionManager import SessionManager
+from libs.Helpers.GeneralHelpers import *
+
+# Show the logs of the session modules, e.g. sessions starting and stopping
+logger = logging.getLogger('libs.Sessions')
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logger.addHandler(handler)
+
+if __name__ == "__main__":
+    HOST = 'localhost'
+    CONTROLLER_PORT = 9000
+    FRAME_PORT = 9001
+
+    # Sessions start on demand, e.g. ws://localhost:9001/world1 streams a session running the default ROM,
+    # and ws://localhost:9001/world2?rom=flappy.nes one running flappy.nes. Controllers connect to the same paths on port 9000.
+    manager = SessionManager(HOST, CONTROLLER_PORT, FRAME_PORT, rom_directory="./roms", default_rom="Super Mario Bros.nes")
+    asyncio.run(manager.main())
@@ -0,0 +1,16 @@
+import pytest
+
+
+class FakeClock:
+    """A clock for classes that take a clock callable, which only moves when a test sets now."""
+
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
@@ -0,0 +1,38 @@
+import numpy as np
+from libs.Helpers.ColorQuantizer import ColorQuantizer
+
+
+def test_bits_keep_the_full_range():
+    for bits in range(1, 8):
+        quantizer = ColorQuantizer(bits=bits)
+        table = quantizer.channel_table
+        assert table[0] == 0
+        assert table[255] == 255
+        assert len(np.unique(table)) == 2 ** bits
+        assert np.all(np.diff(table.astype(np.int32)) >= 0)
+
+
+def test_eight_bits_is_identity():
+    quantizer = ColorQuantizer()
+    assert quantizer.is_identity()
+    frame = np.random.randint(0, 256, (8, 8, 3), dtype=np.uint8)
+    assert np.array_equal(quantizer.channel_table[frame], frame)
+
+
+def test_palette_maps_to_nearest_color():
+    palette = np.array([[0, 0, 0], [255, 255, 255], [200, 0, 0]], dtype=np.uint8)
+    quantizer = ColorQuantizer(palette=palette)
+    assert not quantizer.is_identity()
+    frame = np.array([[[10, 20, 5], [250, 240, 255], [180, 30, 10], [200, 0, 0]]], dtype=np.uint8)
+    expected = palette[[0, 1, 2, 2]][None]
+    assert np.array_equal(quantizer.quantize(frame.copy()), expected)
+    # Colors looked up before come from the table
+    assert np.array_equal(quantizer.quantize(frame.copy()), expected)
+
+
+def test_quantized_frames_are_a_fixed_point():
+    frame = np.random.randint(0, 256, (16, 16, 3), dtype=np.uint8)
+    palette = np.random.randint(0, 256, (12, 3), dtype=np.uint8)
+    for quantizer in (ColorQuantizer(bits=5), ColorQuantizer(palette=palette), ColorQuantizer(bits=4, palette=palette)):
+        quantized = quantizer.quantize(frame.copy())
+        assert np.array_equal(quantizer.quantize(quantized.copy()), quantized)
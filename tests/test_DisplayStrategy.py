@@ -3,6 +3,7 @@ import random
 from libs.Helpers.GeneralHelpers import *
 from libs.DisplayStrategies.AdvancedDisplayStrategy import *
 from libs.DisplayStrategies.MessageViewer import *
+from libs.Recording.StreamRecorder import record_messages
 from libs.CtypesLibs.CPPFrameToString import FrameToString
 
 
@@ -229,20 +230,20 @@ def test_unicode_utf8_conversion():
 
 
 
-def test_smb_title_demo_messages():
+def test_smb_title_demo_messages(tmp_path):
     # Run this with -s
     # a to move to prev frame, s to move to next frame. esc key to quit.
-    messages = load_json_file("./files/smb_title_demo_messages.json")
-    viewer = MessageViewer(messages)
+    record_messages(load_json_file("./files/smb_title_demo_messages.json"), tmp_path / "smb_title_demo.nesrec")
+    viewer = MessageViewer(StreamReader(tmp_path / "smb_title_demo.nesrec"))
     viewer.start()
     return
 
 
-def test_smb_title_demo_messages_artifacting_debug():
+def test_smb_title_demo_messages_artifacting_debug(tmp_path):
     # Run this with -s
     # a to move to prev frame, s to move to next frame. esc key to quit.
-    messages = load_json_file("./files/smb_title_demo_messages.json")
-    viewer = MessageViewer(messages,
+    record_messages(load_json_file("./files/smb_title_demo_messages.json"), tmp_path / "smb_title_demo.nesrec")
+    viewer = MessageViewer(StreamReader(tmp_path / "smb_title_demo.nesrec"),
                            cycle_mode=True,
                            start_index=72,
                            end_index=115
@@ -251,11 +252,11 @@ def test_smb_title_demo_messages_artifacting_debug():
     return
 
 
-def test_smb_title_demo_messages_artifacting_debug_2():
+def test_smb_title_demo_messages_artifacting_debug_2(tmp_path):
     # Run this with -s
     # a to move to prev frame, s to move to next frame. esc key to quit.
-    messages = load_json_file("./files/smb_title_demo_messages.json")
-    viewer = MessageViewer(messages,
+    record_messages(load_json_file("./files/smb_title_demo_messages.json"), tmp_path / "smb_title_demo.nesrec")
+    viewer = MessageViewer(StreamReader(tmp_path / "smb_title_demo.nesrec"),
                            display_canvas_every_update=True,
                            cycle_mode=True,
                            start_index=76,
@@ -263,3 +264,48 @@ def test_smb_title_demo_messages_artifacting_debug_2():
                            )
     viewer.start()
     return
+
+
+def encode_value(value: int) -> str:
+    codepoint = value + OFFSET
+    if codepoint >= 0xD800:
+        codepoint += SURROGATE_RANGE_SIZE
+    return chr(codepoint)
+
+
+def test_vectorized_update_canvas_matches_per_pixel():
+    random.seed(0)
+    for _ in range(5):
+        message = ""
+        for row in range(DEFAULT_FRAME_HEIGHT):
+            message += encode_value(row * 1000 + min(random.randint(1, 4), DEFAULT_FRAME_HEIGHT - row))
+            for _ in range(random.randint(1, 3)):
+                message += rgb_to_utf8(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), offset=OFFSET)
+                for _ in range(random.randint(1, 3)):
+                    start = random.randint(0, DEFAULT_FRAME_WIDTH - 2)
+                    span = random.randint(1, DEFAULT_FRAME_WIDTH - start - 1)
+                    message += encode_value(start * 1000 + span)
+                message += chr(1)
+            message += chr(2)
+
+        expected_canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+        canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+        update_canvas_per_pixel(message=message, canvas=expected_canvas, offset=OFFSET)
+        update_canvas(message=message, canvas=canvas, offset=OFFSET)
+        assert np.array_equal(canvas, expected_canvas)
+
+
+def test_vectorized_update_canvas_matches_per_pixel_for_cpp_deltas(frame_to_string: FrameToString):
+    rng = np.random.default_rng(0)
+    frame = (rng.integers(0, 4, (DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3)) * 60).astype(np.uint8)
+    previous_frame = None
+    expected_canvas = np.zeros_like(frame)
+    canvas = np.zeros_like(frame)
+    for _ in range(10):
+        frame = np.roll(frame, 2, axis=1)
+        frame[rng.integers(0, 200):][:20, rng.integers(0, 200):][:, :40] = rng.integers(0, 255, 3)
+        message = frame_to_string.get_string(frame, previous_frame)
+        previous_frame = frame
+        update_canvas_per_pixel(message=message, canvas=expected_canvas, offset=OFFSET)
+        update_canvas(message=message, canvas=canvas, offset=OFFSET)
+        assert np.array_equal(canvas, expected_canvas)
@@ -0,0 +1,67 @@
+import asyncio
+from libs.Helpers.FrameScheduler import FrameScheduler, NES_FRAME_RATE
+from tests.conftest import FakeClock
+
+
+def run_on_time(scheduler: FrameScheduler, clock: FakeClock, seconds: float, lateness: float = 0.0) -> int:
+    """Takes every render tick, each `lateness` seconds after its deadline. Returns how many were published."""
+    scheduler.start()
+    end = clock.now + seconds
+    published = 0
+    while scheduler.next_render_time < end:
+        clock.now = scheduler.next_render_time + lateness
+        published += scheduler.advance(clock.now)
+    return published
+
+
+def test_publish_rate_is_not_quantized_to_a_divisor_of_the_render_rate(clock: FakeClock):
+    for publish_rate in [30.0, 40.0, 45.0, 59.0]:
+        scheduler = FrameScheduler(render_rate=NES_FRAME_RATE, publish_rate=publish_rate, clock=clock)
+        published = run_on_time(scheduler, clock, seconds=10.0)
+        assert abs(published - publish_rate * 10) <= 1
+
+
+def test_publish_rate_is_capped_at_the_render_rate(clock: FakeClock):
+    scheduler = FrameScheduler(render_rate=NES_FRAME_RATE, publish_rate=120.0, clock=clock)
+    published = run_on_time(scheduler, clock, seconds=10.0)
+    assert published == scheduler.rendered_count
+
+
+def test_late_ticks_do_not_drift(clock: FakeClock):
+    scheduler = FrameScheduler(render_rate=NES_FRAME_RATE, publish_rate=45.0, clock=clock)
+    # Every tick is taken late, but deadlines stay on the original grid, so no ticks are lost.
+    run_on_time(scheduler, clock, seconds=10.0, lateness=0.8 / NES_FRAME_RATE)
+    render_rate, publish_rate = scheduler.pop_achieved_rates()
+    assert abs(render_rate - NES_FRAME_RATE) < 0.5
+    assert abs(publish_rate - 45.0) < 0.5
+
+
+def test_stall_resyncs_instead_of_bursting(clock: FakeClock):
+    scheduler = FrameScheduler(render_rate=NES_FRAME_RATE, publish_rate=45.0, clock=clock)
+    scheduler.start()
+    clock.now += 1.0
+    scheduler.advance(clock.now)
+    # The next deadline is at most one period away, rather than a second of missed ticks in the past.
+    assert 0 < scheduler.next_render_time - clock.now <= 1.0 / NES_FRAME_RATE
+
+
+def test_waiting_sleeps_once_per_frame_without_polling(monkeypatch, clock: FakeClock):
+    scheduler = FrameScheduler(render_rate=NES_FRAME_RATE, publish_rate=45.0, clock=clock)
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        # Wake up a little late, like a real sleep
+        clock.now += delay + 0.001
+
+    monkeypatch.setattr(asyncio, 'sleep', fake_sleep)
+
+    async def run():
+        scheduler.start()
+        for _ in range(60):
+            await scheduler.wait_for_next_frame()
+
+    asyncio.run(run())
+    assert len(delays) == 59
+    assert all(delay > 0 for delay in delays)
+    assert scheduler.rendered_count == 60
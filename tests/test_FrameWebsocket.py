@@ -0,0 +1,350 @@
+import asyncio
+import pytest
+from libs.Helpers.GeneralHelpers import *
+from libs.DisplayStrategies.DisplayStrategy import update_canvas
+from libs.DisplayStrategies.FrameDecoder import Palette
+from libs.Protocol.FrameProtocol import FEATURE_BINARY, FEATURE_PALETTE, FEATURE_ROW_CACHE, FEATURE_SHIFT, FEATURE_ZSTD, \
+    SHIFT_COMMAND, parse_features, binary_to_codepoints, codepoints_to_binary, message_to_codepoints
+from libs.Protocol.RowCache import RowCache
+from libs.Protocol.ZstdCodec import ZstdCodec, is_zstd_message, train_dictionary
+from libs.Websockets.FrameWebsocket import FrameWebsocket
+from libs.Websockets.FrameClient import FrameClient
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def frame_websocket():
+    return FrameWebsocket('localhost', 9001)
+
+
+def connect(frame_websocket: FrameWebsocket, features: frozenset = frozenset()) -> FakeWebsocket:
+    websocket = FakeWebsocket()
+    frame_websocket.frame_websockets[websocket] = FrameClient(websocket, features=features)
+    return websocket
+
+
+def generate_frames(count: int, color_count: int = None):
+    """Yields frames that each add a rectangle, in a random color or one of color_count colors."""
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 255, (color_count, 3)) if color_count else None
+    frame = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+    for i in range(count):
+        frame = frame.copy()
+        row, column = rng.integers(0, 200, 2)
+        frame[row:row + 20, column:column + 40] = colors[i % color_count] if color_count else rng.integers(0, 255, 3)
+        yield frame
+
+
+async def deliver(frame_websocket: FrameWebsocket, encoded_frame):
+    """Broadcasts the frame and waits until every client has been sent it."""
+    await frame_websocket.broadcast(encoded_frame)
+    await frame_websocket.wait_for_deliveries()
+
+
+def replay(websocket: FakeWebsocket, palette: Palette = None, row_cache: RowCache = None) -> np.ndarray:
+    canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+    for message in websocket.messages:
+        update_canvas(message=message, canvas=canvas, offset=OFFSET, palette=palette, row_cache=row_cache)
+    return canvas
+
+
+def test_late_client_gets_keyframe_and_others_keep_deltas(frame_websocket: FrameWebsocket):
+    early_client = connect(frame_websocket)
+    late_client = None
+    frame = None
+    for i, frame in enumerate(generate_frames(10)):
+        if i == 5:
+            late_client = connect(frame_websocket)
+        encoded_frame = frame_websocket.encode_frame(frame)
+        asyncio.run(deliver(frame_websocket, encoded_frame))
+        if i == 5:
+            assert late_client.messages[-1] == encoded_frame.keyframe_message
+            assert early_client.messages[-1] == encoded_frame.message
+            assert len(encoded_frame.message) < len(encoded_frame.keyframe_message)
+
+    # Canvases are BGR
+    assert np.array_equal(replay(early_client), frame[..., ::-1])
+    assert np.array_equal(replay(late_client), frame[..., ::-1])
+
+
+def test_lagging_client_gets_keyframe(frame_websocket: FrameWebsocket):
+    client = connect(frame_websocket)
+    frames = list(generate_frames(3))
+    asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frames[0])))
+    # The client misses the second frame
+    frame_websocket.encode_frame(frames[1])
+    encoded_frame = frame_websocket.encode_frame(frames[2])
+    asyncio.run(deliver(frame_websocket, encoded_frame))
+    assert client.messages[-1] == encoded_frame.keyframe_message
+    assert np.array_equal(replay(client), frames[2][..., ::-1])
+
+
+def test_parse_features():
+    assert parse_features('/') == frozenset()
+    assert parse_features('/?features=palette,unknown') == frozenset([FEATURE_PALETTE])
+    assert parse_features('/?features=zstd') == frozenset([FEATURE_ZSTD, FEATURE_BINARY])
+
+
+def test_binary_codec_round_trips_every_codepoint_size():
+    message = ''.join(map(chr, [1, 2, 16, 127, 128, 16383, 16384, 0xD7FF, 0xD800 + 2048, 255255 + 16, 0x10FFFF]))
+    codepoints = message_to_codepoints(message)
+    payload = codepoints_to_binary(codepoints)
+    assert len(payload) < len(message.encode('utf-8'))
+    assert binary_to_codepoints(payload).tolist() == codepoints.tolist()
+    assert binary_to_codepoints(b'').tolist() == []
+
+
+def test_palette_clients_decode_the_same_frames_with_smaller_messages(frame_websocket: FrameWebsocket):
+    palette = frozenset([FEATURE_PALETTE])
+    text_client = connect(frame_websocket)
+    palette_client = connect(frame_websocket, palette)
+    late_palette_client = None
+    frame = None
+    # The palette pays off once colors repeat
+    for i, frame in enumerate(generate_frames(30, color_count=4)):
+        if i == 4:
+            late_palette_client = connect(frame_websocket, palette)
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert sum(map(len, palette_client.messages)) < sum(map(len, text_client.messages))
+    assert np.array_equal(replay(palette_client, Palette()), frame[..., ::-1])
+    assert np.array_equal(replay(late_palette_client, Palette()), frame[..., ::-1])
+
+
+def test_palette_overflow_resyncs_clients_with_keyframe(frame_websocket: FrameWebsocket):
+    frame_websocket.get_palette_transcoder(frozenset([FEATURE_PALETTE])).max_size = 4
+    client = connect(frame_websocket, frozenset([FEATURE_PALETTE]))
+    frame = None
+    for frame in generate_frames(8):
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert frame_websocket.get_palette_transcoder(frozenset([FEATURE_PALETTE])).epoch > 0
+    assert np.array_equal(replay(client, Palette()), frame[..., ::-1])
+
+
+class SlowWebsocket(FakeWebsocket):
+    """A client whose sends don't complete until released."""
+
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def send(self, message):
+        await self.released.wait()
+        self.messages.append(message)
+
+
+def test_slow_client_gets_latest_frame_without_holding_up_others(frame_websocket: FrameWebsocket):
+    frames = list(generate_frames(6))
+
+    async def run():
+        fast_client = connect(frame_websocket)
+        slow_client = SlowWebsocket()
+        frame_websocket.frame_websockets[slow_client] = FrameClient(slow_client)
+
+        encoded_frames = []
+        for frame in frames:
+            encoded_frames.append(frame_websocket.encode_frame(frame))
+            await frame_websocket.broadcast(encoded_frames[-1])
+            # Let the sender tasks run
+            await asyncio.sleep(0)
+        # The fast client got every frame while the slow one is still stuck on its first.
+        assert len(fast_client.messages) == len(frames)
+        assert frame_websocket.frame_websockets[slow_client].pending_delivery is not None
+
+        slow_client.released.set()
+        await frame_websocket.wait_for_deliveries()
+        return fast_client, slow_client, encoded_frames
+
+    fast_client, slow_client, encoded_frames = asyncio.run(run())
+    # The frames in between were coalesced, and the newest one was sent as a keyframe.
+    assert slow_client.messages == [encoded_frames[0].keyframe_message, encoded_frames[-1].keyframe_message]
+    # Every frame posted while the slow client was stuck replaced the one before it, except the last
+    max_send_latency, dropped_deliveries = frame_websocket.pop_delivery_stats()
+    assert dropped_deliveries == len(frames) - 2
+    assert max_send_latency > 0
+    assert frame_websocket.pop_delivery_stats() == (0.0, 0)
+    assert np.array_equal(replay(fast_client), frames[-1][..., ::-1])
+    assert np.array_equal(replay(slow_client), frames[-1][..., ::-1])
+
+
+def test_preframed_messages_reach_real_connections(frame_websocket: FrameWebsocket):
+    import websockets
+    frames = list(generate_frames(5))
+
+    async def run():
+        server = await websockets.serve(frame_websocket.handle_connection, 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        # Without compression the pre-framed bytes are written directly, with permessage-deflate they're sent normally.
+        raw_client = await websockets.connect(f'ws://localhost:{port}/', compression=None)
+        deflate_client = await websockets.connect(f'ws://localhost:{port}/')
+        binary_client = await websockets.connect(f'ws://localhost:{port}/?features=binary', compression=None)
+        while len(frame_websocket.frame_websockets) < 3:
+            await asyncio.sleep(0.01)
+        for frame in frames:
+            await deliver(frame_websocket, frame_websocket.encode_frame(frame))
+
+        canvases = []
+        for client in (raw_client, deflate_client, binary_client):
+            canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+            for _ in frames:
+                message = await client.recv()
+                assert isinstance(message, bytes) == (client is binary_client)
+                update_canvas(message=message, canvas=canvas, offset=OFFSET)
+            canvases.append(canvas)
+            await client.close()
+        server.close()
+        await server.wait_closed()
+        return canvases
+
+    for canvas in asyncio.run(run()):
+        assert np.array_equal(canvas, frames[-1][..., ::-1])
+
+
+def generate_scrolling_frames(count: int):
+    """Yields frames of a playfield scrolling left under a static status bar, like a side scroller."""
+    rng = np.random.default_rng(0)
+    playfield = rng.integers(0, 4, (DEFAULT_FRAME_HEIGHT // 8, DEFAULT_FRAME_WIDTH // 4, 1)) * 60
+    playfield = np.repeat(np.repeat(playfield, 8, axis=0), 8, axis=1).repeat(3, axis=2).astype(np.uint8)
+    for i in range(count):
+        frame = np.ascontiguousarray(playfield[:, i * 3:i * 3 + DEFAULT_FRAME_WIDTH])
+        frame[:24] = [i, 0, 0]
+        yield frame
+
+
+def test_shift_clients_get_smaller_scrolling_deltas():
+    frame_websocket = FrameWebsocket('localhost', 9001)
+    text_client = connect(frame_websocket)
+    shift_client = connect(frame_websocket, frozenset([FEATURE_SHIFT]))
+    palette_shift_client = connect(frame_websocket, frozenset([FEATURE_SHIFT, FEATURE_PALETTE]))
+    frame = None
+    for frame in generate_scrolling_frames(20):
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert shift_client.messages[-1].startswith(chr(SHIFT_COMMAND))
+    assert sum(map(len, shift_client.messages)) * 4 < sum(map(len, text_client.messages))
+    assert np.array_equal(replay(shift_client), frame[..., ::-1])
+    assert np.array_equal(replay(palette_shift_client, Palette()), frame[..., ::-1])
+
+
+def test_frame_size_change_forces_keyframe(frame_websocket: FrameWebsocket):
+    client = connect(frame_websocket)
+    frame = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+    asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+    smaller_frame = np.full((DEFAULT_FRAME_HEIGHT // 2, DEFAULT_FRAME_WIDTH // 2, 3), 7, dtype=np.uint8)
+    encoded_frame = frame_websocket.encode_frame(smaller_frame)
+    assert encoded_frame.is_keyframe
+    asyncio.run(deliver(frame_websocket, encoded_frame))
+    assert client.messages[-1] == encoded_frame.keyframe_message
+
+
+def generate_tiled_frames(count: int, tile_count: int = 6):
+    """Yields frames made of bands of 8 rows, each a copy of one of a few tiles, like a tiled playfield."""
+    rng = np.random.default_rng(0)
+    tiles = rng.integers(0, 255, (tile_count, 8, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+    for _ in range(count):
+        yield np.concatenate(tiles[rng.integers(0, tile_count, DEFAULT_FRAME_HEIGHT // 8)])
+
+
+def test_row_cache_clients_mirror_the_server_cache(frame_websocket: FrameWebsocket):
+    text_client = connect(frame_websocket)
+    feature_sets = [frozenset([FEATURE_ROW_CACHE]), frozenset([FEATURE_ROW_CACHE, FEATURE_PALETTE]),
+                    frozenset([FEATURE_ROW_CACHE, FEATURE_PALETTE, FEATURE_SHIFT])]
+    clients = [connect(frame_websocket, features) for features in feature_sets]
+    late_clients = []
+    frame = None
+    for i, frame in enumerate(generate_tiled_frames(60)):
+        if i == 20:
+            late_clients = [connect(frame_websocket, features) for features in feature_sets]
+        if i % 15 == 0:
+            # Like a dropped delivery, so this client gets keyframes while the others keep getting deltas
+            frame_websocket.frame_websockets[clients[0]].last_sequence = -1
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert sum(map(len, clients[0].messages)) * 4 < sum(map(len, text_client.messages))
+    for features, client in zip(feature_sets * 2, clients + late_clients):
+        row_cache = RowCache()
+        assert np.array_equal(replay(client, Palette() if FEATURE_PALETTE in features else None, row_cache), frame[..., ::-1])
+        server_cache = frame_websocket.get_row_cache_transcoder(features).cache
+        assert [(slot, body.tolist()) for slot, body in row_cache.entries()] == \
+               [(slot, body.tolist()) for slot, body in server_cache.entries()]
+
+
+def test_binary_clients_decode_the_same_frames_with_smaller_messages(frame_websocket: FrameWebsocket):
+    text_client = connect(frame_websocket, frozenset([FEATURE_PALETTE, FEATURE_ROW_CACHE]))
+    binary_client = connect(frame_websocket, frozenset([FEATURE_PALETTE, FEATURE_ROW_CACHE, FEATURE_BINARY]))
+    frame = None
+    for frame in generate_tiled_frames(20):
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert all(isinstance(message, bytes) for message in binary_client.messages)
+    assert sum(map(len, binary_client.messages)) < sum(len(message.encode('utf-8')) for message in text_client.messages)
+    assert np.array_equal(replay(binary_client, Palette(), RowCache()), frame[..., ::-1])
+
+
+def test_deflate_clients_share_one_compressed_frame(frame_websocket: FrameWebsocket):
+    import websockets
+    frames = list(generate_tiled_frames(10))
+
+    async def run():
+        server = await websockets.serve(frame_websocket.handle_connection, 'localhost', 0, **frame_websocket.get_serve_options())
+        port = server.sockets[0].getsockname()[1]
+        clients = [await websockets.connect(f'ws://localhost:{port}/') for _ in range(3)]
+        clients.append(await websockets.connect(f'ws://localhost:{port}/', compression=None))
+        while len(frame_websocket.frame_websockets) < len(clients):
+            await asyncio.sleep(0.01)
+        assert [client.deflate_window_bits for client in frame_websocket.frame_websockets.values()].count(None) == 1
+        for frame in frames:
+            await deliver(frame_websocket, frame_websocket.encode_frame(frame))
+
+        canvases = []
+        for client in clients:
+            canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+            for _ in frames:
+                update_canvas(message=await client.recv(), canvas=canvas, offset=OFFSET)
+            canvases.append(canvas)
+            await client.close()
+        server.close()
+        await server.wait_closed()
+        return canvases
+
+    for canvas in asyncio.run(run()):
+        assert np.array_equal(canvas, frames[-1][..., ::-1])
+    # Compressed once per frame, not once per client
+    ratios = frame_websocket.metrics.snapshot()['histograms']['deflate_ratio']
+    assert ratios['count'] == len(frames)
+    assert ratios['max'] < 1
+
+
+def test_zstd_clients_decode_the_same_frames_with_smaller_messages(tmp_path):
+    pytest.importorskip('zstandard')
+    # The dictionary is trained on a recording of the same game
+    recording_websocket = FrameWebsocket('localhost', 9001)
+    recorded = [recording_websocket.encode_frame(frame).message for frame in generate_tiled_frames(100)]
+    dictionary_path = tmp_path / 'frames.zdict'
+    dictionary_path.write_bytes(train_dictionary([codepoints_to_binary(message_to_codepoints(message)) for message in recorded],
+                                                 size=16384))
+
+    frame_websocket = FrameWebsocket('localhost', 9001, zstd_dictionary_path=str(dictionary_path))
+    binary_client = connect(frame_websocket, parse_features('/?features=binary'))
+    zstd_client = connect(frame_websocket, parse_features('/?features=zstd'))
+    frame = None
+    for frame in generate_tiled_frames(20):
+        asyncio.run(deliver(frame_websocket, frame_websocket.encode_frame(frame)))
+
+    assert all(is_zstd_message(message) for message in zstd_client.messages)
+    assert sum(map(len, zstd_client.messages)) < sum(map(len, binary_client.messages)) / 2
+    codec = ZstdCodec(str(dictionary_path))
+    zstd_client.messages = [codec.decompress(message) for message in zstd_client.messages]
+    assert zstd_client.messages == binary_client.messages
+    assert np.array_equal(replay(zstd_client), frame[..., ::-1])
+    # Messages compressed with a dictionary can't be read without it
+    with pytest.raises(Exception):
+        ZstdCodec().decompress(codec.compress(binary_client.messages[-1]))
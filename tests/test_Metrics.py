@@ -0,0 +1,84 @@
+import asyncio
+import json
+import numpy as np
+from libs.Helpers.Metrics import Metrics, RingHistogram
+from libs.Helpers.StatsServer import StatsServer
+from libs.Websockets.FrameWebsocket import FrameWebsocket
+from libs.Websockets.FrameClient import FrameClient
+
+
+class FakeWebsocket:
+    async def send(self, message):
+        pass
+
+
+def test_histogram_keeps_the_latest_samples():
+    histogram = RingHistogram(capacity=4)
+    assert histogram.summary() == {'count': 0}
+    for value in [100, 100, 1, 2, 3, 4]:
+        histogram.record(value)
+    summary = histogram.summary()
+    assert summary['count'] == 6
+    assert summary['max'] == 4 and summary['mean'] == 2.5
+
+
+def test_counters_and_summary():
+    metrics = Metrics()
+    metrics.increment('dropped')
+    metrics.increment('dropped', 2)
+    metrics.record('encode_ms', 1.5)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'dropped': 3}
+    assert snapshot['histograms']['encode_ms']['p50'] == 1.5
+    assert metrics.format_summary() == "encode_ms p50 1.5 p95 1.5, dropped 3"
+
+
+def test_frame_websocket_records_metrics():
+    metrics = Metrics()
+    frame_websocket = FrameWebsocket('localhost', 9001, metrics=metrics)
+    websocket = FakeWebsocket()
+    frame_websocket.frame_websockets[websocket] = FrameClient(websocket)
+    frame = np.zeros((240, 256, 3), dtype=np.uint8)
+
+    async def run():
+        for color in range(3):
+            frame[:10] = color
+            await frame_websocket.broadcast(frame_websocket.encode_frame(frame.copy()))
+            await frame_websocket.wait_for_deliveries()
+
+    asyncio.run(run())
+    histograms = metrics.snapshot()['histograms']
+    assert histograms['encode_ms']['count'] == 3
+    assert histograms['message_bytes']['count'] == 3
+    assert histograms['send_latency_ms']['count'] == 3
+    assert metrics.counters['keyframes'] == 1
+
+
+async def get(port: int, target: str):
+    reader, writer = await asyncio.open_connection('localhost', port)
+    writer.write(f"GET {target} HTTP/1.0\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b'\r\n\r\n', 1)
+    return head.split(b'\r\n')[0].decode(), body.decode()
+
+
+def test_stats_server():
+    metrics = Metrics()
+    metrics.record('step_ms', 2.0)
+    stats_server = StatsServer('localhost', 0, metrics)
+
+    async def run():
+        server_task = asyncio.create_task(stats_server.start())
+        while stats_server.server is None:
+            await asyncio.sleep(0.01)
+        responses = [await get(stats_server.port, '/stats'), await get(stats_server.port, '/profile?seconds=0.1'),
+                     await get(stats_server.port, '/missing')]
+        server_task.cancel()
+        return responses
+
+    (stats_status, stats), (profile_status, profile), (missing_status, _) = asyncio.run(run())
+    assert stats_status == 'HTTP/1.0 200 OK'
+    assert json.loads(stats)['histograms']['step_ms']['max'] == 2.0
+    assert profile_status == 'HTTP/1.0 200 OK' and 'function calls' in profile
+    assert missing_status == 'HTTP/1.0 404 Not Found'
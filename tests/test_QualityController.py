@@ -0,0 +1,60 @@
+from libs.Helpers.QualityController import QualityController, QualityLevel
+from tests.conftest import FakeClock
+
+
+def make_controller(clock: FakeClock) -> QualityController:
+    levels = [QualityLevel(100, 8, 45.0), QualityLevel(100, 5, 30.0), QualityLevel(50, 4, 20.0)]
+    return QualityController(levels, target_bytes_per_second=1000.0, target_latency=0.1, target_send_latency=0.1,
+                             target_encode_time=0.01, clock=clock)
+
+
+def run_interval(controller: QualityController, clock: FakeClock, bytes_per_second: float, latency: float = 0.0,
+                 encode_time: float = 0.0, send_latency: float = 0.0, dropped_deliveries: int = 0) -> bool:
+    controller.record_frame(int(bytes_per_second * controller.ADJUST_INTERVAL), latency, encode_time)
+    controller.record_deliveries(send_latency, dropped_deliveries)
+    clock.now += controller.ADJUST_INTERVAL
+    return controller.update()
+
+
+def test_quality_drops_when_over_a_target(clock: FakeClock):
+    controller = make_controller(clock)
+    assert not controller.update()
+    assert run_interval(controller, clock, bytes_per_second=2000.0)
+    assert controller.level_index == 1
+    assert run_interval(controller, clock, bytes_per_second=100.0, latency=0.5)
+    assert controller.level_index == 2
+    # Already at the lowest level
+    assert not run_interval(controller, clock, bytes_per_second=2000.0)
+
+
+def test_quality_recovers_only_after_stable_intervals(clock: FakeClock):
+    controller = make_controller(clock)
+    run_interval(controller, clock, bytes_per_second=2000.0)
+    for _ in range(controller.STABLE_INTERVALS_TO_UPGRADE - 1):
+        assert not run_interval(controller, clock, bytes_per_second=100.0)
+    # Close to the target doesn't count as stable
+    assert not run_interval(controller, clock, bytes_per_second=900.0)
+    for _ in range(controller.STABLE_INTERVALS_TO_UPGRADE - 1):
+        assert not run_interval(controller, clock, bytes_per_second=100.0)
+    assert run_interval(controller, clock, bytes_per_second=100.0)
+    assert controller.level_index == 0
+
+
+def test_backlogged_clients_and_slow_encoding_drop_quality(clock: FakeClock):
+    controller = make_controller(clock)
+    # Frames reach the mailboxes in time, but a client's connection can't keep up
+    assert run_interval(controller, clock, bytes_per_second=100.0, send_latency=0.5)
+    assert run_interval(controller, clock, bytes_per_second=100.0, dropped_deliveries=controller.MAX_DROPPED_DELIVERIES + 1)
+    assert controller.level_index == 2
+
+    controller = make_controller(clock)
+    assert run_interval(controller, clock, bytes_per_second=100.0, encode_time=0.02)
+    assert controller.level_index == 1
+
+
+def test_any_dropped_delivery_prevents_upgrading(clock: FakeClock):
+    controller = make_controller(clock)
+    run_interval(controller, clock, bytes_per_second=2000.0)
+    for _ in range(controller.STABLE_INTERVALS_TO_UPGRADE * 2):
+        assert not run_interval(controller, clock, bytes_per_second=100.0, dropped_deliveries=1)
+    assert controller.level_index == 1
@@ -0,0 +1,64 @@
+import asyncio
+from libs.Helpers.GeneralHelpers import *
+from libs.Recording.RecordingFormat import TRAILER
+from libs.Recording.StreamReader import StreamReader
+from libs.Websockets.FrameWebsocket import FrameWebsocket
+from tests.test_FrameWebsocket import connect, deliver, generate_frames
+
+
+async def record(frame_websocket: FrameWebsocket, frames: list, path: str, keyframe_interval: int):
+    frame_websocket.start_recording(path, keyframe_interval=keyframe_interval)
+    for frame in frames:
+        await deliver(frame_websocket, frame_websocket.encode_frame(frame))
+    await frame_websocket.stop_recording()
+
+
+def test_recording_rebuilds_any_frame(tmp_path):
+    frame_websocket = FrameWebsocket('localhost', 9001)
+    frames = list(generate_frames(45))
+    path = str(tmp_path / 'stream.nesrec')
+    # Frames are recorded whether or not clients are connected
+    asyncio.run(record(frame_websocket, frames, path, keyframe_interval=10))
+
+    with StreamReader(path) as reader:
+        assert len(reader) == len(frames)
+        assert list(reader.keyframes['frame']) == [0, 10, 20, 30, 40]
+        # Jumping backwards and forwards, then reading in order from the cursor
+        for index in (44, 3, 27, 28, 29, 10, 0):
+            assert np.array_equal(reader.render(index), frames[index][..., ::-1])
+        message, is_keyframe, _ = reader.get_record(20)
+        assert is_keyframe
+        assert len(message) > len(reader.get_message(21))
+
+
+def test_recording_without_trailer_is_indexed_from_its_records(tmp_path):
+    frame_websocket = FrameWebsocket('localhost', 9001)
+    connect(frame_websocket)
+    frames = list(generate_frames(25))
+    path = str(tmp_path / 'stream.nesrec')
+    asyncio.run(record(frame_websocket, frames, path, keyframe_interval=10))
+
+    # Cut off the index, the trailer and part of the last record, like a recording that never got closed
+    with StreamReader(path) as reader:
+        last_record_end = len(reader.map) - TRAILER.size - reader.keyframes.nbytes
+    with open(path, 'r+b') as file:
+        file.truncate(last_record_end - 5)
+
+    with StreamReader(path) as reader:
+        assert len(reader) == len(frames) - 1
+        assert list(reader.keyframes['frame']) == [0, 10, 20]
+        assert np.array_equal(reader.render(23), frames[23][..., ::-1])
+
+
+def test_recording_keeps_the_frame_size(tmp_path):
+    frame_websocket = FrameWebsocket('localhost', 9001)
+    # Like a server with SCALE_PERCENTAGE at 50
+    frames = [cv2.resize(frame, (DEFAULT_FRAME_WIDTH // 2, DEFAULT_FRAME_HEIGHT // 2), interpolation=cv2.INTER_NEAREST)
+              for frame in generate_frames(15)]
+    path = str(tmp_path / 'stream.nesrec')
+    asyncio.run(record(frame_websocket, frames, path, keyframe_interval=10))
+
+    with StreamReader(path) as reader:
+        assert (reader.width, reader.height) == (DEFAULT_FRAME_WIDTH // 2, DEFAULT_FRAME_HEIGHT // 2)
+        for index in (14, 3):
+            assert np.array_equal(reader.render(index), frames[index][..., ::-1])
@@ -0,0 +1,23 @@
+import numpy as np
+from libs.Protocol.RowCache import RowCache
+
+
+def body(value: int, length: int = 8) -> np.ndarray:
+    return np.full(length, value, dtype=np.int64)
+
+
+def test_least_recently_used_entry_is_evicted():
+    row_cache = RowCache(size=3, min_length=8)
+    assert not row_cache.is_cacheable(body(1, length=7))
+    assert [row_cache.add(body(value)) for value in (1, 2, 3)] == [0, 1, 2]
+
+    # Finding or getting an entry makes it the most recently used, unless touch is off
+    assert row_cache.find(body(1)) == 0
+    assert row_cache.get(1, touch=False).tolist() == body(2).tolist()
+    assert row_cache.add(body(4)) == 1
+    assert row_cache.find(body(2)) is None
+    assert [slot for slot, _ in row_cache.entries()] == [2, 0, 1]
+
+    mirror = RowCache(size=3, min_length=8)
+    mirror.replace(row_cache.entries())
+    assert mirror.add(body(5)) == row_cache.add(body(5)) == 2
@@ -0,0 +1,186 @@
+import asyncio
+import multiprocessing
+import os
+import pytest
+import websockets
+from libs.Helpers.GeneralHelpers import *
+from libs.DisplayStrategies.DisplayStrategy import update_canvas
+from libs.Sessions.Session import Session
+from libs.Sessions.SessionManager import SessionManager, parse_session_path, DEFAULT_SESSION_ID
+from libs.Sessions.SharedFrameRing import SharedFrameRing, NES_FRAME_SHAPE
+
+ROM_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'roms')
+
+
+def test_frame_ring_reads_complete_frames_and_actions():
+    writer = SharedFrameRing(multiprocessing.Lock(), (4, 5, 3))
+    reader = SharedFrameRing(writer.lock, (4, 5, 3), name=writer.name)
+    try:
+        assert reader.acquire_latest() is None
+        frame = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+        writer.write(frame)
+        writer.write(frame + 1)
+        copy, sequence = reader.read()
+        assert sequence == 2
+        assert reader.latest_sequence == 2
+        assert np.array_equal(copy, frame + 1)
+        reader.set_action(8)
+        assert writer.get_action() == 8
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_frame_ring_never_writes_pinned_slots():
+    writer = SharedFrameRing(multiprocessing.Lock(), (4, 5, 3))
+    reader = SharedFrameRing(writer.lock, (4, 5, 3), name=writer.name)
+    try:
+        frame = np.zeros((4, 5, 3), dtype=np.uint8)
+        writer.write(frame)
+        first_slot, first_frame, first_sequence = reader.acquire_latest()
+        writer.write(frame + 1)
+        second_slot, second_frame, second_sequence = reader.acquire_latest()
+        assert (first_sequence, second_sequence) == (1, 2)
+        # Both pinned frames survive many more writes, and are read in place from shared memory
+        for i in range(2, 20):
+            writer.write(frame + i)
+        assert reader.latest_sequence == 20
+        assert np.all(first_frame == 0) and np.all(second_frame == 1)
+        assert reader.slot_sequences[first_slot] == 1 and reader.slot_sequences[second_slot] == 2
+        assert first_frame.ctypes.data == reader.frames[first_slot].ctypes.data
+
+        # A third pin could leave the writer without a slot
+        with pytest.raises(Exception):
+            reader.acquire_latest()
+        reader.release(first_slot)
+        third_slot, third_frame, third_sequence = reader.acquire_latest()
+        assert third_sequence == 20 and np.all(third_frame == 19)
+        for slot in (second_slot, third_slot):
+            reader.release(slot)
+        del first_frame, second_frame, third_frame
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_parse_session_path():
+    assert parse_session_path('/') == (DEFAULT_SESSION_ID, None)
+    assert parse_session_path('/?features=shift') == (DEFAULT_SESSION_ID, None)
+    assert parse_session_path('/world1?rom=flappy.nes&features=palette') == ('world1', 'flappy.nes')
+    assert parse_session_path('/../etc') is None
+
+
+async def receive_canvas(port: int, path: str) -> np.ndarray:
+    canvas = np.zeros((DEFAULT_FRAME_HEIGHT, DEFAULT_FRAME_WIDTH, 3), dtype=np.uint8)
+    async with websockets.connect(f'ws://localhost:{port}{path}', max_size=None) as client:
+        # The emulator takes a moment to start, then the first message is a keyframe
+        message = await asyncio.wait_for(client.recv(), timeout=30)
+        update_canvas(message=message, canvas=canvas, offset=OFFSET)
+    return canvas
+
+
+async def run_sessions():
+    manager = SessionManager('localhost', 0, 0, rom_directory=ROM_DIRECTORY, default_rom='flappy.nes')
+    manager.IDLE_TIMEOUT = 0.5
+    manager.MONITOR_INTERVAL = 0.1
+    manager.MAX_SESSIONS = 2
+    await manager.start()
+    try:
+        canvases = await asyncio.gather(receive_canvas(manager.frame_port, '/one'),
+                                        receive_canvas(manager.frame_port, '/two?rom=flappy.nes'))
+        for canvas in canvases:
+            assert canvas.any()
+        assert set(manager.sessions) == {'one', 'two'}
+        processes = [session.process for session in manager.sessions.values()]
+        assert processes[0].pid != processes[1].pid
+
+        # A ROM that isn't in the ROM directory doesn't start a session
+        async with websockets.connect(f'ws://localhost:{manager.frame_port}/three?rom=missing.nes') as client:
+            await client.wait_closed()
+            assert client.close_code == 1008
+        assert 'three' not in manager.sessions
+
+        # Both clients left, so the sessions stop once they've been idle long enough
+        monitor_task = asyncio.create_task(manager.monitor_sessions())
+        for _ in range(100):
+            if not manager.sessions and not any(process.is_alive() for process in processes):
+                break
+            await asyncio.sleep(0.1)
+        monitor_task.cancel()
+        assert not manager.sessions
+        assert not any(process.is_alive() for process in processes)
+    finally:
+        await manager.close()
+
+
+def test_sessions_start_on_demand_and_stop_when_idle():
+    asyncio.run(run_sessions())
+
+
+async def run_session_with_dead_worker():
+    manager = SessionManager('localhost', 0, 0, rom_directory=ROM_DIRECTORY, default_rom='flappy.nes')
+    manager.MONITOR_INTERVAL = 0.1
+    await manager.start()
+    try:
+        async with websockets.connect(f'ws://localhost:{manager.controller_port}/crash') as controller:
+            await controller.send('right')
+            for _ in range(100):
+                if 'crash' in manager.sessions and manager.sessions['crash'].controller_websockets:
+                    break
+                await asyncio.sleep(0.1)
+            session = manager.sessions['crash']
+            session.process.terminate()
+
+            # The monitor stops the session, and closes the controller connection before the frame ring
+            monitor_task = asyncio.create_task(manager.monitor_sessions())
+            await asyncio.wait_for(controller.wait_closed(), timeout=10)
+            monitor_task.cancel()
+            assert 'crash' not in manager.sessions
+            assert session.frame_ring.header is None
+            assert not session.controller_websockets
+            # A press that was already on its way is ignored
+            session.set_action(8)
+    finally:
+        await manager.close()
+
+
+def test_stopping_a_session_closes_its_controllers():
+    asyncio.run(run_session_with_dead_worker())
+
+
+
+def test_failed_broadcasts_release_their_frame_ring_slots():
+    session = Session('test', rom_path=None, host='localhost')
+    session.PUBLISH_FRAME_RATE = 200.0
+    session.frame_ring = SharedFrameRing(multiprocessing.Lock(), NES_FRAME_SHAPE)
+    failures = []
+    broadcast_frames = []
+
+    async def broadcast(encoded_frame):
+        if len(failures) < 3:
+            failures.append(encoded_frame)
+            raise Exception("Broadcast failed")
+        broadcast_frames.append(encoded_frame)
+
+    session.frame.broadcast = broadcast
+
+    async def run():
+        publish_task = asyncio.create_task(session.publish_frames())
+        for i in range(8):
+            session.frame_ring.write(np.full(NES_FRAME_SHAPE, i, dtype=np.uint8))
+            while len(failures) + len(broadcast_frames) <= i:
+                await asyncio.sleep(0.005)
+        publish_task.cancel()
+        await asyncio.gather(publish_task, return_exceptions=True)
+
+    try:
+        asyncio.run(asyncio.wait_for(run(), timeout=10))
+        # Publishing carried on after the failures, starting over with a keyframe
+        assert len(broadcast_frames) == 5
+        assert broadcast_frames[0].is_keyframe and not broadcast_frames[1].is_keyframe
+        # Only the frame the next delta would be encoded against is still pinned
+        assert session.frame_ring.slot_pins.sum() == 1
+    finally:
+        session.frame.encoder_executor.shutdown(wait=True)
+        session.frame.previous_frame = None
+        session.frame_ring.close()
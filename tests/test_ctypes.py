@@ -14,4 +14,145 @@ def test_random_frame_to_string(frame_to_string):
     result = frame_to_string.get_string(current_state, last_state)
     assert isinstance(result, str)
     assert result != ''
-    print(result)
\ No newline at end of file
+    print(result)
+
+def test_output_buffer_is_reused_and_sized_to_message(frame_to_string):
+    current_state = np.random.randint(0, 256, (240, 256, 3), dtype=np.uint8)
+    last_state = np.random.randint(0, 256, (240, 256, 3), dtype=np.uint8)
+
+    view = frame_to_string.get_view(current_state, None)
+    output = frame_to_string.output
+    assert view.nbytes > 0 and b'\x00' not in view.tobytes()
+
+    result = frame_to_string.get_bytes(current_state, last_state)
+    assert frame_to_string.output is output
+    assert result == frame_to_string.get_string(current_state, last_state).encode('utf-8')
+
+
+def test_colors_are_grouped_in_order_of_first_appearance(frame_to_string):
+    from libs.DisplayStrategies.FrameDecoder import parse_message
+    from libs.Helpers.GeneralHelpers import OFFSET
+
+    a, b, c = [10, 20, 30], [200, 100, 50], [0, 255, 0]
+    current_state = np.array([[a, a, b, a, c, c, b, a],
+                              [c, c, c, c, c, c, c, c],
+                              [b, b, b, b, b, b, b, b]], dtype=np.uint8)
+
+    message = frame_to_string.get_string(current_state, None)
+    assert frame_to_string.get_string(current_state, None) == message
+
+    runs = parse_message(message, offset=OFFSET)
+    first_row = runs.row_starts == 0
+    columns = list(zip(runs.column_starts[first_row], runs.column_spans[first_row]))
+    colors = [list(color[::-1]) for color in runs.colors[first_row]]
+    assert columns == [(0, 2), (3, 1), (7, 1), (2, 1), (6, 1), (4, 2)]
+    assert colors == [a, a, a, b, b, c]
+
+
+def test_deltas_reproduce_every_frame_exactly(frame_to_string):
+    from libs.DisplayStrategies.DisplayStrategy import update_canvas
+    from libs.Helpers.GeneralHelpers import OFFSET
+
+    previous_state = np.zeros((6, 8, 3), dtype=np.uint8)
+    # Rows that differ in the previous frame become identical in the current one, so they're sent as one row span.
+    previous_state[1, 2] = [1, 2, 3]
+    previous_state[3, 6] = [4, 5, 6]
+    current_state = previous_state.copy()
+    current_state[:4] = [7, 8, 9]
+    # Only the last row changes
+    last_row_state = current_state.copy()
+    last_row_state[5, 7] = [255, 0, 0]
+
+    canvas = np.zeros((6, 8, 3), dtype=np.uint8)
+    previous_frame = None
+    for state in (previous_state, current_state, last_row_state):
+        update_canvas(message=frame_to_string.get_string(state, previous_frame), canvas=canvas, offset=OFFSET)
+        previous_frame = state
+        assert np.array_equal(canvas, state[..., ::-1])
+
+    assert frame_to_string.get_string(last_row_state, last_row_state) == ''
+
+
+def test_delta_only_contains_changed_runs(frame_to_string):
+    from libs.DisplayStrategies.FrameDecoder import parse_message
+    from libs.Helpers.GeneralHelpers import OFFSET
+
+    previous_state = np.random.randint(0, 256, (240, 256, 3), dtype=np.uint8)
+    current_state = previous_state.copy()
+    current_state[100, 10:20] = [1, 2, 3]
+
+    runs = parse_message(frame_to_string.get_string(current_state, previous_state), offset=OFFSET)
+    assert list(zip(runs.row_starts, runs.row_spans, runs.column_starts, runs.column_spans)) == [(100, 1, 10, 10)]
+
+
+def test_rectangles_mode_sends_vertical_runs_as_rectangles():
+    from libs.DisplayStrategies.DisplayStrategy import update_canvas
+    from libs.DisplayStrategies.FrameDecoder import parse_message
+    from libs.Helpers.GeneralHelpers import OFFSET
+
+    rectangles_frame_to_string = FrameToString(rectangles=True)
+    row_frame_to_string = FrameToString()
+    previous_state = np.random.randint(0, 256, (240, 256, 3), dtype=np.uint8)
+    current_state = previous_state.copy()
+    current_state[20:120, 30:34] = [1, 2, 3]
+    current_state[50:52, 100] = [4, 5, 6]
+
+    message = rectangles_frame_to_string.get_string(current_state, previous_state)
+    runs = parse_message(message, offset=OFFSET)
+    # The short vertical run is left to the row encoding
+    assert list(zip(runs.row_starts, runs.row_spans, runs.column_starts, runs.column_spans)) == \
+           [(20, 100, 30, 4), (50, 1, 100, 1), (51, 1, 100, 1)]
+    assert len(message) < len(row_frame_to_string.get_string(current_state, previous_state))
+
+    canvas = previous_state[..., ::-1].copy()
+    update_canvas(message=message, canvas=canvas, offset=OFFSET)
+    assert np.array_equal(canvas, current_state[..., ::-1])
+
+
+def test_encoders_in_parallel_threads_match_sequential_encoding():
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = np.random.default_rng(0)
+    # Streams of different widths, so encoders sharing scratch state would corrupt each other
+    streams = [[rng.integers(0, 4, (240, width, 3), dtype=np.uint8) for _ in range(20)] for width in (256, 64, 200, 128)]
+
+    def encode_stream(stream, frame_to_string):
+        messages = []
+        previous_state = None
+        for state in stream:
+            messages.append(frame_to_string.get_bytes(state, previous_state))
+            previous_state = state
+        return messages
+
+    expected = [encode_stream(stream, FrameToString(rectangles=True)) for stream in streams]
+    with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        results = list(executor.map(encode_stream, streams, [FrameToString(rectangles=True) for _ in streams]))
+    assert results == expected
+
+
+def test_reset_and_close(frame_to_string):
+    current_state = np.random.randint(0, 256, (240, 256, 3), dtype=np.uint8)
+    message = frame_to_string.get_bytes(current_state, None)
+    frame_to_string.reset()
+    assert frame_to_string.get_bytes(current_state, None) == message
+
+    frame_to_string.close()
+    frame_to_string.close()
+    with pytest.raises(Exception):
+        frame_to_string.get_bytes(current_state, None)
+
+
+@pytest.mark.parametrize('rectangles', [False, True])
+def test_tiled_encoding_matches_single_thread(rectangles):
+    rng = np.random.default_rng(1)
+    encoders = [FrameToString(rectangles=rectangles, thread_count=thread_count) for thread_count in (1, 2, 3, 8)]
+    for shape in [(240, 256, 3), (480, 512, 3), (17, 9, 3), (1, 5, 3)]:
+        frames = [rng.integers(0, 3, shape, dtype=np.uint8) for _ in range(4)]
+        # Groups of identical rows that cross band boundaries, and a frame that is a single group
+        frames[1][shape[0] // 8:shape[0] * 7 // 8] = frames[1][0]
+        frames[2][:] = frames[2][0]
+        previous_state = None
+        for state in frames:
+            messages = [frame_to_string.get_bytes(state, previous_state) for frame_to_string in encoders]
+            assert all(message == messages[0] for message in messages)
+            previous_state = state
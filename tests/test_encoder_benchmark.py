@@ -0,0 +1,19 @@
+from libs.Helpers.GeneralHelpers import load_json_file
+from benchmarks.encoder_benchmark import DEFAULT_BASELINE_PATH, find_regressions, run_suite
+
+
+def test_message_sizes_match_the_baseline():
+    # Timing varies between machines, but the frames are deterministic, so sizes must not grow
+    results = run_suite(repeats=1)
+    assert find_regressions(results, load_json_file(DEFAULT_BASELINE_PATH)) == []
+
+
+def test_find_regressions():
+    baseline = {'static': {'plain': {'encode_us_per_frame': 100.0, 'bytes_per_frame': 20.0,
+                                     'runs_per_row': 2.0, 'decode_us_per_frame': 50.0}}}
+    results = {'static': {'plain': {'encode_us_per_frame': 120.0, 'bytes_per_frame': 19.0,
+                                    'runs_per_row': 2.5, 'decode_us_per_frame': 80.0}}}
+    regressions = find_regressions(results, baseline, time_tolerance=0.3)
+    assert len(regressions) == 2
+    assert 'runs_per_row' in regressions[0] and 'decode_us_per_frame' in regressions[1]
+    assert find_regressions({}, baseline) == ["static/plain: missing from the results"]
@@ -1,5 +1,6 @@
 from libs.Helpers.GeneralHelpers import *
 from libs.DisplayStrategies.AdvancedDisplayStrategy import AdvancedDisplayStrategy
+from libs.Protocol.FrameProtocol import FEATURE_BINARY, FEATURE_PALETTE, FEATURE_ROW_CACHE, FEATURE_SHIFT, FEATURE_ZSTD
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -7,7 +8,12 @@ logger = logging.getLogger(__name__)
 HOST = 'localhost'
 PORT = 9001
 SCALE_PERCENTAGE = 100
+# Optional protocol features, e.g. frozenset([FEATURE_PALETTE, FEATURE_SHIFT, FEATURE_ROW_CACHE, FEATURE_BINARY]) for smaller messages.
+# FEATURE_ZSTD needs the zstandard package, and the server's NESGameServer.ZSTD_DICTIONARY_PATH in ZSTD_DICTIONARY_PATH.
+FEATURES = frozenset()
+ZSTD_DICTIONARY_PATH = None
 
 if __name__ == "__main__":
-    display_strategy = AdvancedDisplayStrategy(host=HOST, port=PORT, scale_percentage=SCALE_PERCENTAGE)
+    display_strategy = AdvancedDisplayStrategy(host=HOST, port=PORT, scale_percentage=SCALE_PERCENTAGE,
+                                               features=FEATURES, zstd_dictionary_path=ZSTD_DICTIONARY_PATH)
     asyncio.run(display_strategy.receive_frames())
\ No newline at end of file